@@ -0,0 +1,172 @@
+'''Benchmarks of the loaders and analyses on synthetic archives
+
+Written for airspeed velocity (``asv run``, see ``asv.conf.json``) and also
+runnable without it with ``python -m benchmarks.run``. The scale of the
+archive is set with ``LOCA_BENCH_SCALE`` (see ``synthetic.SCALES``) and
+computations run on a local distributed cluster unless
+``LOCA_BENCH_SCHEDULER=threads``.
+'''
+import os
+import tempfile
+from contextlib import redirect_stderr, redirect_stdout
+
+# keep the caches of the benchmarks apart from the user's, don't log runs
+# and don't memoize results unless a benchmark asks for it
+os.environ.setdefault('LOCA_CACHE_DIR',
+                      os.path.join(tempfile.gettempdir(), 'loca-bench-cache'))
+os.environ.setdefault('LOCA_INSTRUMENT', '0')
+os.environ.setdefault('LOCA_MEMO', '0')
+
+import dask  # noqa: E402
+
+from loca import data_catalog, memo  # noqa: E402
+from loca.analysis import weighted_mean_of_monthly_data  # noqa: E402
+from loca.extremes import calc_7ro10, calc_ro20yr  # noqa: E402
+from loca.utils import calc_change  # noqa: E402
+
+from .synthetic import get_archive, use_archive  # noqa: E402
+
+SCALE = os.environ.get('LOCA_BENCH_SCALE', 'small')
+SCHEDULER = os.environ.get('LOCA_BENCH_SCHEDULER', 'distributed')
+
+_client = None
+
+
+def _setup():
+    '''point the loaders at the archive and start the local cluster once
+    per process'''
+    global _client
+    use_archive(get_archive(SCALE))
+    if SCHEDULER == 'threads':
+        dask.config.set(scheduler='threads')
+    elif _client is None:
+        from loca.tools import dask_distributed_setup
+        _, _client = dask_distributed_setup('local', adapt=False,
+                                            scheduler_file=None)
+
+
+def _quiet(func, *args, **kwargs):
+    '''call a loader without its progress output'''
+    with open(os.devnull, 'w') as devnull:
+        with redirect_stdout(devnull), redirect_stderr(devnull):
+            return func(*args, **kwargs)
+
+
+class Loaders(object):
+    '''opening (metadata only) every collection'''
+    params = ['load_daily_loca_hydrology', 'load_daily_loca_meteorology',
+              'load_monthly_loca_hydrology', 'load_monthly_loca_meteorology',
+              'load_daily_bcsd_hydrology', 'load_daily_bcsd_meteorology',
+              'load_monthly_bcsd_hydrology', 'load_monthly_bcsd_meteorology',
+              'load_daily_maurer_meteorology',
+              'load_monthly_maurer_hydrology',
+              'load_daily_livneh_hydrology', 'load_daily_livneh_meteorology',
+              'load_monthly_livneh_hydrology']
+    param_names = ['loader']
+    timeout = 600
+
+    def setup(self, loader):
+        _setup()
+
+    def time_open(self, loader):
+        _quiet(getattr(data_catalog, loader))
+
+    def time_open_and_load(self, loader):
+        _quiet(getattr(data_catalog, loader)).load()
+
+    def peakmem_open_and_load(self, loader):
+        _quiet(getattr(data_catalog, loader)).load()
+
+
+class Wrappers(object):
+    '''the multi-source wrappers used by the notebooks'''
+    timeout = 600
+
+    def setup(self):
+        _setup()
+
+    def time_daily_cmip_hydro_datasets(self):
+        _quiet(data_catalog.load_daily_cmip_hydro_datasets, 'rcp85')
+
+    def time_monthly_historical_hydro_datasets(self):
+        _quiet(data_catalog.load_monthly_historical_hydro_datasets)
+
+
+class Resample(object):
+    '''daily to monthly and annual aggregation'''
+    params = ['MS', 'AS']
+    param_names = ['freq']
+    timeout = 600
+
+    def setup(self, freq):
+        _setup()
+        self.ds = _quiet(data_catalog.load_daily_loca_hydrology)
+
+    def time_resample_daily_data(self, freq):
+        data_catalog.resample_daily_data(self.ds, freq=freq).load()
+
+    def peakmem_resample_daily_data(self, freq):
+        data_catalog.resample_daily_data(self.ds, freq=freq).load()
+
+
+class Analysis(object):
+    '''epoch means and change signals of monthly data'''
+    timeout = 600
+
+    def setup(self):
+        _setup()
+        self.hist = _quiet(data_catalog.load_monthly_loca_hydrology,
+                           'historical')
+        self.rcp = _quiet(data_catalog.load_monthly_loca_hydrology, 'rcp85')
+        self.hist_mean = weighted_mean_of_monthly_data(self.hist).load()
+        self.rcp_mean = weighted_mean_of_monthly_data(self.rcp).load()
+
+    def time_weighted_mean_of_monthly_data(self):
+        weighted_mean_of_monthly_data(self.hist).load()
+
+    def time_calc_change(self):
+        calc_change(self.hist_mean, self.rcp_mean, pct=True).load()
+
+    def time_change_from_monthly(self):
+        calc_change(weighted_mean_of_monthly_data(self.hist),
+                    weighted_mean_of_monthly_data(self.rcp)).load()
+
+
+class Memo(object):
+    '''change signals served from the memo cache'''
+    timeout = 600
+
+    def setup(self):
+        _setup()
+        memo.clear()
+        self.hist = _quiet(data_catalog.load_monthly_loca_hydrology,
+                           'historical')
+        self.rcp = _quiet(data_catalog.load_monthly_loca_hydrology, 'rcp85')
+        self.time_change_from_monthly()
+
+    def time_change_from_monthly(self):
+        calc_change(weighted_mean_of_monthly_data(self.hist, memo=True),
+                    weighted_mean_of_monthly_data(self.rcp, memo=True),
+                    memo=True).load()
+
+
+class Extremes(object):
+    '''return periods of annual runoff extremes'''
+    params = ['pearson3', 'gev']
+    param_names = ['dist']
+    timeout = 600
+
+    def setup(self, dist):
+        _setup()
+        self.runoff = _quiet(data_catalog.load_daily_loca_hydrology,
+                             variables=['total_runoff'],
+                             chunks='extreme_fit')['total_runoff']
+
+    def time_ro20yr(self, dist):
+        calc_ro20yr(self.runoff, dist=dist).load()
+
+    def time_7ro10(self, dist):
+        calc_7ro10(self.runoff, dist=dist).load()
+
+    def peakmem_7ro10(self, dist):
+        calc_7ro10(self.runoff, dist=dist).load()
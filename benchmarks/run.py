@@ -0,0 +1,114 @@
+'''Run the benchmarks without asv and track the results over commits
+
+    python -m benchmarks.run [-b <regex>] [-n <repeat>]
+
+Runs every ``time_*`` benchmark in ``benchmarks.benchmarks`` (``peakmem_*``
+benchmarks need asv), prints the best of ``repeat`` timings and appends
+them, with the commit and machine, to ``.asv/results/runs.jsonl``. Each
+timing is compared to the last run on the same machine, scale and
+scheduler.
+'''
+import argparse
+import inspect
+import itertools
+import json
+import os
+import re
+import socket
+import subprocess
+import time as timer
+from datetime import datetime
+
+from . import benchmarks
+
+RESULTS = os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), '.asv', 'results', 'runs.jsonl')
+
+
+def _commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], universal_newlines=True,
+            cwd=os.path.dirname(os.path.abspath(__file__))).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _cases(pattern=None):
+    '''(name, class, method, params) of every time benchmark'''
+    for cname, cls in inspect.getmembers(benchmarks, inspect.isclass):
+        if cls.__module__ != benchmarks.__name__:
+            continue
+        params = getattr(cls, 'params', [])
+        if params and not isinstance(params[0], list):
+            params = [params]
+        for mname, _ in inspect.getmembers(cls, inspect.isfunction):
+            if not mname.startswith('time_'):
+                continue
+            for args in itertools.product(*params):
+                name = '%s.%s' % (cname, mname)
+                if args:
+                    name += '(%s)' % ', '.join(map(str, args))
+                if pattern is None or re.search(pattern, name):
+                    yield name, cls, mname, args
+
+
+def run(pattern=None, repeat=3):
+    '''time the benchmarks matching pattern, return ``{name: seconds}``'''
+    results = {}
+    for name, cls, method, args in _cases(pattern):
+        bench = cls()
+        if hasattr(bench, 'setup'):
+            bench.setup(*args)
+        timings = []
+        for _ in range(repeat):
+            start = timer.perf_counter()
+            getattr(bench, method)(*args)
+            timings.append(timer.perf_counter() - start)
+        results[name] = min(timings)
+        print('%-70s %10.4f s' % (name, results[name]), flush=True)
+    return results
+
+
+def _previous(machine, scale, scheduler, path=RESULTS):
+    try:
+        with open(path) as f:
+            runs = [json.loads(line) for line in f if line.strip()]
+    except OSError:
+        return {}
+    key = (machine, scale, scheduler)
+    runs = [r for r in runs
+            if (r['machine'], r['scale'], r['scheduler']) == key]
+    return runs[-1]['results'] if runs else {}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('-b', '--bench', default=None,
+                        help='regular expression selecting benchmarks')
+    parser.add_argument('-n', '--repeat', type=int, default=3)
+    parser.add_argument('--results', default=RESULTS)
+    args = parser.parse_args()
+
+    machine = socket.gethostname()
+    previous = _previous(machine, benchmarks.SCALE, benchmarks.SCHEDULER,
+                         args.results)
+    results = run(args.bench, repeat=args.repeat)
+
+    for name, t in sorted(results.items()):
+        if previous.get(name):
+            ratio = t / previous[name]
+            if ratio > 1.1 or ratio < 0.9:
+                print('%-70s %6.2fx' % (name, ratio))
+
+    os.makedirs(os.path.dirname(args.results), exist_ok=True)
+    with open(args.results, 'a') as f:
+        f.write(json.dumps({'commit': _commit(), 'machine': machine,
+                            'scale': benchmarks.SCALE,
+                            'scheduler': benchmarks.SCHEDULER,
+                            'date': datetime.now().isoformat(),
+                            'results': results}) + '\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,199 @@
+'''Synthetic archives with the directory layouts of the GLADE datasets
+
+``make_archive`` writes small (or not so small) random netCDF files in the
+same trees, file names, coordinate and variable names the loaders in
+``loca.data_catalog`` expect, so that they can be benchmarked anywhere:
+
+- LOCA met: ``<model>/<res>/<scen>/<ens>/<var>/<var>_day_<model>_<scen>_<ens>_<drange>.LOCA_2016-04-02.16th.nc``
+- LOCA VIC: ``<model>/vic_output.<scen>.netcdf/<res>/<var>.<year>.v0.nc``
+- BCSD (daily and monthly, met and VIC): ``<model>_<scen>_<ens>/<model>_<year>.nc``
+- Maurer met: ``<var>/nldas_met_update.obs.daily.<var>.<year>.nc``, Maurer VIC: ``vic.<year>.nc``
+- Livneh met: ``<res>/livneh_NAmerExt_15Oct2014.<year><month>.nc``
+- Livneh VIC: ``Livneh_L14_CONUS/<res>/<var>.<year>.v0.nc`` in the LOCA VIC tree
+'''
+import os
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+# models, years per period and grid size of the preset scales
+SCALES = {
+    'small': dict(nmodels=2, nyears=2, nlat=16, nlon=24),
+    'medium': dict(nmodels=4, nyears=5, nlat=64, nlon=128),
+    # the size of the 1/8th degree CONUS grid
+    'large': dict(nmodels=8, nyears=10, nlat=222, nlon=462),
+}
+
+HIST_START, FUTURE_START = 1950, 2006
+ENSEMBLE = 'r1i1p1'
+
+
+def _grid(nlat, nlon):
+    lat = np.linspace(25.0625, 52.9375, nlat).astype('f4')
+    lon = np.linspace(-124.6875, -67.0625, nlon).astype('f4')
+    return lat, lon
+
+
+def _land_mask(nlat, nlon):
+    '''a blob of land with ocean in one corner'''
+    mask = np.ones((nlat, nlon), dtype=bool)
+    mask[:nlat // 3, :nlon // 3] = False
+    return mask
+
+
+def _dataset(names, time, lat, lon, latname='lat', lonname='lon', seed=0):
+    rs = np.random.RandomState(seed)
+    mask = _land_mask(len(lat), len(lon))
+    ds = xr.Dataset(coords={'time': time, latname: lat, lonname: lon})
+    for name in names:
+        data = rs.gamma(2., size=(len(time), len(lat), len(lon))).astype('f4')
+        if name in ('tasmin', 'tasmax', 'Tmin', 'Tmax'):
+            data = data + 280
+        if name == 'pr':
+            data = data / 86400.
+        data[:, ~mask] = np.nan
+        ds[name] = (('time', latname, lonname), data)
+    return ds
+
+
+def _days(year):
+    return pd.date_range('%d-01-01' % year, '%d-12-31' % year)
+
+
+def _write(ds, path):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    ds.to_netcdf(path)
+
+
+def make_archive(root, scale='small', resolution='8th', **kwargs):
+    '''write a synthetic archive below root
+
+    Parameters
+    ----------
+    root : str
+        Directory of the archive
+    scale : str
+        One of ``SCALES``; ``nmodels``, ``nyears``, ``nlat`` and ``nlon`` can
+        be overridden with keyword arguments
+    resolution : str
+        Resolution directory of the LOCA and Livneh files
+
+    Returns
+    -------
+    dirs : dict
+        Maps the root directory constants of ``loca.data_catalog`` to the
+        directories of the archive (see ``use_archive``)
+    '''
+    opts = dict(SCALES[scale], **kwargs)
+    models = ['Model%d' % i for i in range(opts['nmodels'])]
+    hist = list(range(HIST_START, HIST_START + opts['nyears']))
+    future = list(range(FUTURE_START, FUTURE_START + opts['nyears']))
+    periods = [('historical', hist), ('rcp85', future)]
+    lat, lon = _grid(opts['nlat'], opts['nlon'])
+    dirs = {}
+
+    d = dirs['LOC_MET_ROOT_DIR'] = os.path.join(root, 'LOCA', 'met')
+    for i, m in enumerate(models):
+        for scen, years in periods:
+            for var in ['pr', 'tasmin', 'tasmax']:
+                for y in years:
+                    name = ('%s_day_%s_%s_%s_%d0101-%d1231.LOCA_2016-04-02.'
+                            '16th.nc' % (var, m, scen, ENSEMBLE, y, y))
+                    _write(_dataset([var], _days(y), lat, lon, seed=i),
+                           os.path.join(d, m, resolution, scen, ENSEMBLE,
+                                        var, name))
+
+    d = dirs['LOCA_VIC_ROOT_DIR'] = os.path.join(root, 'LOCA', 'vic')
+    for i, m in enumerate(models):
+        for scen, years in periods:
+            for var in ['runoff', 'baseflow', 'ET', 'SWE']:
+                for y in years:
+                    _write(_dataset([var], _days(y), lat, lon, seed=i),
+                           os.path.join(d, m, 'vic_output.%s.netcdf' % scen,
+                                        resolution, '%s.%d.v0.nc' % (var, y)))
+
+    for key, sub, names, freq in (
+            ('BCSD_MET_ROOT_DIR', 'BCSD_daily_forc_nc',
+             ['pr', 'tasmin', 'tasmax'], 'D'),
+            ('BCSD_VIC_ROOT_DIR', 'BCSD_daily_VIC_nc',
+             ['total runoff', 'et'], 'D'),
+            ('BCSD_MET_MON_ROOT_DIR', 'BCSD_mon_forc_nc',
+             ['pr', 'tasmin', 'tasmax', 'tas'], 'MS'),
+            ('BCSD_VIC_MON_ROOT_DIR', 'BCSD_mon_VIC_nc',
+             ['total_runoff', 'et', 'swe'], 'MS')):
+        d = dirs[key] = os.path.join(root, 'BCSD', sub)
+        for i, m in enumerate(models):
+            ml = m.lower()
+            for y in hist + future:
+                time = pd.date_range('%d-01-01' % y, '%d-12-31' % y,
+                                     freq=freq)
+                _write(_dataset(names, time, lat, lon, 'latitude',
+                                'longitude', seed=i),
+                       os.path.join(d, '%s_rcp85_%s' % (ml, ENSEMBLE),
+                                    '%s_%d.nc' % (ml, y)))
+
+    d = dirs['MAURER_MET_ROOT_DIR'] = os.path.join(root, 'Maurer_met')
+    for var in ['pr', 'tasmin', 'tasmax']:
+        for y in hist:
+            # Maurer longitudes are in [0, 360)
+            _write(_dataset([var], _days(y), lat, lon + 360),
+                   os.path.join(d, var, 'nldas_met_update.obs.daily.%s.%d.nc'
+                                % (var, y)))
+    d = dirs['MAURER_VIC_ROOT_DIR'] = os.path.join(root, 'BCSD',
+                                                   'historical_mon_VIC')
+    for y in hist:
+        time = pd.date_range('%d-01-01' % y, '%d-12-31' % y, freq='MS')
+        _write(_dataset(['et', 'swe', 'surface_runoff', 'total_runoff'],
+                        time, lat, lon, 'latitude', 'longitude'),
+               os.path.join(d, 'vic.%d.nc' % y))
+
+    d = dirs['LIVNEH_MET_ROOT_DIR'] = os.path.join(root, 'Livneh_met')
+    for y in hist:
+        for month in range(1, 13):
+            start = pd.Timestamp('%d-%02d-01' % (y, month))
+            time = pd.date_range(start, start + pd.offsets.MonthEnd(1))
+            _write(_dataset(['Prec', 'Tmin', 'Tmax'], time, lat, lon),
+                   os.path.join(d, resolution,
+                                'livneh_NAmerExt_15Oct2014.%d%02d.nc'
+                                % (y, month)))
+    d = dirs['LIVNEH_VIC_ROOT_DIR'] = os.path.join(
+        dirs['LOCA_VIC_ROOT_DIR'], 'Livneh_L14_CONUS')
+    for var in ['runoff', 'baseflow', 'ET', 'SWE']:
+        for y in hist:
+            _write(_dataset([var], _days(y), lat, lon),
+                   os.path.join(d, resolution, '%s.%d.v0.nc' % (var, y)))
+    return dirs
+
+
+def use_archive(dirs):
+    '''point the loaders in ``loca.data_catalog`` at a synthetic archive'''
+    from loca import data_catalog
+    for key, path in dirs.items():
+        setattr(data_catalog, key, path)
+
+
+def get_archive(scale='small', root=None):
+    '''return the dirs of the archive at scale, writing it if needed
+
+    Archives are kept in ``root`` (default ``LOCA_BENCH_DIR`` or
+    ``bench`` in the loca cache directory) and reused between runs.
+    '''
+    if root is None:
+        root = os.environ.get('LOCA_BENCH_DIR')
+    if root is None:
+        from loca.utils import get_cache_dir
+        root = get_cache_dir('bench')
+    root = os.path.join(root, scale)
+    done = os.path.join(root, 'complete')
+    if not os.path.isfile(done):
+        dirs = make_archive(root, scale=scale)
+        with open(done, 'w') as f:
+            f.write('\n'.join('%s=%s' % kv for kv in sorted(dirs.items())))
+    with open(done) as f:
+        return dict(line.split('=', 1) for line in f.read().splitlines())
+
+
+if __name__ == '__main__':
+    import sys
+    make_archive(sys.argv[1], *sys.argv[2:3])
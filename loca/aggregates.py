@@ -0,0 +1,152 @@
+'''On-disk store of monthly and annual aggregates of the daily archives
+
+Resampling the full daily archive every time a monthly dataset is loaded is
+expensive. An ``AggregateStore`` holds one chunked, compressed netCDF file per
+resampling frequency along with a ``provenance.json`` that records the source
+files (path, size and mtime) the aggregates were computed from and the dtype
+of the precision policy they were written in. The store is current as long as
+the source files it was built from have not changed and the dtype matches.
+'''
+import hashlib
+import json
+import os
+from datetime import datetime
+
+import xarray as xr
+
+from .utils import get_cache_dir
+
+AGGREGATE_VERSION = 1
+
+DEFAULT_FREQS = ('MS', 'AS')
+
+# on-disk chunk length along time for each frequency
+TIME_CHUNKS = {'MS': 120, 'AS': 30}
+
+
+def source_fingerprint(records):
+    '''hash of the (path, size, mtime) of a list of FileIndex records'''
+    h = hashlib.sha1()
+    for r in sorted(records, key=lambda r: r['path']):
+        h.update(('%s:%s:%s\n' % (r['path'], r['size'], r['mtime'])).encode())
+    return h.hexdigest()
+
+
+def store_name(source, *args):
+    '''build a store name from a source name and the loader arguments'''
+    parts = [source]
+    for a in args:
+        if a is None:
+            parts.append('all')
+        elif isinstance(a, (list, tuple, set)):
+            parts.append(hashlib.sha1(
+                ','.join(sorted(a)).encode()).hexdigest()[:12])
+        else:
+            parts.append(str(a))
+    return '.'.join(parts)
+
+
+def _encoding(ds, freq):
+    encoding = {}
+    for name, da in ds.data_vars.items():
+        chunksizes = []
+        for dim, size in zip(da.dims, da.shape):
+            if dim == 'time':
+                size = min(size, TIME_CHUNKS.get(freq, size))
+            elif dim == 'gcm':
+                size = 1
+            chunksizes.append(max(size, 1))
+        encoding[name] = {'zlib': True, 'complevel': 1,
+                          'chunksizes': tuple(chunksizes)}
+    return encoding
+
+
+class AggregateStore(object):
+    '''Pre-aggregated copies of one loader output
+
+    Parameters
+    ----------
+    name : str
+        Unique name of the loader output (see ``store_name``)
+    sources : list
+        FileIndex records of the daily files the aggregates are built from
+    root : str, optional
+        Parent directory of the store, defaults to the loca cache directory
+    dtype : numpy dtype, optional
+        Dtype of the precision policy the aggregates are read and written
+        in, None for the native dtypes (see ``loca.precision``)
+    '''
+
+    def __init__(self, name, sources, root=None, dtype=None):
+        self.name = name
+        self.sources = list(sources)
+        self.dtype = 'native' if dtype is None else str(dtype)
+        if root is None:
+            root = get_cache_dir('aggregates')
+        self.path = os.path.join(root, name)
+
+    def __repr__(self):
+        return '<AggregateStore %s>' % self.path
+
+    @property
+    def provenance_file(self):
+        return os.path.join(self.path, 'provenance.json')
+
+    def _file(self, freq):
+        return os.path.join(self.path, '%s.nc' % freq)
+
+    @property
+    def provenance(self):
+        try:
+            with open(self.provenance_file) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def is_current(self, freq='MS'):
+        '''True if the aggregate for freq exists, the sources are unchanged
+        and it was written in the store's dtype'''
+        prov = self.provenance
+        if prov is None or prov.get('version') != AGGREGATE_VERSION:
+            return False
+        if prov.get('dtype') != self.dtype:
+            return False
+        if freq not in prov['freqs'] or not os.path.isfile(self._file(freq)):
+            return False
+        return prov['fingerprint'] == source_fingerprint(self.sources)
+
+    def open(self, freq='MS', chunks=None):
+        '''open the stored aggregate for freq'''
+        return xr.open_dataset(self._file(freq),
+                               chunks={} if chunks is None else chunks)
+
+    def write(self, aggregates, rules=None):
+        '''write a dict of {freq: dataset} to the store
+
+        ``rules`` (variable name -> 'sum' or 'mean') is recorded in the
+        provenance alongside the source files.
+        '''
+        os.makedirs(self.path, exist_ok=True)
+        # invalidate the store while we write to it
+        if os.path.exists(self.provenance_file):
+            os.remove(self.provenance_file)
+
+        for freq, ds in aggregates.items():
+            fname = self._file(freq)
+            tmp = '%s.%d.tmp' % (fname, os.getpid())
+            ds.to_netcdf(tmp, encoding=_encoding(ds, freq))
+            os.replace(tmp, fname)
+
+        prov = {'version': AGGREGATE_VERSION, 'name': self.name,
+                'created': datetime.now().isoformat(),
+                'freqs': sorted(aggregates),
+                'dtype': self.dtype,
+                'rules': rules or {},
+                'fingerprint': source_fingerprint(self.sources),
+                'sources': [{k: r[k] for k in ('path', 'size', 'mtime')}
+                            for r in self.sources]}
+        tmp = '%s.%d.tmp' % (self.provenance_file, os.getpid())
+        with open(tmp, 'w') as f:
+            json.dump(prov, f)
+        os.replace(tmp, self.provenance_file)
+        return self
@@ -1,8 +1,274 @@
+import warnings
 
-from .utils import dpm_from_time_var
+import numpy as np
+import xarray as xr
 
+from .data_catalog import SUM_VARS
+from .instrument import instrument
+from .memo import memoize
+from .precision import ACCUMULATOR, cast, get_dtype
+from .utils import calc_change, dpm_from_time_var
 
+
+@instrument(kind='analysis')
+@memoize()
 def weighted_mean_of_monthly_data(ds, freq='AS'):
     '''months should be weighted by the number of days'''
-    dpm = dpm_from_time_var(ds['time'])
-    return (ds * dpm).mean('time') / dpm.sum('time')
+    dpm = dpm_from_time_var(ds['time'], dtype=get_dtype())
+    weighted = (ds * dpm).mean('time', dtype=ACCUMULATOR)
+    return cast(weighted / dpm.sum('time', dtype=ACCUMULATOR))
+
+
+def _time_weights(time):
+    '''days represented by each time step (1 for daily, days per month for
+    monthly data)'''
+    if time.size > 1 and np.median(np.diff(time.values)) > np.timedelta64(2, 'D'):
+        return dpm_from_time_var(time, dtype=ACCUMULATOR).values
+    return np.ones(time.size, dtype=ACCUMULATOR)
+
+
+class _EpochAccumulator(object):
+    '''running day-weighted sums for one dataset and one epoch'''
+
+    def __init__(self):
+        self.sums = {}
+        self.weights = {}
+
+    def add(self, ds, weights, how, dim):
+        axis_weights = xr.DataArray(weights, dims=dim)
+        for name, da in ds.data_vars.items():
+            if dim not in da.dims:
+                continue
+            valid = da.notnull()
+            if how(name) == 'sum':
+                # annual totals, averaged over the years of the epoch;
+                # years without any valid value (e.g. ocean cells) don't
+                # count, so cells that are never valid stay NaN
+                s = da.fillna(0).sum(dim, dtype=ACCUMULATOR)
+                w = valid.any(dim).astype(ACCUMULATOR)
+            else:
+                s = (da.fillna(0) * axis_weights).sum(dim, dtype=ACCUMULATOR)
+                w = (valid * axis_weights).sum(dim, dtype=ACCUMULATOR)
+            if name in self.sums:
+                self.sums[name] = self.sums[name] + s
+                self.weights[name] = self.weights[name] + w
+            else:
+                self.sums[name] = s
+                self.weights[name] = w
+
+    def result(self):
+        out = xr.Dataset()
+        for name, s in self.sums.items():
+            out[name] = s / self.weights[name].where(self.weights[name] > 0)
+        return cast(out)
+
+
+@instrument(kind='analysis', report=True)
+def epoch_climatology(datasets, epochs, how=None, dim='time'):
+    '''streaming annual climatology of many datasets over many epochs
+
+    The input files are walked one year (and one gcm) at a time and running
+    day-weighted sums are kept for every epoch, so memory is bounded by one
+    year of one grid rather than by the epoch length. Variables in
+    ``SUM_VARS`` give the mean annual total, all other variables the
+    day-weighted mean over the epoch. Epochs should span whole years.
+
+    Parameters
+    ----------
+    datasets : dict
+        Maps a key (e.g. ``('loca', 'rcp85')``) to a lazily loaded daily or
+        monthly dataset, as returned by the ``load_*`` functions
+    epochs : dict
+        Maps an epoch name to a time slice, e.g.
+        ``{'hist': slice('1970-01-01', '1999-12-31')}``
+    how : callable, optional
+        Maps a variable name to ``'sum'`` or ``'mean'``
+
+    Returns
+    -------
+    out : dict
+        ``out[key][epoch]`` is the climatology of ``datasets[key]``
+    '''
+    if how is None:
+        how = lambda name: 'sum' if name in SUM_VARS else 'mean'
+
+    out = {}
+    for key, ds in datasets.items():
+        members = [None]
+        if 'gcm' in ds.dims:
+            members = list(range(ds.sizes['gcm']))
+
+        results = {e: [] for e in epochs}
+        for member in members:
+            member_ds = ds if member is None else ds.isel(gcm=member)
+            clim = _member_climatology(member_ds, epochs, how, dim)
+            for e in epochs:
+                results[e].append(clim[e])
+
+        out[key] = {}
+        for e, sl in epochs.items():
+            if members == [None]:
+                clim = results[e][0]
+            else:
+                clim = xr.concat(results[e], dim=ds['gcm'])
+            clim.attrs['epoch'] = '%s to %s' % (sl.start, sl.stop)
+            out[key][e] = clim
+    return out
+
+
+def _member_climatology(ds, epochs, how, dim='time'):
+    '''climatology of every epoch of one member, walked one year at a time'''
+    times = ds[dim]
+    in_epoch = {e: times.isin(times.sel({dim: sl}).values).values
+                for e, sl in epochs.items()}
+    years = times.dt.year.values
+
+    acc = {e: _EpochAccumulator() for e in epochs}
+    for year in np.unique(years):
+        in_year = years == year
+        wanted = [e for e in epochs if in_epoch[e][in_year].any()]
+        if not wanted:
+            continue
+        block = ds.isel({dim: np.flatnonzero(in_year)}).load()
+        weights = _time_weights(block[dim])
+        for e in wanted:
+            keep = in_epoch[e][in_year]
+            acc[e].add(block.isel({dim: np.flatnonzero(keep)}),
+                       weights[keep], how, dim)
+    return {e: acc[e].result() for e in epochs}
+
+
+def _quantile_name(q):
+    return 'q%g' % (100 * q)
+
+
+class _EnsembleAccumulator(object):
+    '''per grid cell statistics of ensemble members added one at a time
+
+    Only one map per member and variable, in the policy dtype, is kept (for
+    the median and percentiles), the mean and spread are accumulated in
+    ``ACCUMULATOR`` precision.
+    '''
+
+    def __init__(self):
+        self.members = []
+        self.coords = None
+
+    def add(self, member, ds):
+        ds = ds.load()
+        if self.coords is None:
+            self.coords = ds.coords
+            self.maps = {name: [] for name in ds.data_vars}
+            self.sums = {name: 0. for name in ds.data_vars}
+            self.squares = {name: 0. for name in ds.data_vars}
+            self.positive = {name: 0 for name in ds.data_vars}
+            self.negative = {name: 0 for name in ds.data_vars}
+            self.counts = {name: 0 for name in ds.data_vars}
+        self.members.append(member)
+        for name, da in ds.data_vars.items():
+            x = da.values
+            valid = ~np.isnan(x)
+            x64 = np.where(valid, x, 0).astype(ACCUMULATOR)
+            self.maps[name].append(x.astype(get_dtype() or x.dtype))
+            self.sums[name] = self.sums[name] + x64
+            self.squares[name] = self.squares[name] + x64 ** 2
+            self.counts[name] = self.counts[name] + valid
+            self.positive[name] = self.positive[name] + (x > 0)
+            self.negative[name] = self.negative[name] + (x < 0)
+        self.dims = {name: da.dims for name, da in ds.data_vars.items()}
+
+    def result(self, quantiles=(0.1, 0.9)):
+        stats = ['mean', 'median', 'std', 'min', 'max']
+        stats += [_quantile_name(q) for q in quantiles]
+        stats += ['agreement', 'count']
+        out = xr.Dataset(coords=self.coords)
+        for name, maps in self.maps.items():
+            stack = np.stack(maps)
+            n = self.counts[name]
+            with np.errstate(invalid='ignore', divide='ignore'), \
+                    warnings.catch_warnings():
+                # all-NaN (ocean) cells
+                warnings.simplefilter('ignore', RuntimeWarning)
+                mean = self.sums[name] / n
+                var = (self.squares[name] - n * mean ** 2) / (n - 1)
+                std = np.sqrt(np.maximum(var, 0))
+                # fraction of the members with the sign of the ensemble mean
+                agreement = np.where(mean >= 0, self.positive[name],
+                                     self.negative[name]) / n
+                values = [mean, np.nanmedian(stack, axis=0), std,
+                          np.nanmin(stack, axis=0), np.nanmax(stack, axis=0)]
+                values += list(np.nanquantile(stack, quantiles, axis=0))
+            values += [agreement, n]
+            mask = n > 0
+            data = np.stack([np.where(mask, v, np.nan) for v in values])
+            out[name] = (('statistic', ) + self.dims[name],
+                         data.astype(stack.dtype))
+        out.coords['statistic'] = stats
+        out.attrs['members'] = ', '.join(str(m) for m in self.members)
+        return out
+
+
+@instrument(kind='analysis')
+def ensemble_statistics(ds, quantiles=(0.1, 0.9), dim='gcm'):
+    '''mean, median, spread, range, quantiles and sign agreement across dim
+
+    Members are loaded one at a time, so ``ds`` may be a lazy dataset of
+    per-member results (e.g. return levels) of any size. Returns a dataset
+    with a ``statistic`` dimension (``'mean'``, ``'median'``, ``'std'``,
+    ``'min'``, ``'max'``, ``'q10'``, ``'q90'``, ..., ``'agreement'``, the
+    fraction of the members with the sign of the ensemble mean, and
+    ``'count'``, the number of valid members).
+    '''
+    acc = _EnsembleAccumulator()
+    for i, member in enumerate(ds[dim].values):
+        acc.add(member, ds.isel({dim: i}, drop=True))
+    return acc.result(quantiles=quantiles)
+
+
+@instrument(kind='analysis', report=True)
+def ensemble_change(hist, future, hist_epoch, future_epoch, pct=False,
+                    quantiles=(0.1, 0.9), how=None, dim='time'):
+    '''ensemble statistics of the change signal between two epochs
+
+    Every gcm is streamed once: its historical and future epoch
+    climatologies are computed one year at a time (as in
+    ``epoch_climatology``), turned into a change signal with
+    ``calc_change`` and added to the ensemble statistics, so neither the
+    per-model epoch means nor the daily data are held on the cluster.
+
+    Parameters
+    ----------
+    hist, future : xarray.Dataset
+        Lazily loaded datasets with a ``gcm`` dimension, as returned by the
+        ``load_*`` functions
+    hist_epoch, future_epoch : slice
+        Time slices of the two epochs (whole years)
+    pct : bool
+        Percent rather than absolute change
+    quantiles : sequence of float
+        Quantiles to return besides the median
+    how : callable, optional
+        Maps a variable name to ``'sum'`` or ``'mean'``
+
+    Returns
+    -------
+    out : xarray.Dataset
+        Statistics of the change (see ``ensemble_statistics``)
+    '''
+    if how is None:
+        how = lambda name: 'sum' if name in SUM_VARS else 'mean'
+
+    models = [m for m in hist['gcm'].values if m in future['gcm'].values]
+    acc = _EnsembleAccumulator()
+    for model in models:
+        h = _member_climatology(hist.sel(gcm=model, drop=True),
+                                {'hist': hist_epoch}, how, dim)['hist']
+        f = _member_climatology(future.sel(gcm=model, drop=True),
+                                {'future': future_epoch}, how, dim)['future']
+        acc.add(model, calc_change(h, f, pct=pct))
+    out = acc.result(quantiles=quantiles)
+    out.attrs.update(hist_epoch='%s to %s' % (hist_epoch.start,
+                                              hist_epoch.stop),
+                     future_epoch='%s to %s' % (future_epoch.start,
+                                                future_epoch.stop))
+    return out
@@ -0,0 +1,202 @@
+'''Compact land-only representation of gridded data
+
+About half of the cells of every LOCA/BCSD/Livneh grid are ocean or outside
+CONUS and are always missing. ``CellIndex`` stores the flat indices of the
+valid cells of a grid; ``pack`` replaces the ``(lat, lon)`` dimensions of a
+dataset by one ``cell`` dimension holding only those cells (with ``lat`` and
+``lon`` as coordinates along ``cell``), so that reductions, resampling and
+extreme-value fits only touch land cells. ``unpack`` scatters the cells back
+onto the full grid, e.g. for plotting.
+
+The indices are computed once per source and grid from the first time step
+of the data and cached on disk.
+'''
+import os
+
+import numpy as np
+import xarray as xr
+
+from .regions import grid_hash
+from .utils import get_cache_dir
+
+CELL_DIM = 'cell'
+
+
+class CellIndex(object):
+    '''Flat indices of the valid cells of a regular lat/lon grid
+
+    Parameters
+    ----------
+    lat, lon : array-like
+        Grid coordinates
+    index : array-like
+        Sorted flat indices (into ``lat.size * lon.size``) of valid cells
+    key : str, optional
+        Name the index is cached under (see ``get_cell_index``)
+    '''
+
+    def __init__(self, lat, lon, index, key=None):
+        self.lat = np.asarray(lat)
+        self.lon = np.asarray(lon)
+        self.index = np.asarray(index, dtype='i8')
+        self.key = key
+
+    def __repr__(self):
+        return '<CellIndex: %d of %dx%d cells>' % (
+            self.index.size, self.lat.size, self.lon.size)
+
+    @classmethod
+    def from_mask(cls, mask, lat, lon, key=None):
+        '''index of the True cells of a (lat, lon) mask'''
+        return cls(lat, lon, np.flatnonzero(np.asarray(mask).ravel()),
+                   key=key)
+
+    @property
+    def mask(self):
+        mask = np.zeros(self.lat.size * self.lon.size, dtype=bool)
+        mask[self.index] = True
+        return mask.reshape(self.lat.size, self.lon.size)
+
+    def save(self, path):
+        tmp = '%s.%d.tmp.npz' % (path[:-4], os.getpid())
+        np.savez_compressed(tmp, lat=self.lat, lon=self.lon, index=self.index)
+        os.replace(tmp, path)
+
+    @classmethod
+    def load(cls, path, key=None):
+        with np.load(path) as f:
+            return cls(f['lat'], f['lon'], f['index'], key=key)
+
+    def _pack_block(self, block):
+        return block.reshape(block.shape[:-2] + (-1, ))[..., self.index]
+
+    def _unpack_block(self, block):
+        out = np.full(block.shape[:-1] + (self.lat.size * self.lon.size, ),
+                      np.nan, dtype=np.result_type(block.dtype, np.float32))
+        out[..., self.index] = block
+        return out.reshape(block.shape[:-1] + (self.lat.size, self.lon.size))
+
+    def pack(self, obj):
+        '''lazily replace (lat, lon) by the valid cells of a DataArray or
+        Dataset'''
+        if isinstance(obj, xr.Dataset):
+            out = xr.Dataset(attrs=obj.attrs)
+            for name, da in obj.data_vars.items():
+                if 'lat' in da.dims and 'lon' in da.dims:
+                    out[name] = self.pack(da)
+                elif 'lat' not in da.dims and 'lon' not in da.dims:
+                    out[name] = da
+            return out
+
+        if obj.chunks is not None:
+            obj = obj.chunk({'lat': -1, 'lon': -1})
+        out = xr.apply_ufunc(self._pack_block, obj,
+                             input_core_dims=[['lat', 'lon']],
+                             output_core_dims=[[CELL_DIM]],
+                             dask='parallelized', output_dtypes=[obj.dtype],
+                             dask_gufunc_kwargs=dict(output_sizes={
+                                 CELL_DIM: self.index.size}),
+                             keep_attrs=True)
+        ilat, ilon = np.unravel_index(self.index,
+                                      (self.lat.size, self.lon.size))
+        out.coords[CELL_DIM] = (CELL_DIM, self.index,
+                                {'cell_index': self.key or ''})
+        out.coords['lat'] = (CELL_DIM, self.lat[ilat])
+        out.coords['lon'] = (CELL_DIM, self.lon[ilon])
+        return out
+
+    def unpack(self, obj):
+        '''lazily scatter the cells of a DataArray or Dataset back onto the
+        (lat, lon) grid, missing cells are NaN'''
+        if isinstance(obj, xr.Dataset):
+            out = xr.Dataset(attrs=obj.attrs)
+            for name, da in obj.data_vars.items():
+                out[name] = self.unpack(da) if CELL_DIM in da.dims else da
+            return out
+
+        obj = obj.drop_vars([c for c in ('lat', 'lon') if c in obj.coords])
+        if obj.chunks is not None:
+            obj = obj.chunk({CELL_DIM: -1})
+        dtype = np.result_type(obj.dtype, np.float32)
+        out = xr.apply_ufunc(self._unpack_block, obj,
+                             input_core_dims=[[CELL_DIM]],
+                             output_core_dims=[['lat', 'lon']],
+                             dask='parallelized', output_dtypes=[dtype],
+                             dask_gufunc_kwargs=dict(output_sizes={
+                                 'lat': self.lat.size,
+                                 'lon': self.lon.size}),
+                             keep_attrs=True)
+        out.coords['lat'] = self.lat
+        out.coords['lon'] = self.lon
+        return out
+
+
+def loader_key(name):
+    '''key of the cell index of a loader, shared by its daily and monthly
+    variants (e.g. ``'loca_hydrology'``)'''
+    return name.replace('load_daily_', '').replace('load_monthly_', '')
+
+
+def _index_path(key, lat, lon):
+    return os.path.join(get_cache_dir('cells'),
+                        '%s-%s.npz' % (key, grid_hash(lat, lon)))
+
+
+def _valid_mask(ds):
+    '''cells with data in the first time step (of the first gcm) of any
+    variable'''
+    mask = None
+    for da in ds.data_vars.values():
+        if 'lat' not in da.dims or 'lon' not in da.dims:
+            continue
+        da = da.isel({d: 0 for d in da.dims if d not in ('lat', 'lon')})
+        valid = da.notnull().transpose('lat', 'lon').values
+        mask = valid if mask is None else mask | valid
+    if mask is None:
+        raise ValueError('dataset has no variables on a (lat, lon) grid')
+    return mask
+
+
+def get_cell_index(ds, key, refresh=False):
+    '''return the cached CellIndex of the grid of ds for source key
+
+    On a cache miss (or with ``refresh=True``) the valid cells are read from
+    the first time step of ds.
+    '''
+    lat, lon = ds['lat'].values, ds['lon'].values
+    path = _index_path(key, lat, lon)
+    if not refresh and os.path.isfile(path):
+        return CellIndex.load(path, key=key)
+    index = CellIndex.from_mask(_valid_mask(ds), lat, lon, key=key)
+    index.save(path)
+    return index
+
+
+def pack(ds, key, refresh=False):
+    '''pack ds to the valid cells of source key (a no-op if already packed)'''
+    if CELL_DIM in ds.dims:
+        return ds
+    return get_cell_index(ds, key, refresh=refresh).pack(ds)
+
+
+def cached_index(obj):
+    '''the cached CellIndex packed obj was packed with'''
+    key = obj[CELL_DIM].attrs.get('cell_index')
+    paths = [os.path.join(get_cache_dir('cells'), f)
+             for f in os.listdir(get_cache_dir('cells'))
+             if key and f.startswith(key + '-') and f.endswith('.npz')]
+    for path in paths:
+        candidate = CellIndex.load(path, key=key)
+        if np.array_equal(candidate.index, obj[CELL_DIM].values):
+            return candidate
+    raise ValueError('no cached cell index matches, pass index')
+
+
+def unpack(obj, index=None):
+    '''unpack obj to (lat, lon)
+
+    The index defaults to the cached index obj was packed with.
+    '''
+    if index is None:
+        index = cached_index(obj)
+    return index.unpack(obj)
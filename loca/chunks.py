@@ -0,0 +1,177 @@
+'''Dask chunk plans for the common workloads
+
+Rather than hard-coding chunks like ``{'lat': 50, 'lon': 50, 'time': 366}``,
+``plan_chunks`` derives them from the operation, the shape of the data and
+the memory of a worker thread. Each operation keeps the dimensions it needs
+whole in every chunk (e.g. the full time series to fit a distribution, or
+the full grid for a sparse regional aggregation) and splits the other
+dimensions until a chunk fits the memory budget, so no full-array rechunk
+is needed afterwards. Loaders, resamplers and stores accept the operation
+name wherever they take ``chunks``.
+'''
+from dask.utils import parse_bytes
+
+# dimensions that each operation needs in a single chunk
+OPERATIONS = {
+    # reductions along time are tree-reduced, so time can be split anywhere
+    # and chunks follow the on-disk layout (full grid per time step)
+    'time_reduction': ('lat', 'lon'),
+    # maps of every time step
+    'spatial_map': ('lat', 'lon'),
+    # distributions are fit to the full time series of each grid cell
+    'extreme_fit': ('time', ),
+    # RegionWeights.aggregate is one sparse product per full grid
+    'regional_aggregation': ('lat', 'lon'),
+}
+
+# order in which the other dimensions are split
+SPLIT_ORDER = ['gcm', 'time', 'lat', 'lon']
+
+# a chunk may use this fraction of the memory of one worker thread (to leave
+# room for temporaries and the outputs)
+MEMORY_FRACTION = 0.25
+
+MIN_CHUNK_BYTES = 2 ** 23
+MAX_CHUNK_BYTES = 2 ** 28
+
+
+def worker_resources(profile='cheyenne'):
+    '''(memory in bytes, threads) of one worker of a cluster profile in
+    ``loca.tools.PROFILES``'''
+    try:
+        from .tools import worker_resources
+    except ImportError:  # distributed is not installed
+        return parse_bytes('4GB'), 1
+    return worker_resources(profile)
+
+
+def chunk_budget(memory=None, threads=None):
+    '''bytes per chunk for workers with memory (bytes) and threads'''
+    if memory is None or threads is None:
+        default_memory, default_threads = worker_resources()
+        memory = memory or default_memory
+        threads = threads or default_threads
+    budget = int(memory * MEMORY_FRACTION / threads)
+    return min(max(budget, MIN_CHUNK_BYTES), MAX_CHUNK_BYTES)
+
+
+def plan_chunks(op, sizes, itemsize=4, memory=None, threads=None,
+                chunk_bytes=None):
+    '''dask chunks for running op on data with dimension sizes
+
+    Parameters
+    ----------
+    op : str
+        One of ``OPERATIONS``
+    sizes : dict
+        Dimension sizes, e.g. ``ds.sizes``
+    itemsize : int
+        Bytes per value (4 for float32)
+    memory, threads : optional
+        Memory (bytes or a string like ``'6GB'``) and threads of a worker,
+        default to those of the ``'cheyenne'`` profile in ``loca.tools``
+    chunk_bytes : int, optional
+        Use this chunk size instead of deriving it from the worker
+
+    Returns
+    -------
+    chunks : dict
+        Chunk size of every dimension in sizes
+    '''
+    if op not in OPERATIONS:
+        raise ValueError('unknown operation %s, choose from %s'
+                         % (op, list(OPERATIONS)))
+    if isinstance(memory, str):
+        memory = parse_bytes(memory)
+    if chunk_bytes is None:
+        chunk_bytes = chunk_budget(memory, threads)
+
+    sizes = dict(sizes)
+    chunks = dict(sizes)
+    keep = OPERATIONS[op]
+    split = [d for d in SPLIT_ORDER if d in sizes and d not in keep]
+    split += [d for d in sizes if d not in split and d not in keep]
+
+    def nbytes():
+        n = itemsize
+        for c in chunks.values():
+            n *= c
+        return n
+
+    for dim in split:
+        if nbytes() <= chunk_bytes:
+            break
+        rest = nbytes() // chunks[dim]
+        chunks[dim] = max(int(chunk_bytes // rest), 1)
+    return chunks
+
+
+def is_operation(chunks):
+    '''True if a chunks argument names an operation'''
+    return isinstance(chunks, str) and chunks in OPERATIONS
+
+
+def itemsize(obj):
+    '''largest itemsize of the data variables of a Dataset or DataArray'''
+    if hasattr(obj, 'data_vars'):
+        return max([v.dtype.itemsize for v in obj.data_vars.values()] or [4])
+    return obj.dtype.itemsize
+
+
+def open_chunks(op, file_sizes, nfiles=1, concat_dim='time', itemsize=4):
+    '''chunks to open each of nfiles files (concatenated along concat_dim)
+    with, so that the combined dataset is chunked for op
+
+    The chunks of the other dimensions are planned for the combined size, so
+    that ``chunk_for`` only has to merge chunks along concat_dim.
+    '''
+    sizes = dict(file_sizes)
+    if concat_dim in sizes:
+        sizes[concat_dim] *= nfiles
+    return plan_chunks(op, sizes, itemsize=itemsize)
+
+
+def chunk_for(obj, op, **kwargs):
+    '''rechunk a Dataset or DataArray for op (see ``plan_chunks``)
+
+    Dimensions that op needs whole are merged into one chunk. Other
+    dimensions keep their chunks unless some are larger than planned, so
+    data opened with ``open_chunks`` is not split again.
+    '''
+    plan = plan_chunks(op, obj.sizes, itemsize=itemsize(obj), **kwargs)
+    if not obj.chunks:
+        return obj.chunk(plan)
+
+    current = obj.chunksizes
+    keep = OPERATIONS[op]
+    chunks = {}
+    for dim, size in plan.items():
+        sizes = current.get(dim, ())
+        if dim in keep:
+            if len(sizes) > 1:
+                chunks[dim] = -1
+        elif not sizes or max(sizes) > size:
+            chunks[dim] = size
+    return obj.chunk(chunks) if chunks else obj
+
+
+def max_chunk_bytes(obj):
+    '''bytes of the largest chunk of a Dataset, DataArray or dask array'''
+    variables = obj.data_vars.values() if hasattr(obj, 'data_vars') else [obj]
+    nbytes = 0
+    for var in variables:
+        chunks = getattr(var, 'chunks', None) or [(s, ) for s in var.shape]
+        n = var.dtype.itemsize
+        for c in chunks:
+            n *= max(c)
+        nbytes = max(nbytes, n)
+    return nbytes
+
+
+def resolve_chunks(obj, chunks):
+    '''apply a chunks argument that may also be an operation name'''
+    if chunks is None:
+        return obj
+    if is_operation(chunks):
+        return chunk_for(obj, chunks)
+    return obj.chunk(chunks)
@@ -1,10 +1,26 @@
 
-import os
+import inspect
+import time as timer
 import warnings
-import glob
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache, partial, wraps
 
+import pandas as pd
 import xarray as xr
 
+from . import cells as _cells
+from .aggregates import DEFAULT_FREQS, AggregateStore, store_name
+from .chunks import is_operation, itemsize, open_chunks, resolve_chunks
+from .file_index import get_file_index
+from .instrument import add_files, instrument, run_in_context
+from .memo import memoize
+from .precision import cast, get_dtype, precision
+from .remap import LAT_NAMES, LON_NAMES, remap_dataset
+from .resample import resample_dataset
+from .schemas import KELVIN, SCHEMAS, SEC_PER_DAY  # noqa: F401
+from .virtual import open_virtual_dataset
+from .zarr_store import LAYOUTS, REGION_BYTES, ZarrStore
+
 # TODO: make this more configurable
 # LOCA
 LOC_MET_ROOT_DIR = '/glade/p/ral/hap/common_data/LOCA/met'
@@ -29,8 +45,44 @@ DEFAULT_MON_HYDRO_VARS = ['ET', 'total_runoff']
 DEFAULT_DAY_HYDRO_VARS = ['total_runoff']
 DEFAULT_RESOLUTION = '8th'
 
-KELVIN = 273.13
-SEC_PER_DAY = 86400
+# Zarr copies (see export_zarr), None puts them in the loca cache directory
+ZARR_ROOT_DIR = None
+
+# resolutions that can be served from the 1/16th degree data when no files
+# exist on disk, mapped to the grid file to remap to (None merges 2x2 cells)
+REMAP_GRIDFILES = {'8th': None}
+
+# variables that are summed (rather than averaged) when resampling
+SUM_VARS = ['ET', 'runoff', 'total_runoff', 'baseflow', 'pcp']
+
+# loader outputs that can be exported to Zarr: the loader, and the root
+# directory (the name of the constant above) and layout of its FileIndex
+ZARR_SOURCES = {
+    'daily_loca_hydrology': ('load_daily_loca_hydrology',
+                             'LOCA_VIC_ROOT_DIR', 'loca_vic'),
+    'daily_loca_meteorology': ('load_daily_loca_meteorology',
+                               'LOC_MET_ROOT_DIR', 'loca_met'),
+    'daily_bcsd_hydrology': ('load_daily_bcsd_hydrology',
+                             'BCSD_VIC_ROOT_DIR', 'bcsd'),
+    'daily_bcsd_meteorology': ('load_daily_bcsd_meteorology',
+                               'BCSD_MET_ROOT_DIR', 'bcsd'),
+    'monthly_bcsd_hydrology': ('load_monthly_bcsd_hydrology',
+                               'BCSD_VIC_MON_ROOT_DIR', 'bcsd'),
+    'monthly_bcsd_meteorology': ('load_monthly_bcsd_meteorology',
+                                 'BCSD_MET_MON_ROOT_DIR', 'bcsd'),
+    'monthly_maurer_hydrology': ('load_monthly_maurer_hydrology',
+                                 'MAURER_VIC_ROOT_DIR', 'maurer_vic'),
+    'daily_maurer_meteorology': ('load_daily_maurer_meteorology',
+                                 'MAURER_MET_ROOT_DIR', 'maurer_met'),
+    'daily_livneh_hydrology': ('load_daily_livneh_hydrology',
+                               'LIVNEH_VIC_ROOT_DIR', 'livneh_vic'),
+    'daily_livneh_meteorology': ('load_daily_livneh_meteorology',
+                                 'LIVNEH_MET_ROOT_DIR', 'livneh_met'),
+}
+
+# number of sources (and of models within a source) opened concurrently;
+# opening files is dominated by metadata latency on GLADE
+MAX_OPEN_WORKERS = 8
 
 
 def progress(r):
@@ -41,160 +93,452 @@ def progress(r):
         return r
 
 
-def _calc_total_runoff(ds):
-    if 'total_runoff' in ds:
-        return ds['total_runoff']
-    return ds['runoff'] + ds['baseflow']
+def _load_sources(loaders):
+    '''call every loader in ``{name: loader}`` concurrently
 
+    Returns ``{name: dataset}`` and prints the time each source took.
+    '''
+    def timed(name, loader):
+        start = timer.perf_counter()
+        ds = loader()
+        print('loaded %s in %.1f s' % (name, timer.perf_counter() - start),
+              flush=True)
+        return ds
 
-# TODO --- make sure this is the common definition of t_mean
-def _calc_t_mean(ds):
-    if 't_mean' in ds:
-        return ds['t_mean']
-    return (ds['t_min'] + ds['t_max']) / 2.
+    with ThreadPoolExecutor(max_workers=MAX_OPEN_WORKERS) as pool:
+        futures = {name: run_in_context(pool, timed, name, loader)
+                   for name, loader in loaders.items()}
+        return {name: f.result() for name, f in futures.items()}
 
 
-def resample_daily_data(ds, freq='MS', chunks=None):
-    out = xr.Dataset()
+def _open_models(models, open_model):
+    '''open every model concurrently and concatenate them along ``gcm``
+
+    ``open_model(m)`` returns the dataset of model ``m`` or None to skip it.
+    Models that fail to open (OSError) are skipped too.
+    '''
+    def try_open(m):
+        try:
+            return open_model(m)
+        except OSError:
+            print('skipping %s' % m)
 
-    for name, da in ds.data_vars.items():
-        if name in ['ET', 'runoff', 'total_runoff', 'baseflow', 'pcp']:
-            out[name] = da.resample(time=freq).sum('time')
-        else:
-            out[name] = da.resample(time=freq).mean('time')
+    with ThreadPoolExecutor(max_workers=MAX_OPEN_WORKERS) as pool:
+        futures = [run_in_context(pool, try_open, m) for m in models]
+        results = [f.result() for f in progress(futures)]
+
+    opened = [(m, ds) for m, ds in zip(models, results) if ds is not None]
+    _check_same_grid(opened)
+    return xr.concat([ds for _, ds in opened],
+                     dim=xr.Variable('gcm', [m for m, _ in opened]))
+
+
+def _check_same_grid(opened):
+    '''raise if the models are not on one lat/lon grid
+
+    ``xr.concat`` would otherwise outer join them into a NaN padded union.
+    '''
+    if not opened:
+        return
+    m0, ds0 = opened[0]
+    for m, ds in opened[1:]:
+        for name in LAT_NAMES + LON_NAMES:
+            if name in ds0.indexes and not ds0.indexes[name].equals(
+                    ds.indexes.get(name, ds0.indexes[name][:0])):
+                raise ValueError('%s and %s are not on the same %s grid'
+                                 % (m0, m, name))
 
-    if chunks is not None:
-        out = out.persist().chunk(chunks)
-    return out
 
+def _resample_how(name):
+    return 'sum' if name in SUM_VARS else 'mean'
 
+
+@memoize()
+def resample_daily_data(ds, freq='MS', chunks=None):
+    out = resample_dataset(ds, freqs=[freq], how=_resample_how)[freq]
+    return resolve_chunks(out, chunks)
+
+
+@memoize()
 def resample_monthly_data(ds, freq='MS', chunks=None):
-    out = xr.Dataset()
-    for name, da in ds.data_vars.items():
-        if name in ['ET', 'runoff', 'total_runoff', 'baseflow', 'pcp']:
-            out[name] = da.resample(time=freq).sum('time')
-        else:
-            # TODO: weight by days in month, or sum over year
-            out[name] = da.resample(time=freq).mean('time')
-
-    if chunks is not None:
-        out = out.persist().chunk(chunks)
-    return out
+    # TODO: weight means by days in month, or sum over year
+    out = resample_dataset(ds, freqs=[freq], how=_resample_how)[freq]
+    return resolve_chunks(out, chunks)
+
+
+def _year_range(time):
+    '''inclusive (start, end) years covered by a time slice'''
+    if time is None:
+        return None
+
+    def year(t, default):
+        if t is None:
+            return default
+        return getattr(t, 'year', None) or pd.Timestamp(t).year
+
+    return year(time.start, 0), year(time.stop, 9999)
+
+
+def _whole_years(time):
+    '''widen a time slice to whole years (so that resampled months and years
+    are complete)'''
+    if time is None:
+        return None
+    start, stop = _year_range(time)
+    return slice(str(start) if time.start is not None else None,
+                 str(stop) if time.stop is not None else None)
+
+
+def _select(ds, variables=None, time=None):
+    '''subset a dataset to variables and a time slice'''
+    if variables is not None:
+        ds = ds[list(variables)]
+    if time is not None:
+        ds = ds.sel(time=time)
+    return ds
+
+
+def _load_monthly_from_store(name, sources, load_daily, materialize=False,
+                             variables=None, time=None, cells=False,
+                             **kwargs):
+    '''load monthly data from the aggregate store if it is current
+
+    Otherwise load the daily data (only the requested variables and years)
+    and resample it. With ``materialize=True`` the monthly and annual
+    aggregates of all variables and years are written to the store before
+    returning. With ``cells=True`` the daily data is packed (see
+    ``_loader_options``) before it is resampled.
+    '''
+    # a store written in another dtype (e.g. float32 read as float64) would
+    # silently lose precision, so it counts as stale
+    store = AggregateStore(name, sources, dtype=get_dtype())
+    chunks = kwargs.get('chunks')
+    if store.is_current('MS'):
+        return _select(_open_store(store, chunks, 'MS'), variables, time)
+
+    print('aggregate store %s is stale or missing, resampling daily data'
+          % name, flush=True)
+    if not materialize:
+        ds = load_daily(variables=variables, time=_whole_years(time),
+                        cells=cells, **kwargs)
+        # the aggregate store, not the memo cache, persists monthly data
+        ds = resample_daily_data(ds, chunks=chunks if is_operation(chunks)
+                                 else None, memo=False)
+        return _select(ds, time=time)
+
+    ds = load_daily(**kwargs)
+    rules = {k: _resample_how(k) for k in ds.data_vars}
+    store.write(resample_dataset(ds, freqs=DEFAULT_FREQS, how=rules),
+                rules=rules)
+    return _select(_open_store(store, chunks, 'MS'), variables, time)
+
+
+def _open_store(store, chunks, *args):
+    '''open an aggregate or Zarr store, chunks may name an operation'''
+    if is_operation(chunks):
+        return resolve_chunks(store.open(*args), chunks)
+    return store.open(*args, chunks=chunks)
+
+
+def _memo_loader(root, layout):
+    '''memoize a loader (on request, ``memo=True``) keyed by the files of
+    its source, ``root`` names the root directory constant above'''
+    def manifest(arguments):
+        return get_file_index(globals()[root], layout).records()
+    return memoize(manifest=manifest, default=False)
+
+
+def _loader_options(func):
+    '''add the ``dtype`` and ``cells`` options to a loader
+
+    ``dtype`` is the floating point dtype the data is loaded and derived in,
+    defaulting to the precision policy (see ``loca.precision``). With
+    ``cells=True`` the (lat, lon) dimensions of the loaded dataset are
+    packed to a ``cell`` dimension of the valid (land) cells, see
+    ``loca.cells``. The daily and monthly loaders of a source share one
+    cached index. Loaders that take a ``cells`` argument themselves are
+    passed it too.
+    '''
+    key = _cells.loader_key(func.__name__)
+    forward = 'cells' in inspect.signature(func).parameters
+
+    @wraps(func)
+    def wrapper(*args, cells=False, dtype=None, **kwargs):
+        if forward:
+            kwargs['cells'] = cells
+        with precision(dtype):
+            ds = cast(func(*args, **kwargs))
+            return _cells.pack(ds, key) if cells else ds
+    return wrapper
 
 
 # Wrappers
+# ``variables`` and ``time`` (a slice) are passed down to the individual
+# loaders, which only open the files holding those variables and years. The
+# sources are opened concurrently.
+@instrument(kind='load')
 def load_monthly_historical_hydro_datasets(models=None,
                                            variables=DEFAULT_MON_HYDRO_VARS,
                                            resolution=DEFAULT_RESOLUTION,
+                                           materialize=False, time=None,
                                            **kwargs):
     print('load_monthly_historical_hydro_datasets', flush=True)
-
-    data = load_monthly_cmip_hydro_datasets('historical', models=models,
-                                            resolution=resolution,
-                                            **kwargs)
-
-    data['livneh'] = load_monthly_livneh_hydrology(resolution=resolution,
-                                                   **kwargs)
-    data['maurer'] = load_monthly_maurer_hydrology(resolution=resolution,
-                                                   **kwargs)
-
-    # TODO: it would be better if we passed this info to the individual loaders
-    out = {}
-    for k, ds in data.items():
-        out[k] = ds[variables]
+    kwargs.update(resolution=resolution, variables=variables, time=time)
+
+    data = _load_sources({
+        'cmip': partial(load_monthly_cmip_hydro_datasets, 'historical',
+                        models=models, materialize=materialize, **kwargs),
+        'livneh': partial(load_monthly_livneh_hydrology,
+                          materialize=materialize, **kwargs),
+        'maurer': partial(load_monthly_maurer_hydrology, **kwargs)})
+    out = data.pop('cmip')
+    out.update(data)
     return out
 
 
+@instrument(kind='load')
 def load_daily_historical_hydro_datasets(models=None,
                                          variables=DEFAULT_DAY_HYDRO_VARS,
                                          resolution=DEFAULT_RESOLUTION,
-                                         **kwargs):
+                                         time=None, **kwargs):
     print('load_daily_historical_hydro_datasets', flush=True)
-
-    data = load_daily_cmip_hydro_datasets('historical', models=models,
-                                          resolution=resolution,
-                                          **kwargs)
-    data['livneh'] = load_daily_livneh_hydrology(resolution=resolution,
-                                                 **kwargs)
-    data['maurer'] = load_daily_maurer_hydrology(resolution=resolution,
-                                                 **kwargs)
-
-    # TODO: it would be better if we passed this info to the individual loaders
-    for k, ds in data.items():
-        data[k] = ds[variables]
-    return data
+    kwargs.update(resolution=resolution, variables=variables, time=time)
+
+    data = _load_sources({
+        'cmip': partial(load_daily_cmip_hydro_datasets, 'historical',
+                        models=models, **kwargs),
+        'livneh': partial(load_daily_livneh_hydrology, **kwargs),
+        'maurer': partial(load_daily_maurer_hydrology, **kwargs)})
+    out = data.pop('cmip')
+    out.update(data)
+    return out
 
 
+@instrument(kind='load')
 def load_monthly_historical_met_datasets(resolution=DEFAULT_RESOLUTION,
-                                         models=None, **kwargs):
+                                         models=None, materialize=False,
+                                         variables=None, time=None,
+                                         **kwargs):
     print('load_monthly_historical_met_datasets', flush=True)
-    data = load_monthly_cmip_met_datasets('historical', models=models,
-                                          resolution=resolution,
-                                          **kwargs)
-
-    data['livneh'] = load_monthly_livneh_meteorology(resolution=resolution,
-                                                     **kwargs)
-    data['maurer'] = load_monthly_maurer_meteorology(resolution=resolution,
-                                                     **kwargs)
-
-    return data
+    kwargs.update(resolution=resolution, materialize=materialize,
+                  variables=variables, time=time)
+
+    data = _load_sources({
+        'cmip': partial(load_monthly_cmip_met_datasets, 'historical',
+                        models=models, **kwargs),
+        'livneh': partial(load_monthly_livneh_meteorology, **kwargs),
+        'maurer': partial(load_monthly_maurer_meteorology, **kwargs)})
+    out = data.pop('cmip')
+    out.update(data)
+    return out
 
 
+@instrument(kind='load')
 def load_monthly_cmip_met_datasets(scen, models=None,
-                                   resolution=DEFAULT_RESOLUTION, **kwargs):
+                                   resolution=DEFAULT_RESOLUTION,
+                                   materialize=False, variables=None,
+                                   time=None, **kwargs):
     print('load_monthly_cmip_met_datasets', flush=True)
-    data = {}
-    data['loca'] = load_monthly_loca_meteorology(scen=scen, models=models,
-                                                 resolution=resolution,
-                                                 **kwargs)
-    data['bcsd'] = load_monthly_bcsd_meteorology(scen=scen, models=models,
-                                                 resolution=resolution,
-                                                 **kwargs)
-    return data
+    kwargs.update(scen=scen, models=models, resolution=resolution,
+                  variables=variables, time=time)
+    return _load_sources({
+        'loca': partial(load_monthly_loca_meteorology,
+                        materialize=materialize, **kwargs),
+        'bcsd': partial(load_monthly_bcsd_meteorology, **kwargs)})
 
 
+@instrument(kind='load')
 def load_monthly_cmip_hydro_datasets(scen, models=None,
                                      variables=DEFAULT_MON_HYDRO_VARS,
-                                     resolution=DEFAULT_RESOLUTION, **kwargs):
+                                     resolution=DEFAULT_RESOLUTION,
+                                     materialize=False, time=None, **kwargs):
     print('load_monthly_cmip_hydro_datasets', flush=True)
-    data = {}
-    data['loca'] = load_monthly_loca_hydrology(scen=scen, models=models,
-                                               resolution=resolution,
-                                               **kwargs)
-    data['bcsd'] = load_monthly_bcsd_hydrology(scen=scen, models=models,
-                                               resolution=resolution,
-                                               **kwargs)
-
-    # TODO: it would be better if we passed this info to the individual loaders
-    for k, ds in data.items():
-        data[k] = ds[variables]
-    return data
+    kwargs.update(scen=scen, models=models, resolution=resolution,
+                  variables=variables, time=time)
+    return _load_sources({
+        'loca': partial(load_monthly_loca_hydrology,
+                        materialize=materialize, **kwargs),
+        'bcsd': partial(load_monthly_bcsd_hydrology, **kwargs)})
 
 
+@instrument(kind='load')
 def load_daily_cmip_met_datasets(scen, models=None,
-                                 resolution=DEFAULT_RESOLUTION, **kwargs):
+                                 resolution=DEFAULT_RESOLUTION,
+                                 variables=None, time=None, **kwargs):
     print('load_daily_cmip_met_datasets', flush=True)
-    data = {}
-    data['loca'] = load_daily_loca_meteorology(scen=scen, models=models,
-                                               resolution=resolution,
-                                               **kwargs)
-    data['bcsd'] = load_daily_bcsd_meteorology(scen=scen, models=models,
-                                               resolution=resolution,
-                                               **kwargs)
-    return data
+    kwargs.update(scen=scen, models=models, resolution=resolution,
+                  variables=variables, time=time)
+    return _load_sources({
+        'loca': partial(load_daily_loca_meteorology, **kwargs),
+        'bcsd': partial(load_daily_bcsd_meteorology, **kwargs)})
 
 
+@instrument(kind='load')
 def load_daily_cmip_hydro_datasets(scen, models=None,
-                                   resolution=DEFAULT_RESOLUTION, **kwargs):
+                                   resolution=DEFAULT_RESOLUTION,
+                                   variables=None, time=None, **kwargs):
     print('load_daily_cmip_hydro_datasets', flush=True)
-    data = {}
-    data['loca'] = load_daily_loca_hydrology(scen=scen, models=models,
-                                             resolution=resolution,
-                                             **kwargs)
-    data['bcsd'] = load_daily_bcsd_hydrology(scen=scen, models=models,
-                                             resolution=resolution,
-                                             **kwargs)
-    return data
+    kwargs.update(scen=scen, models=models, resolution=resolution,
+                  variables=variables, time=time)
+    return _load_sources({
+        'loca': partial(load_daily_loca_hydrology, **kwargs),
+        'bcsd': partial(load_daily_bcsd_hydrology, **kwargs)})
+
+
+def _open_mfdataset(files, cache_metadata=False, **kwargs):
+    '''open a list of files (paths or records from a FileIndex)
+
+    With ``cache_metadata=True`` the dataset is built from the cached file
+    schemas in ``loca.virtual`` rather than by reading every file header.
+    This only supports the ``preprocess`` and ``chunks`` arguments, other
+    keyword arguments fall back to ``xr.open_mfdataset``.
+
+    ``chunks`` may name an operation in ``loca.chunks.OPERATIONS``, the files
+    are then opened with chunks planned for that operation.
+    '''
+    if not files:
+        raise OSError('no files to open')
+    add_files(files)
+    op = kwargs.get('chunks')
+    if is_operation(op):
+        kwargs['chunks'] = _open_chunks_for(files, op,
+                                            kwargs.get('preprocess'))
+    if cache_metadata and set(kwargs) <= {'preprocess', 'chunks'}:
+        ds = open_virtual_dataset(files, **kwargs)
+    else:
+        paths = [f['path'] if isinstance(f, dict) else f for f in files]
+        ds = xr.open_mfdataset(paths, **kwargs)
+    return resolve_chunks(ds, op) if is_operation(op) else ds
+
+
+def _open_chunks_for(files, op, preprocess=None):
+    '''per-file chunks for op, planned from the first file's header'''
+    path = files[0]['path'] if isinstance(files[0], dict) else files[0]
+    with xr.open_dataset(path) as ds:
+        if preprocess is not None:
+            ds = preprocess(ds)
+        return open_chunks(op, ds.sizes, nfiles=len(files),
+                           itemsize=itemsize(ds))
+
+
+def _records_or_remap(index, resolution, schema=None, variables=None,
+                      time=None, **filters):
+    '''records at resolution, falling back to the 1/16th degree records
+
+    Files are pruned to the years of ``time`` and, given a schema, to the
+    files holding ``variables`` (or the inputs they are derived from).
+    Returns ``(records, remap)``; ``remap`` is True if the records have to be
+    remapped to resolution with ``_remap_to``.
+    '''
+    if variables is not None and schema is not None:
+        filters['variable'] = schema.source_variables(variables)
+    if time is not None:
+        filters['years'] = _year_range(time)
+
+    records = index.records(resolution=resolution, **filters)
+    if records or resolution not in REMAP_GRIDFILES:
+        return records, False
+    return index.records(resolution='16th', **filters), True
+
+
+@lru_cache(maxsize=16)
+def _native_grid(path, schema=None):
+    '''lat/lon cell centers of one file after its schema fixes, by path'''
+    with xr.open_dataset(path) as ds:
+        if schema is not None:
+            ds = schema(ds)
+        return ds['lat'].values, ds['lon'].values
+
+
+def _remap_to(ds, resolution, index=None, schema=None):
+    '''lazily remap 1/16th degree data to resolution
+
+    Without a grid file for resolution, the data are remapped onto the grid
+    of the files that do exist at resolution in ``index`` so that remapped
+    models line up with the others. Only if there are none are 2x2 cells
+    merged.
+    '''
+    gridfile = REMAP_GRIDFILES[resolution]
+    if gridfile is None and index is not None:
+        records = index.records(resolution=resolution)
+        if records:
+            grid = _native_grid(records[0]['path'], schema)
+            return remap_dataset(ds, grid=grid)
+    return remap_dataset(ds, gridfile=gridfile)
+
+
+def _zarr_store(name, scen=None, resolution=DEFAULT_RESOLUTION, layout=None):
+    '''ZarrStore of a loader output (``layout=None`` picks an existing one)'''
+    _, root, index_layout = ZARR_SOURCES[name]
+    index = get_file_index(globals()[root], index_layout)
+    if index_layout == 'bcsd':
+        sources = index.records(scenario='rcp85' if 'hist' in scen else scen,
+                                years=get_valid_year_range(scen))
+    elif index_layout.startswith('maurer'):
+        sources = index.records()
+    elif index_layout.startswith('loca'):
+        sources = _records_or_remap(index, resolution, scenario=scen)[0]
+    else:
+        sources = _records_or_remap(index, resolution)[0]
+
+    args = [scen, resolution] if scen is not None else [resolution]
+    stores = [ZarrStore(store_name(name, *args), sources, layout=lay,
+                        root=ZARR_ROOT_DIR)
+              for lay in ([layout] if layout else LAYOUTS)]
+    return next((s for s in stores if s.exists()), stores[0])
+
+
+def _open_zarr(name, scen=None, models=None, resolution=DEFAULT_RESOLUTION,
+               variables=None, time=None, layout=None, chunks=None,
+               **kwargs):
+    '''open the Zarr copy of a loader output written by export_zarr
+
+    Other keyword arguments (meant for ``open_mfdataset``) are ignored.
+    '''
+    store = _zarr_store(name, scen, resolution, layout)
+    if not store.exists():
+        raise OSError('%s does not exist, create it with export_zarr' % store)
+    if not store.is_current():
+        warnings.warn('%s is older than its source files' % store)
+    ds = _open_store(store, chunks)
+    if models is not None and 'gcm' in ds.dims:
+        ds = ds.sel(gcm=list(models))
+    return _select(ds, variables, time)
+
+
+@instrument(kind='load')
+def export_zarr(name, scen='historical', resolution=DEFAULT_RESOLUTION,
+                layout='time', region_bytes=REGION_BYTES, **kwargs):
+    '''write (or finish writing) the Zarr copy of a loader output
+
+    Parameters
+    ----------
+    name : str
+        Key of ``ZARR_SOURCES``, e.g. ``'daily_loca_hydrology'``
+    scen : str
+        Scenario (LOCA and BCSD only)
+    layout : str
+        ``'time'`` (time series of grid cell tiles) or ``'space'`` (maps)
+    region_bytes : int
+        Approximate memory used by each region written
+    kwargs :
+        Passed on to the loader
+
+    Once written, the loader reads it with ``backend='zarr'``.
+    '''
+    loader, _, index_layout = ZARR_SOURCES[name]
+    if not index_layout.startswith(('loca', 'bcsd')):
+        scen = None
+    store = _zarr_store(name, scen, resolution, layout)
+    if store.is_current():
+        return store
+
+    if scen is not None:
+        kwargs['scen'] = scen
+    ds = globals()[loader](resolution=resolution, **kwargs)
+    print('writing %s' % store, flush=True)
+    store.write(ds, region_bytes=region_bytes)
+    return store
 
 
 def drop_bound_varialbes(ds):
@@ -206,126 +550,131 @@ def drop_bound_varialbes(ds):
 
 
 # Individual datasets
+@instrument(kind='load')
+@_memo_loader('LOCA_VIC_ROOT_DIR', 'loca_vic')
+@_loader_options
 def load_daily_loca_hydrology(scen='historical', models=None,
-                              resolution=DEFAULT_RESOLUTION, **kwargs):
+                              resolution=DEFAULT_RESOLUTION,
+                              cache_metadata=True, variables=None, time=None,
+                              backend='netcdf', **kwargs):
     print('load_daily_loca_hydrology', flush=True)
-
-    def preproc(ds):
-        d = {}
-        for k, v in (('Time', 'time'), ('latitude', 'lat'),
-                     ('longitude', 'lon')):
-            if k in ds or k in ds.coords:
-                d[k] = v
-
-        ds = drop_bound_varialbes(ds)
-
-        return ds.rename(d)
+    if backend == 'zarr':
+        return _open_zarr('daily_loca_hydrology', scen=scen, models=models,
+                          resolution=resolution, variables=variables,
+                          time=time, **kwargs)
+    schema = SCHEMAS['loca_vic']
+    index = get_file_index(LOCA_VIC_ROOT_DIR, 'loca_vic')
 
     if models is None:
-        models = os.listdir(LOCA_VIC_ROOT_DIR)
-        for s in ['Livneh_L14_CONUS', 'Livneh_L14']:
-            if s in models:
-                models.remove(s)
-        models.sort()
-
-    ds_list = []
-    models_list = []
-    for m in progress(models):
-        if resolution == '16th':
-            resolution = ''
-        fpath = os.path.join(LOCA_VIC_ROOT_DIR, m,
-                             f'vic_output.{scen}.netcdf', resolution, '*nc')
-        try:
-            ds_list.append(xr.open_mfdataset(
-                fpath, preprocess=preproc, **kwargs))
-            models_list.append(m)
-        except OSError:
-            print('skipping %s' % m)
-
-    ds = xr.concat(ds_list, dim=xr.Variable('gcm', models_list))
+        # the Livneh_L14 directories don't match the vic_output layout
+        models = index.unique('model')
 
-    ds['total_runoff'] = _calc_total_runoff(ds)
+    def open_model(m):
+        files, remap = _records_or_remap(index, resolution, schema=schema,
+                                         variables=variables, time=time,
+                                         model=m, scenario=scen)
+        ds = _open_mfdataset(files, preprocess=schema,
+                             cache_metadata=cache_metadata, **kwargs)
+        ds = _select(schema.apply(ds, variables=variables), time=time)
+        return _remap_to(ds, resolution, index, schema) if remap else ds
 
-    return ds
+    return _open_models(models, open_model)
 
 
+@instrument(kind='load')
+@_memo_loader('LOCA_VIC_ROOT_DIR', 'loca_vic')
+@_loader_options
 def load_monthly_loca_hydrology(scen='historical', models=None,
-                                resolution=DEFAULT_RESOLUTION, **kwargs):
+                                resolution=DEFAULT_RESOLUTION,
+                                materialize=False, variables=None, time=None,
+                                cells=False, **kwargs):
     print('load_monthly_loca_hydrology', flush=True)
-    # for now, just load daily and resample imediately
-    ds = load_daily_loca_hydrology(scen=scen, models=models,
-                                   resolution=resolution, **kwargs)
-    ds = resample_daily_data(ds)
-    return ds
-
-
-def load_monthly_maurer_hydrology(resolution=DEFAULT_RESOLUTION, **kwargs):
+    sources, _ = _records_or_remap(
+        get_file_index(LOCA_VIC_ROOT_DIR, 'loca_vic'), resolution,
+        model=models, scenario=scen)
+    return _load_monthly_from_store(
+        store_name('loca_hydrology', scen, resolution, models), sources,
+        load_daily_loca_hydrology, materialize=materialize,
+        variables=variables, time=time, cells=cells, scen=scen,
+        models=models, resolution=resolution, **kwargs)
+
+
+@instrument(kind='load')
+@_memo_loader('MAURER_VIC_ROOT_DIR', 'maurer_vic')
+@_loader_options
+def load_monthly_maurer_hydrology(resolution=DEFAULT_RESOLUTION,
+                                  variables=None, time=None,
+                                  backend='netcdf', **kwargs):
     print('load_monthly_maurer_hydrology', flush=True)
+    if backend == 'zarr':
+        return _open_zarr('monthly_maurer_hydrology', resolution=resolution,
+                          variables=variables, time=time, **kwargs)
     if resolution != '8th':
         raise NotImplementedError('Maurer Hydrology has not been remapped to '
                                   'any other resolution')
-    fpath = os.path.join(MAURER_VIC_ROOT_DIR, '*nc')
-    ds = xr.open_mfdataset(fpath, preprocess=drop_bound_varialbes, **kwargs)
+    schema = SCHEMAS['maurer_vic']
+    files, _ = _records_or_remap(
+        get_file_index(MAURER_VIC_ROOT_DIR, 'maurer_vic'), None,
+        schema=schema, variables=variables, time=time)
+    ds = _open_mfdataset(files, preprocess=schema, **kwargs)
 
-    return ds.rename({'longitude': 'lon', 'latitude': 'lat',
-                      'et': 'ET', 'swe': 'SWE', 'surface_runoff': 'runoff'})
+    return _select(schema.apply(ds, variables=variables), time=time)
 
 
+@instrument(kind='load')
+@_memo_loader('MAURER_VIC_ROOT_DIR', 'maurer_vic')
+@_loader_options
 def load_daily_maurer_hydrology(**kwargs):
     print('load_daily_maurer_hydrology', flush=True)
     raise NotImplementedError('netcdf files do not exist, ask @Naoki')
 
 
+@instrument(kind='load')
+@_memo_loader('LOC_MET_ROOT_DIR', 'loca_met')
+@_loader_options
 def load_daily_loca_meteorology(scen='historical', models=None,
-                                resolution=DEFAULT_RESOLUTION, **kwargs):
+                                resolution=DEFAULT_RESOLUTION,
+                                cache_metadata=True, variables=None,
+                                time=None, backend='netcdf', **kwargs):
     print('load_daily_loca_meteorology', flush=True)
-
-    var = '*'
-    ens = '*'
-
-    def preproc(ds):
-        if 'longitude' in ds.coords:
-            ds = ds.rename({'longitude': 'lon', 'latitude': 'lat'})
-        return drop_bound_varialbes(ds)
+    if backend == 'zarr':
+        return _open_zarr('daily_loca_meteorology', scen=scen, models=models,
+                          resolution=resolution, variables=variables,
+                          time=time, **kwargs)
+    schema = SCHEMAS['loca_met']
+    index = get_file_index(LOC_MET_ROOT_DIR, 'loca_met')
 
     if models is None:
-        models = os.listdir(LOC_MET_ROOT_DIR)
-        models.sort()
-
-    ds_list = []
-    models_list = []
-    for m in progress(models):
-        fpath = os.path.join(LOC_MET_ROOT_DIR, m, resolution, scen,
-                             ens, var, '*nc')
-        try:
-            ds_list.append(
-                xr.open_mfdataset(fpath, preprocess=preproc, **kwargs))
-            models_list.append(m)
-        except OSError:
-            print('skipping %s' % m)
+        models = index.unique('model')
 
-    ds = xr.concat(ds_list, dim=xr.Variable('gcm', models_list))
+    def open_model(m):
+        files, remap = _records_or_remap(index, resolution, schema=schema,
+                                         variables=variables, time=time,
+                                         model=m, scenario=scen)
+        ds = _open_mfdataset(files, preprocess=schema,
+                             cache_metadata=cache_metadata, **kwargs)
+        ds = _select(schema.apply(ds, variables=variables), time=time)
+        return _remap_to(ds, resolution, index, schema) if remap else ds
 
-    if 'longitude' in ds.coords:
-        ds = ds.rename({'longitude': 'lon', 'latitude': 'lat', 'pr': 'pcp',
-                        'tasmin': 't_min', 'tasmax': 't_max'})
-    else:
-        ds = ds.rename({'pr': 'pcp', 'tasmin': 't_min', 'tasmax': 't_max'})
-
-    ds['t_mean'] = (ds['t_min'] + ds['t_max']) / 2. - KELVIN  # K --> C
-    ds['pcp'] = ds['pcp'] * SEC_PER_DAY  # kg m-2 s-1 --> mm/d
-
-    return ds
+    return _open_models(models, open_model)
 
 
+@instrument(kind='load')
+@_memo_loader('LOC_MET_ROOT_DIR', 'loca_met')
+@_loader_options
 def load_monthly_loca_meteorology(scen='historical', models=None,
-                                  resolution=DEFAULT_RESOLUTION, **kwargs):
+                                  resolution=DEFAULT_RESOLUTION,
+                                  materialize=False, variables=None,
+                                  time=None, cells=False, **kwargs):
     print('load_monthly_loca_meteorology', flush=True)
-    # for now, just load daily and resample imediately
-    ds = load_daily_loca_meteorology(scen=scen, models=models,
-                                     resolution=resolution, **kwargs)
-    ds = resample_daily_data(ds)
-    return ds
+    sources, _ = _records_or_remap(
+        get_file_index(LOC_MET_ROOT_DIR, 'loca_met'), resolution,
+        model=models, scenario=scen)
+    return _load_monthly_from_store(
+        store_name('loca_meteorology', scen, resolution, models), sources,
+        load_daily_loca_meteorology, materialize=materialize,
+        variables=variables, time=time, cells=cells, scen=scen,
+        models=models, resolution=resolution, **kwargs)
 
 
 def get_valid_years(scen):
@@ -337,6 +686,12 @@ def get_valid_years(scen):
     return list(map(str, list(r)))
 
 
+def get_valid_year_range(scen):
+    '''inclusive (start, end) version of get_valid_years'''
+    years = get_valid_years(scen)
+    return int(years[0]), int(years[-1])
+
+
 def filter_files(files, valid_years):
     out = []
     for f in files:
@@ -347,169 +702,221 @@ def filter_files(files, valid_years):
     return list(set(out))
 
 
+@instrument(kind='load')
 def load_bcsd_dataset(root, scen='rcp85', models=None,
-                      resolution=DEFAULT_RESOLUTION, **kwargs):
+                      resolution=DEFAULT_RESOLUTION, source=None,
+                      variables=None, time=None, **kwargs):
+    '''load a BCSD collection, harmonized with ``SCHEMAS[source]`` if given'''
     if resolution != '8th':
         raise NotImplementedError('BCSD data has not been remapped to a '
                                   'resolution other than 1/8th degree')
     print('load_bcsd_dataset', flush=True)
-    valid_years = get_valid_years(scen)
+    schema = SCHEMAS[source] if source is not None else drop_bound_varialbes
+    valid_years = get_valid_year_range(scen)
+    if time is not None:
+        start, stop = _year_range(time)
+        valid_years = max(valid_years[0], start), min(valid_years[1], stop)
     if 'hist' in scen:
         scen = 'rcp85'  # bcsd put historical in the rcp dataset
 
-    if models is None:
-        _models = os.listdir(root)
-        _models.sort()
-
-        models = []
-        for m in _models:
-            name, scen, ens = m.split('_')
-            models.append(name)
-        models = list(set(models))
-
-    ds_list = []
-    models_list = []
-    for m in progress(models):
-        ml = m.lower()  # bcsd uses lower case naming
-        fpath = os.path.join(root, f'{ml}_{scen}_r*', '*nc')
-        files = glob.glob(fpath)
+    index = get_file_index(root, 'bcsd')
 
-        if not files:
-            warnings.warn('no files to open: %s' % fpath)
-            models.remove(m)
-            continue
+    if models is None:
+        models = index.unique('model', scenario=scen)
 
-        files = filter_files(files, valid_years)
-        try:
-            ds_list.append(xr.open_mfdataset(files,
-                                             preprocess=drop_bound_varialbes,
-                                             **kwargs))
-            models_list.append(m)
-        except OSError:
-            print('skipping %s' % m)
+    def open_model(m):
+        ml = m.lower()  # bcsd uses lower case naming
+        if not index.query(model=ml, scenario=scen):
+            warnings.warn('no files to open: %s %s %s' % (root, ml, scen))
+            return None
 
-    ds = xr.concat(ds_list, dim=xr.Variable('gcm', models_list))
+        files = index.query(model=ml, scenario=scen, years=valid_years)
+        ds = _open_mfdataset(files, preprocess=schema, **kwargs)
+        if source is not None:
+            ds = schema.apply(ds, variables=variables)
+        return _select(ds, variables, time)
 
-    return ds
+    return _open_models(models, open_model)
 
 
+@instrument(kind='load')
+@_memo_loader('BCSD_MET_ROOT_DIR', 'bcsd')
+@_loader_options
 def load_daily_bcsd_meteorology(scen='rcp85', models=None,
-                                resolution=DEFAULT_RESOLUTION, **kwargs):
+                                resolution=DEFAULT_RESOLUTION, variables=None,
+                                time=None, backend='netcdf', **kwargs):
     print('load_daily_bcsd_meteorology', flush=True)
+    if backend == 'zarr':
+        return _open_zarr('daily_bcsd_meteorology', scen=scen, models=models,
+                          resolution=resolution, variables=variables,
+                          time=time, **kwargs)
 
-    ds = load_bcsd_dataset(BCSD_MET_ROOT_DIR, scen=scen, models=models,
-                           resolution=resolution, **kwargs)
-    return ds
+    return load_bcsd_dataset(BCSD_MET_ROOT_DIR, scen=scen, models=models,
+                             resolution=resolution, source='bcsd_met',
+                             variables=variables, time=time, **kwargs)
 
 
+@instrument(kind='load')
+@_memo_loader('BCSD_MET_MON_ROOT_DIR', 'bcsd')
+@_loader_options
 def load_monthly_bcsd_meteorology(scen='rcp85', models=None,
-                                  resolution=DEFAULT_RESOLUTION, **kwargs):
+                                  resolution=DEFAULT_RESOLUTION,
+                                  variables=None, time=None,
+                                  backend='netcdf', **kwargs):
     print('load_monthly_bcsd_meteorology', flush=True)
+    if backend == 'zarr':
+        return _open_zarr('monthly_bcsd_meteorology', scen=scen, models=models,
+                          resolution=resolution, variables=variables,
+                          time=time, **kwargs)
 
-    ds = load_bcsd_dataset(BCSD_MET_MON_ROOT_DIR, scen=scen, models=models,
-                           resolution=resolution, **kwargs)
-
-    return ds.rename({'latitude': 'lat', 'longitude': 'lon',
-                      'pr': 'pcp', 'tasmin': 't_min',
-                      'tasmax': 't_max', 'tas': 't_mean'})
+    return load_bcsd_dataset(BCSD_MET_MON_ROOT_DIR, scen=scen, models=models,
+                             resolution=resolution, source='bcsd_met_mon',
+                             variables=variables, time=time, **kwargs)
 
 
+@instrument(kind='load')
+@_memo_loader('BCSD_VIC_ROOT_DIR', 'bcsd')
+@_loader_options
 def load_daily_bcsd_hydrology(scen='rcp85', models=None,
-                              resolution=DEFAULT_RESOLUTION, **kwargs):
+                              resolution=DEFAULT_RESOLUTION, variables=None,
+                              time=None, backend='netcdf', **kwargs):
     print('load_daily_bcsd_hydrology', flush=True)
+    if backend == 'zarr':
+        return _open_zarr('daily_bcsd_hydrology', scen=scen, models=models,
+                          resolution=resolution, variables=variables,
+                          time=time, **kwargs)
 
-    ds = load_bcsd_dataset(BCSD_VIC_ROOT_DIR, scen=scen, models=models,
-                           resolution=resolution, **kwargs)
-    return ds.rename({'longitude': 'lon', 'latitude': 'lat',
-                      'total runoff': 'total_runoff'})
+    return load_bcsd_dataset(BCSD_VIC_ROOT_DIR, scen=scen, models=models,
+                             resolution=resolution, source='bcsd_vic',
+                             variables=variables, time=time, **kwargs)
 
 
+@instrument(kind='load')
+@_memo_loader('BCSD_VIC_MON_ROOT_DIR', 'bcsd')
+@_loader_options
 def load_monthly_bcsd_hydrology(scen='rcp85', models=None,
-                                resolution=DEFAULT_RESOLUTION, **kwargs):
+                                resolution=DEFAULT_RESOLUTION, variables=None,
+                                time=None, backend='netcdf', **kwargs):
     print('load_monthly_bcsd_hydrology', flush=True)
-
-    ds = load_bcsd_dataset(BCSD_VIC_MON_ROOT_DIR, scen=scen, models=models,
-                           resolution=resolution, **kwargs)
-    return ds.rename({'longitude': 'lon', 'latitude': 'lat',
-                      'et': 'ET', 'swe': 'SWE'})
-
-
-def load_daily_maurer_meteorology(resolution=DEFAULT_RESOLUTION, **kwargs):
+    if backend == 'zarr':
+        return _open_zarr('monthly_bcsd_hydrology', scen=scen, models=models,
+                          resolution=resolution, variables=variables,
+                          time=time, **kwargs)
+
+    return load_bcsd_dataset(BCSD_VIC_MON_ROOT_DIR, scen=scen, models=models,
+                             resolution=resolution, source='bcsd_vic_mon',
+                             variables=variables, time=time, **kwargs)
+
+
+@instrument(kind='load')
+@_memo_loader('MAURER_MET_ROOT_DIR', 'maurer_met')
+@_loader_options
+def load_daily_maurer_meteorology(resolution=DEFAULT_RESOLUTION,
+                                  variables=None, time=None,
+                                  backend='netcdf', **kwargs):
     print('load_daily_maurer_meteorology', flush=True)
+    if backend == 'zarr':
+        return _open_zarr('daily_maurer_meteorology', resolution=resolution,
+                          variables=variables, time=time, **kwargs)
 
     if resolution != '8th':
         raise NotImplementedError('Maurer data has not been remapped to a '
                                   'resolution other than 1/8th degree')
 
-    def preproc(ds):
-        if 'latitude' in ds:
-            # 1 or 2 files have different coordinate data so we fix that here
-            ds = ds.rename({'latitude': 'lat', 'longitude': 'lon'})
-            ds = ds.drop(['longitude_bnds', 'latitude_bnds'])
-        ds['lon'] = ds['lon'].where(ds['lon'] <= 180, ds['lon'] - 360)
-        return ds
-
-    var = '*'
-
-    fpath = os.path.join(MAURER_MET_ROOT_DIR, var, '*nc')
-    ds = xr.open_mfdataset(fpath, preprocess=preproc, **kwargs)
+    # 1 or 2 files have different coordinate data, the schema fixes that
+    schema = SCHEMAS['maurer_met']
+    files, _ = _records_or_remap(
+        get_file_index(MAURER_MET_ROOT_DIR, 'maurer_met'), None,
+        schema=schema, variables=variables, time=time)
+    ds = _open_mfdataset(files, preprocess=schema, **kwargs)
 
-    ds = ds.rename({'pr': 'pcp', 'tasmin': 't_min',
-                    'tasmax': 't_max'})
+    return _select(schema.apply(ds, variables=variables), time=time)
 
-    ds['t_mean'] = _calc_t_mean(ds)
 
-    return ds
-
-
-def load_monthly_maurer_meteorology(**kwargs):
+@instrument(kind='load')
+@_memo_loader('MAURER_MET_ROOT_DIR', 'maurer_met')
+@_loader_options
+def load_monthly_maurer_meteorology(resolution=DEFAULT_RESOLUTION,
+                                    materialize=False, variables=None,
+                                    time=None, cells=False, **kwargs):
     print('load_monthly_maurer_meteorology', flush=True)
-    ds = load_daily_maurer_meteorology(**kwargs)
-    return resample_daily_data(ds)
-
-
-def load_daily_livneh_meteorology(resolution=DEFAULT_RESOLUTION, **kwargs):
+    sources = get_file_index(MAURER_MET_ROOT_DIR, 'maurer_met').records()
+    return _load_monthly_from_store(
+        store_name('maurer_meteorology', resolution), sources,
+        load_daily_maurer_meteorology, materialize=materialize,
+        variables=variables, time=time, cells=cells, resolution=resolution,
+        **kwargs)
+
+
+@instrument(kind='load')
+@_memo_loader('LIVNEH_MET_ROOT_DIR', 'livneh_met')
+@_loader_options
+def load_daily_livneh_meteorology(resolution=DEFAULT_RESOLUTION,
+                                  variables=None, time=None,
+                                  backend='netcdf', **kwargs):
     print('load_daily_livneh_meteorology', flush=True)
-    if resolution == '16th':
-        resolution = ''
-    fpath = os.path.join(LIVNEH_MET_ROOT_DIR, resolution, '*nc')
-    ds = xr.open_mfdataset(fpath, **kwargs)
-    if 'longitude' in ds.coords:
-        ds = ds.rename({'latitude': 'lat', 'longitude': 'lon',
-                        'Prec': 'pcp', 'Tmin': 't_min', 'Tmax': 't_max'})
-    else:
-        ds = ds.rename({'Prec': 'pcp', 'Tmin': 't_min', 'Tmax': 't_max'})
-    ds['t_mean'] = _calc_t_mean(ds)
-    return ds[['t_mean', 'pcp']]
-
-
-def load_monthly_livneh_meteorology(resolution=DEFAULT_RESOLUTION, **kwargs):
-    print('load_monthly_livneh_meteorology', flush=True)
-    # for now, just load daily and resample imediately
-    ds = load_daily_livneh_meteorology(resolution=resolution, **kwargs)
-    ds = resample_daily_data(ds)
+    if backend == 'zarr':
+        return _open_zarr('daily_livneh_meteorology', resolution=resolution,
+                          variables=variables, time=time, **kwargs)
+    schema = SCHEMAS['livneh_met']
+    files, remap = _records_or_remap(
+        get_file_index(LIVNEH_MET_ROOT_DIR, 'livneh_met'), resolution,
+        schema=schema, variables=variables, time=time)
+    ds = _open_mfdataset(files, preprocess=schema, **kwargs)
+    ds = _select(schema.apply(ds, variables=variables), time=time)
+    if remap:
+        ds = _remap_to(ds, resolution)
     return ds
 
 
-def load_daily_livneh_hydrology(resolution=DEFAULT_RESOLUTION, **kwargs):
+@instrument(kind='load')
+@_memo_loader('LIVNEH_MET_ROOT_DIR', 'livneh_met')
+@_loader_options
+def load_monthly_livneh_meteorology(resolution=DEFAULT_RESOLUTION,
+                                    materialize=False, variables=None,
+                                    time=None, cells=False, **kwargs):
+    print('load_monthly_livneh_meteorology', flush=True)
+    sources, _ = _records_or_remap(
+        get_file_index(LIVNEH_MET_ROOT_DIR, 'livneh_met'), resolution)
+    return _load_monthly_from_store(
+        store_name('livneh_meteorology', resolution), sources,
+        load_daily_livneh_meteorology, materialize=materialize,
+        variables=variables, time=time, cells=cells, resolution=resolution,
+        **kwargs)
+
+
+@instrument(kind='load')
+@_memo_loader('LIVNEH_VIC_ROOT_DIR', 'livneh_vic')
+@_loader_options
+def load_daily_livneh_hydrology(resolution=DEFAULT_RESOLUTION,
+                                variables=None, time=None,
+                                backend='netcdf', **kwargs):
     print('load_daily_livneh_hydrology', flush=True)
-    if resolution == '16th':
-        resolution = ''
-    fpath = os.path.join(LIVNEH_VIC_ROOT_DIR, resolution, '*nc')
-    ds = xr.open_mfdataset(fpath, **kwargs)
-    ds['total_runoff'] = _calc_total_runoff(ds)
-    if 'Lat' in ds.coords:
-        ds = ds.rename({'Lat': 'lat', 'Lon': 'lon', 'Time': 'time'})
-    elif 'latitude' in ds.coords:
-        ds = ds.rename({'latitude': 'lat', 'longitude': 'lon', 'Time': 'time'})
-    elif 'Time' in ds.coords:
-        ds = ds.rename({'Time': 'time'})
+    if backend == 'zarr':
+        return _open_zarr('daily_livneh_hydrology', resolution=resolution,
+                          variables=variables, time=time, **kwargs)
+    schema = SCHEMAS['livneh_vic']
+    files, remap = _records_or_remap(
+        get_file_index(LIVNEH_VIC_ROOT_DIR, 'livneh_vic'), resolution,
+        schema=schema, variables=variables, time=time)
+    ds = _open_mfdataset(files, preprocess=schema, **kwargs)
+    ds = _select(schema.apply(ds, variables=variables), time=time)
+    if remap:
+        ds = _remap_to(ds, resolution)
     return ds
 
 
-def load_monthly_livneh_hydrology(resolution=DEFAULT_RESOLUTION, **kwargs):
+@instrument(kind='load')
+@_memo_loader('LIVNEH_VIC_ROOT_DIR', 'livneh_vic')
+@_loader_options
+def load_monthly_livneh_hydrology(resolution=DEFAULT_RESOLUTION,
+                                  materialize=False, variables=None,
+                                  time=None, cells=False, **kwargs):
     print('load_monthly_livneh_hydrology', flush=True)
-    # for now, just load daily and resample imediately
-    ds = load_daily_livneh_hydrology(resolution=resolution, **kwargs)
-    ds = resample_daily_data(ds)
-    return ds
+    sources, _ = _records_or_remap(
+        get_file_index(LIVNEH_VIC_ROOT_DIR, 'livneh_vic'), resolution)
+    return _load_monthly_from_store(
+        store_name('livneh_hydrology', resolution), sources,
+        load_daily_livneh_hydrology, materialize=materialize,
+        variables=variables, time=time, cells=cells, resolution=resolution,
+        **kwargs)
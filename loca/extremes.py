@@ -0,0 +1,177 @@
+'''Return-period and low-flow statistics (RO20yr, 7Q10-style metrics)
+
+Annual block maxima/minima are computed lazily with the single-pass
+resampling engine in ``loca.resample`` and distributions are fit to every
+grid cell at once with vectorized L-moment (Pearson III, GEV) or
+method-of-moments (Pearson III, log-normal) estimators, so no per-cell
+``scipy.stats.*.fit`` calls or intermediate ``.compute()`` are needed.
+'''
+import numpy as np
+import xarray as xr
+from scipy import special, stats
+
+from .resample import resample_dataset
+
+DISTRIBUTIONS = ['pearson3', 'gev', 'lognorm', 'empirical']
+
+
+def block_extremes(da, freq='A-OCT', how='max', dim='time'):
+    '''maximum (or minimum) of da in every block of length freq
+
+    Defaults to water-year (October-September) maxima.
+    '''
+    name = da.name or '__values__'
+    out = resample_dataset(da.to_dataset(name=name), freqs=[freq], how=how,
+                           dim=dim)[freq][name]
+    return out.rename(da.name)
+
+
+def rolling_block_min(da, window=7, freq='A-OCT', dim='time'):
+    '''annual minimum of the ``window``-day rolling mean of da'''
+    rolled = da.rolling({dim: window}).mean()
+    return block_extremes(rolled, freq=freq, how='min', dim=dim)
+
+
+def _sorted_valid(x, axis):
+    '''sort along axis (NaNs last) and count the valid values'''
+    x = np.sort(np.moveaxis(np.asarray(x, dtype='f8'), axis, -1), axis=-1)
+    n = np.sum(~np.isnan(x), axis=-1)
+    return x, n
+
+
+def lmoments(x, axis=-1):
+    '''first two sample L-moments and the L-skewness of x along axis
+
+    Returns ``(l1, l2, t3)``. Missing values are ignored.
+    '''
+    x, n = _sorted_valid(x, axis)
+    j = np.arange(x.shape[-1])
+    nf = n[..., np.newaxis].astype('f8')
+    valid = j < nf
+    xs = np.where(valid, x, 0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        w1 = np.where(valid, j / (nf - 1), 0)
+        w2 = np.where(valid, j * (j - 1) / ((nf - 1) * (nf - 2)), 0)
+        b0 = xs.sum(axis=-1) / n
+        b1 = (w1 * xs).sum(axis=-1) / n
+        b2 = (w2 * xs).sum(axis=-1) / n
+        l1 = b0
+        l2 = 2 * b1 - b0
+        l3 = 6 * b2 - 6 * b1 + b0
+        t3 = l3 / l2
+    return l1, l2, t3
+
+
+def fit_pearson3(x, axis=-1, method='lmoments'):
+    '''fit a Pearson type III distribution to x along axis
+
+    Returns ``(skew, loc, scale)`` as used by ``scipy.stats.pearson3``.
+    ``method`` is ``'lmoments'`` (Hosking, 1990) or ``'mom'``.
+    '''
+    if method == 'mom':
+        x = np.moveaxis(np.asarray(x, dtype='f8'), axis, -1)
+        loc = np.nanmean(x, axis=-1)
+        scale = np.nanstd(x, axis=-1, ddof=1)
+        skew = stats.skew(x, axis=-1, bias=False, nan_policy='omit')
+        return np.asarray(skew), loc, scale
+
+    l1, l2, t3 = lmoments(x, axis=axis)
+    at3 = np.abs(t3)
+    with np.errstate(invalid='ignore', divide='ignore', over='ignore'):
+        # rational approximations for the shape parameter alpha
+        z = 3 * np.pi * t3 ** 2
+        alpha_low = (1 + 0.2906 * z) / (z + 0.1882 * z ** 2 + 0.0442 * z ** 3)
+        z = 1 - at3
+        num = 0.36067 * z - 0.59567 * z ** 2 + 0.25361 * z ** 3
+        den = 1 - 2.78861 * z + 2.56096 * z ** 2 - 0.77045 * z ** 3
+        alpha_high = num / den
+        alpha = np.where(at3 < 1. / 3, alpha_low, alpha_high)
+        skew = 2 * np.sign(t3) / np.sqrt(alpha)
+        log_ratio = special.gammaln(alpha) - special.gammaln(alpha + 0.5)
+        scale = l2 * np.sqrt(np.pi) * np.sqrt(alpha) * np.exp(log_ratio)
+    # a symmetric sample is a normal distribution
+    normal = at3 < 1e-6
+    skew = np.where(normal, 0, skew)
+    scale = np.where(normal, l2 * np.sqrt(np.pi), scale)
+    return skew, l1, scale
+
+
+def fit_gev(x, axis=-1):
+    '''fit a generalized extreme value distribution to x along axis
+
+    Uses the L-moment estimators of Hosking et al. (1985). Returns
+    ``(c, loc, scale)`` as used by ``scipy.stats.genextreme``.
+    '''
+    l1, l2, t3 = lmoments(x, axis=axis)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        c = 2 / (3 + t3) - np.log(2) / np.log(3)
+        k = 7.8590 * c + 2.9554 * c ** 2
+        gumbel = np.abs(k) < 1e-6
+        g = special.gamma(1 + k)
+        scale = np.where(gumbel, l2 / np.log(2),
+                         l2 * k / ((1 - 2 ** -k) * g))
+        loc = np.where(gumbel, l1 - 0.5772156649 * scale,
+                       l1 - scale * (1 - g) / k)
+    return np.where(gumbel, 0, k), loc, scale
+
+
+def fit_lognorm(x, axis=-1):
+    '''fit a two parameter log-normal distribution by the method of moments
+    of log(x); non-positive values are ignored. Returns ``(mu, sigma)``.'''
+    x = np.moveaxis(np.asarray(x, dtype='f8'), axis, -1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        logx = np.log(np.where(x > 0, x, np.nan))
+    return np.nanmean(logx, axis=-1), np.nanstd(logx, axis=-1, ddof=1)
+
+
+def quantile(x, q, dist='pearson3', axis=-1, method='lmoments'):
+    '''fit dist to x along axis and return the quantile with probability q'''
+    if dist == 'pearson3':
+        skew, loc, scale = fit_pearson3(x, axis=axis, method=method)
+        return stats.pearson3.ppf(q, skew, loc=loc, scale=scale)
+    elif dist == 'gev':
+        c, loc, scale = fit_gev(x, axis=axis)
+        return stats.genextreme.ppf(q, c, loc=loc, scale=scale)
+    elif dist == 'lognorm':
+        mu, sigma = fit_lognorm(x, axis=axis)
+        return np.exp(mu + sigma * stats.norm.ppf(q))
+    elif dist == 'empirical':
+        with np.errstate(invalid='ignore'):
+            return np.nanpercentile(x, q * 100, axis=axis)
+    raise ValueError('unknown distribution %s, choose from %s'
+                     % (dist, DISTRIBUTIONS))
+
+
+def return_level(da, q, dist='pearson3', dim='time', method='lmoments'):
+    '''fit dist to every grid cell of da along dim and return quantile q
+
+    Block extremes keep one chunk per input time chunk, so ``dim`` is
+    rechunked into a single chunk first (cheap for one value per block).
+    '''
+    if da.chunks is not None:
+        da = da.chunk({dim: -1})
+
+    def _quantile(x):
+        return quantile(x, q, dist=dist, axis=-1,
+                        method=method).astype(x.dtype)
+
+    return xr.apply_ufunc(_quantile, da,
+                          input_core_dims=[[dim]],
+                          dask='parallelized',
+                          output_dtypes=[da.dtype],
+                          keep_attrs=True)
+
+
+def calc_ro20yr(da, dist='pearson3', freq='A-OCT', return_period=20):
+    '''runoff with a ``return_period`` year return period, from water-year
+    maxima'''
+    ymax = block_extremes(da, freq=freq, how='max')
+    return return_level(ymax, 1 - 1. / return_period, dist=dist)
+
+
+def calc_7ro10(da, dist='pearson3', freq='A-OCT', return_period=10,
+               window=7):
+    '''lowest ``window``-day mean runoff with a ``return_period`` year
+    return period (7Q10), from water-year minima of the rolling mean'''
+    ymin = rolling_block_min(da, window=window, freq=freq)
+    return return_level(ymin, 1. / return_period, dist=dist)
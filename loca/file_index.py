@@ -0,0 +1,285 @@
+'''Persistent manifest of the files that make up each archive on disk
+
+Walking the GLADE directory trees with ``os.listdir``/``glob`` on every load
+is slow on a parallel filesystem. A ``FileIndex`` walks a tree once, stores
+one record per file (path, model, scenario, ensemble, variable, year,
+resolution, size and mtime) in a json file under the loca cache directory and
+only re-lists directories whose mtime has changed on later refreshes. The
+files of unchanged directories are still stat'ed, so files rewritten in place
+get their new size and mtime.
+'''
+import hashlib
+import json
+import os
+import re
+import threading
+
+from .utils import get_cache_dir
+
+INDEX_VERSION = 1
+
+FIELDS = ['path', 'model', 'scenario', 'ensemble', 'variable', 'year',
+          'end_year', 'resolution', 'size', 'mtime']
+
+DEFAULT_RESOLUTION = '16th'
+
+# one regular expression per directory layout, matched against the path of
+# each file relative to the archive root. Named groups map to record fields.
+LAYOUTS = {
+    # <model>/<res>/<scen>/<ens>/<var>/<var>_day_<model>_<scen>_<ens>_<drange>.LOCA_2016-04-02.16th.nc
+    'loca_met': re.compile(
+        r'^(?P<model>[^/]+)/(?P<resolution>[^/]+)/(?P<scenario>[^/]+)/'
+        r'(?P<ensemble>[^/]+)/(?P<variable>[^/]+)/'
+        r'[^/]*_(?P<year>\d{4})\d{4}-(?P<end_year>\d{4})\d{4}[^/]*nc$'),
+    # <model>/vic_output.<scen>.netcdf/[<res>/]<var>.<year>.v0.nc
+    'loca_vic': re.compile(
+        r'^(?P<model>[^/]+)/vic_output\.(?P<scenario>[^/]+)\.netcdf/'
+        r'(?:(?P<resolution>[^/]+)/)?(?P<variable>[^/.]+)\.(?P<year>\d{4})'
+        r'\.[^/]*nc$'),
+    # <model>_<scen>_<ens>/*.nc
+    'bcsd': re.compile(
+        r'^(?P<model>[^/_]+)_(?P<scenario>[^/_]+)_(?P<ensemble>[^/_]+)/'
+        r'(?P<filename>[^/]*nc)$'),
+    # <var>/*.nc
+    'maurer_met': re.compile(r'^(?P<variable>[^/]+)/(?P<filename>[^/]*nc)$'),
+    # *.nc
+    'maurer_vic': re.compile(r'^(?P<filename>[^/]*nc)$'),
+    # [<res>/]livneh_NAmerExt_15Oct2014.<year><month>.nc
+    'livneh_met': re.compile(
+        r'^(?:(?P<resolution>[^/]+)/)?livneh[^/]*\.(?P<year>\d{4})\d{2}'
+        r'\.[^/]*nc$'),
+    # [<res>/]<var>.<year>.v0.nc
+    'livneh_vic': re.compile(
+        r'^(?:(?P<resolution>[^/]+)/)?(?P<variable>[^/.]+)\.(?P<year>\d{4})'
+        r'\.[^/]*nc$'),
+}
+
+# fallback for layouts that don't encode the year in a fixed position
+_YEAR_RE = re.compile(r'(?<!\d)(1[89]\d\d|2[01]\d\d)(?!\d)')
+
+_INDEXES = {}
+_INDEXES_LOCK = threading.Lock()
+
+
+def parse_path(relpath, layout):
+    '''parse a path (relative to the archive root) into a file record
+
+    Returns None if the path does not belong to the layout.
+    '''
+    match = LAYOUTS[layout].match(relpath.replace(os.sep, '/'))
+    if match is None:
+        return None
+
+    groups = match.groupdict()
+    filename = groups.pop('filename', None)
+    rec = dict.fromkeys(FIELDS)
+    rec.update(groups)
+
+    if filename is not None and rec['year'] is None:
+        years = [int(y) for y in _YEAR_RE.findall(filename)]
+        if years:
+            rec['year'] = min(years)
+            rec['end_year'] = max(years)
+
+    if rec['year'] is not None:
+        rec['year'] = int(rec['year'])
+        rec['end_year'] = int(rec['end_year'] or rec['year'])
+
+    if rec['resolution'] is None:
+        rec['resolution'] = DEFAULT_RESOLUTION
+
+    return rec
+
+
+def _as_set(value):
+    if value is None:
+        return None
+    if isinstance(value, (str, int)):
+        return {value}
+    return set(value)
+
+
+class FileIndex(object):
+    '''Manifest of the files below ``root`` that match a directory ``layout``
+
+    Parameters
+    ----------
+    root : str
+        Root directory of the archive
+    layout : str
+        Key into ``LAYOUTS`` describing how to parse each file path
+    path : str, optional
+        Location of the persisted index, defaults to a file in the loca cache
+        directory named after ``root``.
+    '''
+
+    def __init__(self, root, layout, path=None):
+        if layout not in LAYOUTS:
+            raise ValueError('unknown layout: %s' % layout)
+        self.root = os.path.abspath(root)
+        self.layout = layout
+        if path is None:
+            key = hashlib.sha1(
+                ('%s:%s' % (self.root, layout)).encode()).hexdigest()[:16]
+            path = os.path.join(get_cache_dir('index'), '%s.json' % key)
+        self.path = path
+
+        self._dirs = {}
+        self._records = {}
+        self._refreshed = False
+        # loaders open models from several threads
+        self._lock = threading.RLock()
+        self._load()
+
+    def __repr__(self):
+        return '<FileIndex %s (%s): %d files>' % (self.root, self.layout,
+                                                  len(self._records))
+
+    def __len__(self):
+        self._maybe_refresh()
+        return len(self._records)
+
+    def _load(self):
+        try:
+            with open(self.path) as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            return
+        header = (state.get('version'), state.get('root'), state.get('layout'))
+        if header != (INDEX_VERSION, self.root, self.layout):
+            return
+        self._dirs = state['dirs']
+        self._records = {r['path']: r for r in state['files']}
+
+    def save(self):
+        '''write the index to disk'''
+        state = {'version': INDEX_VERSION, 'root': self.root,
+                 'layout': self.layout, 'dirs': self._dirs,
+                 'files': list(self._records.values())}
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp = '%s.%d.%d.tmp' % (self.path, os.getpid(),
+                                threading.get_ident())
+        with open(tmp, 'w') as f:
+            json.dump(state, f)
+        os.replace(tmp, self.path)
+
+    def refresh(self, rescan=False):
+        '''bring the index up to date with the filesystem
+
+        Directories whose mtime is unchanged since the last refresh are not
+        listed again (files added or removed always change the mtime of their
+        parent directory), only their known files are stat'ed again to pick
+        up files rewritten in place. Set ``rescan=True`` to list every
+        directory, e.g. if the layout parsing changed.
+        '''
+        dirs = {}
+        records = {}
+        stack = ['']
+        while stack:
+            rel = stack.pop()
+            full = os.path.join(self.root, rel)
+            try:
+                mtime = os.stat(full).st_mtime
+            except OSError:
+                continue
+
+            known = self._dirs.get(rel)
+            if not rescan and known is not None and known['mtime'] == mtime:
+                dirs[rel] = known
+                for name in known['files']:
+                    path = os.path.join(full, name)
+                    rec = self._records.get(path)
+                    if rec is None:
+                        continue
+                    try:
+                        st = os.stat(path)
+                    except OSError:
+                        continue
+                    if (st.st_size, st.st_mtime) != (rec['size'],
+                                                     rec['mtime']):
+                        rec = dict(rec, size=st.st_size, mtime=st.st_mtime)
+                    records[path] = rec
+                stack.extend(os.path.join(rel, d) for d in known['subdirs'])
+                continue
+
+            subdirs, files = [], []
+            with os.scandir(full) as it:
+                for entry in it:
+                    if entry.is_dir():
+                        subdirs.append(entry.name)
+                        continue
+                    rec = parse_path(os.path.join(rel, entry.name),
+                                     self.layout)
+                    if rec is None:
+                        continue
+                    st = entry.stat()
+                    rec['path'] = entry.path
+                    rec['size'] = st.st_size
+                    rec['mtime'] = st.st_mtime
+                    records[entry.path] = rec
+                    files.append(entry.name)
+            dirs[rel] = {'mtime': mtime, 'subdirs': sorted(subdirs),
+                         'files': sorted(files)}
+            stack.extend(os.path.join(rel, d) for d in subdirs)
+
+        changed = dirs != self._dirs or records != self._records
+        self._dirs = dirs
+        self._records = records
+        self._refreshed = True
+        if changed:
+            self.save()
+        return self
+
+    def _maybe_refresh(self):
+        with self._lock:
+            if not self._refreshed:
+                self.refresh()
+
+    def records(self, model=None, scenario=None, ensemble=None,
+                variable=None, resolution=None, years=None):
+        '''return the file records matching all of the given filters
+
+        Each filter may be a single value or a list of values. ``years`` is
+        an inclusive ``(start, end)`` range; files overlapping it are kept,
+        as are files whose years are unknown (their time axis is trimmed
+        after opening).
+        Files that do not encode their variable in the path (e.g. BCSD) may
+        hold any variable and are kept by the ``variable`` filter.
+        '''
+        self._maybe_refresh()
+        filters = [(k, _as_set(v)) for k, v in
+                   (('model', model), ('scenario', scenario),
+                    ('ensemble', ensemble), ('resolution', resolution))
+                   if v is not None]
+        variables = _as_set(variable)
+
+        out = []
+        for rec in self._records.values():
+            if any(rec[k] not in v for k, v in filters):
+                continue
+            known = variables is not None and rec['variable'] is not None
+            if known and rec['variable'] not in variables:
+                continue
+            if years is not None and rec['year'] is not None:
+                if rec['end_year'] < int(years[0]) or rec['year'] > int(years[1]):
+                    continue
+            out.append(rec)
+        return sorted(out, key=lambda r: r['path'])
+
+    def query(self, **filters):
+        '''return a sorted list of the file paths matching the filters'''
+        return [r['path'] for r in self.records(**filters)]
+
+    def unique(self, field, **filters):
+        '''return the sorted unique values of a field'''
+        return sorted({r[field] for r in self.records(**filters)
+                       if r[field] is not None})
+
+
+def get_file_index(root, layout):
+    '''return the (process wide) FileIndex for an archive root'''
+    key = (os.path.abspath(root), layout)
+    with _INDEXES_LOCK:
+        if key not in _INDEXES:
+            _INDEXES[key] = FileIndex(root, layout)
+        return _INDEXES[key]
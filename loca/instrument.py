@@ -0,0 +1,319 @@
+'''Structured performance records of loads, analysis steps and downloads
+
+Every instrumented step (the ``load_*`` functions in ``data_catalog``, the
+analysis functions, the download script) appends one JSON line to the run
+log with its wall time, the number and size of the files it opened, the
+bytes read by the process, the size of the dask graph and of the data it
+returned and the peak memory (RSS) of the process while it ran. Steps run
+inside other steps (e.g. a loader called by a wrapper) record their parent.
+When a distributed client is active, steps with ``report=True`` also write
+a dask performance report next to the log.
+
+The log defaults to ``runs/run_log.jsonl`` in the loca cache directory and
+is set with ``LOCA_RUN_LOG``; ``LOCA_INSTRUMENT=0`` turns recording off.
+Records of one process share a ``run`` id (``LOCA_RUN_ID`` by default) so
+that runs before and after an archive refresh can be compared.
+'''
+import contextlib
+import contextvars
+import functools
+import inspect
+import itertools
+import json
+import os
+import socket
+import threading
+import time as timer
+import uuid
+from datetime import datetime
+from importlib.util import find_spec
+
+ENABLED = os.environ.get('LOCA_INSTRUMENT', '1') != '0'
+RUN_LOG = os.environ.get('LOCA_RUN_LOG') or None
+RUN_ID = os.environ.get('LOCA_RUN_ID') or uuid.uuid4().hex[:12]
+
+# seconds between memory samples
+SAMPLE_INTERVAL = 0.05
+
+# steps active in the current context (innermost last)
+_ACTIVE = contextvars.ContextVar('loca_active_steps', default=())
+_ids = itertools.count(1)
+_write_lock = threading.Lock()
+
+
+def run_log_path():
+    '''path of the run log'''
+    from .utils import get_cache_dir
+    return RUN_LOG or os.path.join(get_cache_dir('runs'), 'run_log.jsonl')
+
+
+def _process():
+    try:
+        import psutil
+        return psutil.Process()
+    except ImportError:
+        return None
+
+
+def _read_bytes(proc):
+    '''bytes read by the process so far (None if unknown)'''
+    if proc is None:
+        return None
+    try:
+        io = proc.io_counters()
+    except (AttributeError, OSError):
+        return None
+    return getattr(io, 'read_chars', io.read_bytes)
+
+
+class _MemorySampler(object):
+    '''one thread that samples the RSS while any step is active'''
+
+    def __init__(self):
+        self.steps = set()
+        self._lock = threading.Lock()
+        self._thread = None
+        self._proc = _process()
+
+    def rss(self):
+        if self._proc is None:
+            import resource
+            # peak of the whole process (kB on linux)
+            return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+        return self._proc.memory_info().rss
+
+    def add(self, step):
+        with self._lock:
+            self.steps.add(step)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+
+    def remove(self, step):
+        with self._lock:
+            self.steps.discard(step)
+
+    def _run(self):
+        while True:
+            with self._lock:
+                if not self.steps:
+                    self._thread = None
+                    return
+                steps = list(self.steps)
+            rss = self.rss()
+            for step in steps:
+                step.peak_rss = max(step.peak_rss, rss)
+            timer.sleep(SAMPLE_INTERVAL)
+
+
+_sampler = _MemorySampler()
+
+
+def _dask_objects(obj):
+    '''dask collections in obj (which may be a dict, list or tuple)'''
+    if isinstance(obj, dict):
+        return [d for v in obj.values() for d in _dask_objects(v)]
+    if isinstance(obj, (list, tuple)):
+        return [d for v in obj for d in _dask_objects(v)]
+    if hasattr(obj, '__dask_graph__'):
+        return [obj]
+    return []
+
+
+def describe(obj):
+    '''graph size (tasks) and size in bytes of a (collection of) result(s)'''
+    graph_size, nbytes = 0, 0
+    for d in _dask_objects(obj):
+        graph = d.__dask_graph__()
+        if graph is not None:
+            graph_size += len(graph)
+        nbytes += getattr(d, 'nbytes', 0)
+    return {'graph_size': graph_size, 'nbytes': int(nbytes)}
+
+
+def _jsonable(value):
+    if value is None or isinstance(value, (bool, int, float, str)):
+        return value
+    if isinstance(value, (list, tuple)):
+        return [_jsonable(v) for v in value]
+    if isinstance(value, dict):
+        return {str(k): _jsonable(v) for k, v in value.items()}
+    if isinstance(value, slice):
+        return [_jsonable(value.start), _jsonable(value.stop)]
+    return repr(value) if len(repr(value)) < 200 else type(value).__name__
+
+
+def _active_client():
+    try:
+        from distributed import default_client
+        return default_client()
+    except (ImportError, ValueError):
+        return None
+
+
+class Step(object):
+    '''measurements of one step, see ``measure``'''
+
+    def __init__(self, name, kind='step', params=None, report=False):
+        self.name = name
+        self.kind = kind
+        self.params = params or {}
+        self.report = report
+        self.id = next(_ids)
+        active = _ACTIVE.get()
+        self.parent = active[-1].id if active else None
+        self.files = 0
+        self.file_bytes = 0
+        self.peak_rss = 0
+        self.extra = {}
+        self.result = None
+
+    def add_files(self, files):
+        '''count opened files (paths or FileIndex records)'''
+        for f in files:
+            if isinstance(f, dict) and 'size' in f:
+                size = f['size']
+            else:
+                path = f['path'] if isinstance(f, dict) else f
+                try:
+                    size = os.path.getsize(path)
+                except OSError:
+                    size = 0
+            self.files += 1
+            self.file_bytes += size
+
+    def update(self, **fields):
+        '''add fields to the record'''
+        self.extra.update(fields)
+
+    def record(self, wall_time, read_bytes=None, report=None, error=None):
+        rec = {'run': RUN_ID, 'id': self.id, 'parent': self.parent,
+               'step': self.name, 'kind': self.kind,
+               'start': self.start.isoformat(), 'host': socket.gethostname(),
+               'pid': os.getpid(), 'params': _jsonable(self.params),
+               'wall_time': round(wall_time, 6), 'files': self.files,
+               'file_bytes': self.file_bytes, 'read_bytes': read_bytes,
+               'peak_rss': self.peak_rss or None, 'report': report,
+               'error': error}
+        rec.update(describe(self.result))
+        rec.update(_jsonable(self.extra))
+        return rec
+
+
+def write_record(rec, path=None):
+    '''append one record to the run log'''
+    path = path or run_log_path()
+    line = json.dumps(rec) + '\n'
+    with _write_lock:
+        with open(path, 'a') as f:
+            f.write(line)
+
+
+def read_run_log(path=None):
+    '''the run log as a pandas DataFrame'''
+    import pandas as pd
+    path = path or run_log_path()
+    with open(path) as f:
+        return pd.DataFrame([json.loads(line) for line in f if line.strip()])
+
+
+@contextlib.contextmanager
+def measure(name, kind='step', params=None, report=True):
+    '''measure the enclosed block and append its record to the run log
+
+    Yields a ``Step``; set ``step.result`` to record the graph size and
+    size of the result, ``step.update(...)`` adds fields. With ``report``
+    and an active distributed client, a dask performance report of the
+    block is written as well.
+
+    Example
+    -------
+    >>> with measure('ro20yr', kind='analysis') as step:
+    ...     step.result = calc_ro20yr(ds['total_runoff']).compute()
+    '''
+    step = Step(name, kind=kind, params=params, report=report)
+    if not ENABLED:
+        yield step
+        return
+
+    token = _ACTIVE.set(_ACTIVE.get() + (step, ))
+    proc = _process()
+    read_start = _read_bytes(proc)
+    report_file = None
+    step.start = datetime.now()
+    start = timer.perf_counter()
+    _sampler.add(step)
+    error = None
+    with contextlib.ExitStack() as stack:
+        # the report is rendered with bokeh
+        has_bokeh = find_spec('bokeh') is not None
+        if report and has_bokeh and _active_client() is not None:
+            from distributed import performance_report
+            from .utils import get_cache_dir
+            report_file = os.path.join(
+                get_cache_dir('runs', 'reports'),
+                '%s-%d-%s.html' % (RUN_ID, step.id, name))
+            stack.enter_context(performance_report(filename=report_file))
+        try:
+            yield step
+        except BaseException as e:
+            error = repr(e)
+            raise
+        finally:
+            wall_time = timer.perf_counter() - start
+            _sampler.remove(step)
+            step.peak_rss = max(step.peak_rss, _sampler.rss())
+            _ACTIVE.reset(token)
+            read_end = _read_bytes(proc)
+            read_bytes = (None if read_start is None or read_end is None
+                          else read_end - read_start)
+            try:
+                write_record(step.record(wall_time, read_bytes=read_bytes,
+                                         report=report_file, error=error))
+            except OSError:
+                pass
+
+
+def add_files(files):
+    '''count files opened by the active steps'''
+    files = list(files)
+    for step in _ACTIVE.get():
+        step.add_files(files)
+
+
+def annotate(**fields):
+    '''add fields to the record of the innermost active step'''
+    active = _ACTIVE.get()
+    if active:
+        active[-1].update(**fields)
+
+
+def instrument(kind='step', report=False, name=None):
+    '''decorator that measures every call of a function
+
+    The arguments of the call (other than data) are recorded as ``params``
+    and the return value as the step's result.
+    '''
+    def decorator(func):
+        step_name = name or func.__name__
+        signature = inspect.signature(func)
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not ENABLED:
+                return func(*args, **kwargs)
+            arguments = signature.bind_partial(*args, **kwargs).arguments
+            params = {k: v for k, v in arguments.items()
+                      if not (hasattr(v, 'dims') or _dask_objects(v))}
+            with measure(step_name, kind=kind, params=params,
+                         report=report) as step:
+                step.result = func(*args, **kwargs)
+            return step.result
+        return wrapper
+    return decorator
+
+
+def run_in_context(pool, func, *args, **kwargs):
+    '''submit func to an executor so that it is measured as part of the
+    steps active in the caller'''
+    return pool.submit(contextvars.copy_context().run, func, *args, **kwargs)
@@ -0,0 +1,383 @@
+'''Persistent, content-addressed cache of analysis results
+
+Notebooks rebuild the same epoch means, resampled data and change signals
+from the raw archives after every kernel restart. ``memoize`` stores the
+result of a function (a Dataset or DataArray) as a chunked Zarr store under
+the loca cache directory, keyed by
+
+- the function, the source of the module it is defined in and of the
+  whole loca package,
+- the dtype of the precision policy (see ``loca.precision``),
+- its arguments (data arguments by their dask token, which for data read
+  from disk includes the path and mtime of the files; virtual datasets, see
+  ``loca.virtual``, key their arrays on the path, size and mtime),
+- and optionally a manifest of the source files (FileIndex records), for
+  functions such as the loaders whose arguments don't identify the data.
+
+A call with the same key returns the stored result, opened lazily. Every
+entry records when it was last used; once the cache exceeds ``MAX_BYTES``
+the least recently used entries are evicted.
+
+Storing a result computes it, so memoization is opt in: every memoized
+function takes a ``memo`` argument, ``True`` stores (or reuses) the result
+and ``'refresh'`` recomputes the entry. Memoization is switched off
+altogether with ``LOCA_MEMO=0`` and the size limit set with
+``LOCA_MEMO_MAX_BYTES``.
+'''
+import functools
+import hashlib
+import inspect
+import json
+import os
+import shutil
+import time
+import warnings
+from datetime import datetime
+
+import dask
+import xarray as xr
+from dask.base import tokenize
+
+from .instrument import annotate
+from .precision import get_dtype
+
+MEMO_VERSION = 1
+
+ENABLED = os.environ.get('LOCA_MEMO', '1') != '0'
+MAX_BYTES = int(os.environ.get('LOCA_MEMO_MAX_BYTES', 2 ** 35))
+
+# seconds after which an untouched, unfinished write is considered abandoned
+TMP_MAX_AGE = 3600
+
+# name of the variable a DataArray without a name is stored as
+_UNNAMED = '__xarray_dataarray_variable__'
+
+
+def memo_dir():
+    # utils instruments its functions, import it lazily
+    from .utils import get_cache_dir
+    return get_cache_dir('memo')
+
+
+def _package_sources():
+    '''source files of the loca package (tests excluded), sorted'''
+    root = os.path.dirname(os.path.abspath(__file__))
+    paths = []
+    for dirpath, dirnames, files in os.walk(root):
+        dirnames[:] = sorted(d for d in dirnames
+                             if d not in ('tests', '__pycache__'))
+        paths.extend(os.path.join(dirpath, f) for f in sorted(files)
+                     if f.endswith('.py'))
+    return paths
+
+
+@functools.lru_cache(maxsize=None)
+def code_version(module):
+    '''hash of the source of a module and of the whole loca package
+
+    Memoized functions call into other loca modules (resampling, schemas,
+    calendars, ...), so a change to any of them invalidates the entries.
+    '''
+    paths = _package_sources()
+    path = os.path.abspath(inspect.getsourcefile(module))
+    if path not in paths:
+        paths.append(path)
+    h = hashlib.sha1()
+    for path in paths:
+        with open(path, 'rb') as f:
+            h.update(f.read())
+    return h.hexdigest()
+
+
+def _token(value):
+    '''deterministic token of an argument, None if there is none'''
+    with dask.config.set({'tokenize.ensure-deterministic': True}):
+        try:
+            return tokenize(value)
+        except Exception:
+            return None
+
+
+def _entry_size(path):
+    size = 0
+    for dirpath, _, files in os.walk(path):
+        for f in files:
+            try:
+                size += os.path.getsize(os.path.join(dirpath, f))
+            except OSError:
+                pass
+    return size
+
+
+def _regular_chunks(ds):
+    '''rechunk ds so that its dask chunks can be written to Zarr'''
+    ds = ds.unify_chunks()
+    chunks = {}
+    for dim, c in ds.chunks.items():
+        if len(set(c[:-1])) > 1 or c[-1] > c[0]:
+            chunks[dim] = max(c)
+    return ds.chunk(chunks) if chunks else ds
+
+
+class Entry(object):
+    '''One stored result
+
+    Parameters
+    ----------
+    key : str
+        Hash of the function, its arguments, manifest and code version
+    root : str, optional
+        Cache directory, defaults to ``memo`` in the loca cache directory
+    '''
+
+    def __init__(self, key, root=None):
+        self.key = key
+        self.path = os.path.join(root or memo_dir(), key)
+
+    def __repr__(self):
+        return '<memo.Entry %s>' % self.path
+
+    @property
+    def data_path(self):
+        return os.path.join(self.path, 'data.zarr')
+
+    @property
+    def meta_file(self):
+        return os.path.join(self.path, 'entry.json')
+
+    @property
+    def meta(self):
+        try:
+            with open(self.meta_file) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def exists(self):
+        meta = self.meta
+        return meta is not None and meta.get('version') == MEMO_VERSION
+
+    def touch(self):
+        '''mark the entry as used (the mtime of the metadata file)'''
+        try:
+            os.utime(self.meta_file)
+        except OSError:
+            pass
+
+    def open(self):
+        '''open the stored result lazily'''
+        meta = self.meta
+        ds = xr.open_zarr(self.data_path, chunks={}, consolidated=True)
+        self.touch()
+        if meta['type'] == 'DataArray':
+            da = ds[meta['name']]
+            return da.rename(None) if meta['name'] == _UNNAMED else da
+        return ds
+
+    def write(self, obj, info=None):
+        '''compute and store obj (a Dataset or DataArray)'''
+        if isinstance(obj, xr.DataArray):
+            name = obj.name if obj.name is not None else _UNNAMED
+            ds = obj.to_dataset(name=name)
+            kind = 'DataArray'
+        else:
+            ds, name, kind = obj, None, 'Dataset'
+        ds = ds.copy()
+        for var in ds.variables.values():
+            var.encoding = {}
+        if any(var.chunks for var in ds.variables.values()):
+            ds = _regular_chunks(ds)
+
+        tmp = '%s.%d.tmp' % (self.path, os.getpid())
+        shutil.rmtree(tmp, ignore_errors=True)
+        os.makedirs(tmp)
+        ds.to_zarr(os.path.join(tmp, 'data.zarr'), mode='w',
+                   consolidated=True)
+        meta = dict(info or {}, version=MEMO_VERSION, key=self.key,
+                    type=kind, name=name,
+                    created=datetime.now().isoformat(),
+                    nbytes=_entry_size(tmp))
+        with open(os.path.join(tmp, 'entry.json'), 'w') as f:
+            json.dump(meta, f)
+
+        self.remove()
+        try:
+            os.replace(tmp, self.path)
+        except OSError:
+            # written by another process in the meantime
+            shutil.rmtree(tmp, ignore_errors=True)
+        return self
+
+    def remove(self):
+        shutil.rmtree(self.path, ignore_errors=True)
+
+
+def entries(root=None):
+    '''metadata of every entry, least recently used first
+
+    The time an entry was last used is in ``'used'``.
+    '''
+    root = root or memo_dir()
+    out = []
+    for key in os.listdir(root):
+        entry = Entry(key, root=root)
+        meta = entry.meta
+        if meta is None:
+            continue
+        meta['used'] = datetime.fromtimestamp(
+            os.path.getmtime(entry.meta_file)).isoformat()
+        out.append(meta)
+    return sorted(out, key=lambda m: m['used'])
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except OSError:
+        pass
+    return True
+
+
+def _last_modified(path):
+    '''newest mtime of any file or directory below path'''
+    latest = os.path.getmtime(path)
+    for dirpath, _, files in os.walk(path):
+        for name in files + ['.']:
+            try:
+                latest = max(latest, os.path.getmtime(
+                    os.path.join(dirpath, name)))
+            except OSError:
+                pass
+    return latest
+
+
+def sweep(root=None, max_age=TMP_MAX_AGE):
+    '''remove ``<key>.<pid>.tmp`` directories left by interrupted writes
+
+    A directory is removed once nothing in it has changed for ``max_age``
+    seconds, unless its process is still running on this host. Returns the
+    number of directories removed.
+    '''
+    root = root or memo_dir()
+    removed = 0
+    for name in os.listdir(root):
+        parts = name.rsplit('.', 2)
+        if len(parts) != 3 or parts[2] != 'tmp' or not parts[1].isdigit():
+            continue
+        path = os.path.join(root, name)
+        try:
+            stale = time.time() - _last_modified(path) > max_age
+        except OSError:
+            continue
+        if stale and not _pid_alive(int(parts[1])):
+            shutil.rmtree(path, ignore_errors=True)
+            removed += 1
+    return removed
+
+
+def evict(max_bytes=None, root=None, keep=()):
+    '''remove least recently used entries until the cache fits in max_bytes
+
+    Abandoned partial writes are swept first (see ``sweep``). Entries whose
+    key is in ``keep`` are never removed. Returns the number of entries
+    removed.
+    '''
+    max_bytes = MAX_BYTES if max_bytes is None else max_bytes
+    sweep(root)
+    metas = entries(root)
+    total = sum(m['nbytes'] for m in metas)
+    removed = 0
+    for meta in metas:
+        if total <= max_bytes:
+            break
+        if meta['key'] in keep:
+            continue
+        Entry(meta['key'], root=root).remove()
+        total -= meta['nbytes']
+        removed += 1
+    return removed
+
+
+def clear(root=None):
+    '''remove every entry'''
+    return evict(0, root=root)
+
+
+def memoize(manifest=None, default=False, name=None):
+    '''decorator that stores the results of a function in the cache
+
+    Parameters
+    ----------
+    manifest : callable, optional
+        Called with the bound arguments (a dict) of a call, returns the
+        FileIndex records of the files the result is computed from
+    default : bool
+        Whether calls are memoized when ``memo`` isn't given (and
+        ``ENABLED`` is set). Storing a result computes it, so this is off
+        for functions that otherwise return lazy results.
+    name : str, optional
+        Name of the function in the key, defaults to its qualified name
+
+    Results other than Datasets and DataArrays, and calls with arguments
+    that have no deterministic token, are not stored.
+    '''
+    def decorator(func):
+        func_name = name or '%s.%s' % (func.__module__, func.__qualname__)
+        signature = inspect.signature(func)
+        module = inspect.getmodule(func)
+
+        def key_of(arguments):
+            tokens = {}
+            for k, v in arguments.items():
+                tokens[k] = _token(v)
+                if tokens[k] is None:
+                    return None
+            parts = [MEMO_VERSION, func_name, code_version(module),
+                     str(get_dtype()), tokens]
+            if manifest is not None:
+                from .aggregates import source_fingerprint
+                parts.append(source_fingerprint(manifest(arguments)))
+            return hashlib.sha1(
+                json.dumps(parts, sort_keys=True).encode()).hexdigest()
+
+        @functools.wraps(func)
+        def wrapper(*args, memo=None, **kwargs):
+            if memo is None:
+                memo = default and ENABLED
+            if not memo:
+                return func(*args, **kwargs)
+
+            bound = signature.bind(*args, **kwargs)
+            bound.apply_defaults()
+            key = key_of(bound.arguments)
+            if key is None:
+                warnings.warn('arguments of %s have no deterministic token, '
+                              'not memoizing' % func_name)
+                return func(*args, **kwargs)
+
+            entry = Entry(key)
+            if memo != 'refresh' and entry.exists():
+                annotate(memo='hit')
+                return entry.open()
+
+            result = func(*args, **kwargs)
+            if not isinstance(result, (xr.Dataset, xr.DataArray)):
+                return result
+            annotate(memo='miss')
+            entry.write(result, info={'function': func_name})
+            evict(keep=(key, ))
+            return entry.open()
+
+        # record the memo argument (e.g. for ``instrument``)
+        params = list(signature.parameters.values())
+        memo_param = inspect.Parameter('memo', inspect.Parameter.KEYWORD_ONLY,
+                                       default=None)
+        if params and params[-1].kind == inspect.Parameter.VAR_KEYWORD:
+            params.insert(-1, memo_param)
+        else:
+            params.append(memo_param)
+        wrapper.__signature__ = signature.replace(parameters=params)
+        return wrapper
+    return decorator
@@ -0,0 +1,241 @@
+'''Time series at points (gauges, stations) from the gridded archives
+
+Selecting one point at a time with ``sel(lat=..., lon=..., method='nearest')``
+reads the chunks around every point separately, for every file and gcm.
+``extract_points`` instead
+
+- finds the nearest valid (land) grid cell of every point at once with a
+  KD-tree over the valid cells of the grid; the trees are kept per grid and
+  source, the valid cells are the cached ``loca.cells`` index,
+- groups the points by the spatial chunk they fall in and reads every chunk
+  once for all of its points,
+- and returns a ``(point, gcm, time)`` dataset.
+
+Example
+-------
+>>> gauges = pd.read_csv('camels_gauges.csv', index_col='gauge_id')
+>>> ds = load_points('load_daily_loca_hydrology', gauges, scen='rcp85',
+...                  variables=['total_runoff'])
+'''
+import threading
+
+import dask.array as dask_array
+import numpy as np
+import pandas as pd
+import xarray as xr
+from scipy.spatial import cKDTree
+
+from .cells import (CELL_DIM, CellIndex, _valid_mask, cached_index,
+                    get_cell_index, loader_key)
+from .instrument import instrument
+from .regions import grid_hash
+
+POINT_DIM = 'point'
+
+EARTH_RADIUS = 6371.
+
+_TREES = {}
+_TREES_LOCK = threading.Lock()
+
+
+def _xyz(lat, lon):
+    '''unit vectors of lat/lon (degrees) for chord distances'''
+    lat, lon = np.deg2rad(lat), np.deg2rad(lon)
+    return np.stack([np.cos(lat) * np.cos(lon), np.cos(lat) * np.sin(lon),
+                     np.sin(lat)], axis=-1)
+
+
+class GridIndex(object):
+    '''KD-tree over the (valid) cells of a regular lat/lon grid
+
+    Parameters
+    ----------
+    cells : CellIndex
+        Grid and flat indices of the cells points may be matched to
+    '''
+
+    def __init__(self, cells):
+        self.cells = cells
+        ilat, ilon = np.unravel_index(cells.index,
+                                      (cells.lat.size, cells.lon.size))
+        self.tree = cKDTree(_xyz(cells.lat[ilat], cells.lon[ilon]))
+
+    def __repr__(self):
+        return '<GridIndex: %d cells>' % self.cells.index.size
+
+    def query(self, lat, lon):
+        '''flat grid index and great circle distance (km) of the nearest
+        cell of every point'''
+        lon = np.asarray(lon, dtype='f8')
+        if self.cells.lon.max() > 180:
+            lon = lon % 360
+        chord, i = self.tree.query(_xyz(np.asarray(lat, dtype='f8'), lon))
+        distance = 2 * EARTH_RADIUS * np.arcsin(np.minimum(chord / 2, 1))
+        return self.cells.index[i], distance
+
+
+def get_grid_index(ds, key=None):
+    '''return the (process wide) GridIndex of the grid of ds
+
+    With a source ``key`` the points are matched to the valid cells of the
+    cached cell index of that source (see ``loca.cells``), packed data to
+    its cells. Otherwise the valid cells are read from the first time step
+    of ds (and the tree is not kept).
+    '''
+    if CELL_DIM in ds.dims:
+        cells = cached_index(ds)
+        name = (cells.key, grid_hash(cells.lat, cells.lon))
+    else:
+        lat, lon = ds['lat'].values, ds['lon'].values
+        if key is None:
+            return GridIndex(CellIndex.from_mask(_valid_mask(ds), lat, lon))
+        cells = None
+        name = (key, grid_hash(lat, lon))
+
+    with _TREES_LOCK:
+        if name not in _TREES:
+            _TREES[name] = GridIndex(cells or get_cell_index(ds, key))
+        return _TREES[name]
+
+
+def _points_frame(points):
+    '''points as a DataFrame with lat and lon columns, indexed by point id'''
+    if isinstance(points, pd.DataFrame):
+        frame = points
+    else:
+        frame = pd.DataFrame.from_dict(dict(points), orient='index',
+                                       columns=['lat', 'lon'])
+    missing = {'lat', 'lon'} - set(frame.columns)
+    if missing:
+        raise ValueError('points have no %s columns' % sorted(missing))
+    return frame
+
+
+def _take_points(block, ilat, ilon):
+    return block[..., ilat, ilon]
+
+
+def _extract_dask(data, ilat, ilon):
+    '''points of a dask array whose last two axes are (lat, lon)
+
+    Every spatial chunk holding points is read once (per chunk along the
+    other axes) for all of its points.
+    '''
+    ndim = data.ndim
+    lat_bounds = np.cumsum((0, ) + data.chunks[-2])
+    lon_bounds = np.cumsum((0, ) + data.chunks[-1])
+    bi = np.searchsorted(lat_bounds, ilat, side='right') - 1
+    bj = np.searchsorted(lon_bounds, ilon, side='right') - 1
+    blocks, group = np.unique(bi * len(data.chunks[-1]) + bj,
+                              return_inverse=True)
+    order = np.argsort(group, kind='stable')
+    splits = np.cumsum(np.bincount(group, minlength=blocks.size))[:-1]
+
+    parts = []
+    for block, members in zip(blocks, np.split(order, splits)):
+        i, j = divmod(block, len(data.chunks[-1]))
+        sub = data.blocks[(slice(None), ) * (ndim - 2) + (i, j)]
+        parts.append(sub.map_blocks(
+            _take_points, ilat[members] - lat_bounds[i],
+            ilon[members] - lon_bounds[j], drop_axis=ndim - 1,
+            chunks=sub.chunks[:-2] + ((members.size, ), ), dtype=data.dtype))
+    out = dask_array.concatenate(parts, axis=-1).rechunk({ndim - 2: -1})
+    # back to the order of the points
+    return out[..., np.argsort(order)]
+
+
+def _extract(da, ilat, ilon):
+    da = da.transpose(..., 'lat', 'lon')
+    dims = da.dims[:-2] + (POINT_DIM, )
+    coords = {k: v for k, v in da.coords.items()
+              if not {'lat', 'lon'} & set(v.dims)}
+    if isinstance(da.data, dask_array.Array):
+        data = _extract_dask(da.data, ilat, ilon)
+    else:
+        data = da.values[..., ilat, ilon]
+    return xr.DataArray(data, dims=dims, coords=coords, attrs=da.attrs)
+
+
+@instrument(kind='analysis')
+def extract_points(ds, points, key=None, max_distance=None):
+    '''time series of a dataset at points
+
+    Parameters
+    ----------
+    ds : xarray.Dataset
+        Gridded (lat, lon) or packed (``cell``) data, e.g. from a loader
+    points : DataFrame or dict
+        ``lat`` and ``lon`` (degrees east) of every point, indexed by point
+        id, or a dict mapping point ids to ``(lat, lon)``
+    key : str, optional
+        Source of the cached cell index the points are matched to (see
+        ``get_grid_index``)
+    max_distance : float, optional
+        Points farther (km) from the nearest valid cell are NaN
+
+    Returns
+    -------
+    out : xarray.Dataset
+        Variables with dims ``(point, ...)``, e.g. ``(point, gcm, time)``,
+        the grid cell of each point (``lat``, ``lon``), its distance
+        (``distance``, km) and the requested location (``point_lat``,
+        ``point_lon``)
+    '''
+    frame = _points_frame(points)
+    index = get_grid_index(ds, key=key)
+    flat, distance = index.query(frame['lat'].values, frame['lon'].values)
+    ilat, ilon = np.unravel_index(flat, (index.cells.lat.size,
+                                         index.cells.lon.size))
+
+    out = xr.Dataset(attrs=ds.attrs)
+    for name, da in ds.data_vars.items():
+        if CELL_DIM in da.dims:
+            position = np.searchsorted(ds[CELL_DIM].values, flat)
+            var = da.isel({CELL_DIM: xr.DataArray(position, dims=POINT_DIM)})
+            var = var.drop_vars([c for c in (CELL_DIM, 'lat', 'lon')
+                                 if c in var.coords])
+        elif 'lat' in da.dims and 'lon' in da.dims:
+            var = _extract(da, ilat, ilon)
+        else:
+            continue
+        out[name] = var.transpose(POINT_DIM, ...)
+
+    out.coords[POINT_DIM] = frame.index.values
+    out.coords['lat'] = (POINT_DIM, index.cells.lat[ilat])
+    out.coords['lon'] = (POINT_DIM, index.cells.lon[ilon])
+    out.coords['distance'] = (POINT_DIM, distance, {'units': 'km'})
+    out.coords['point_lat'] = (POINT_DIM, frame['lat'].values)
+    out.coords['point_lon'] = (POINT_DIM, frame['lon'].values)
+    if max_distance is not None:
+        out = out.where(out['distance'] <= max_distance)
+    return out
+
+
+@instrument(kind='load')
+def load_points(loader, points, max_distance=None, **kwargs):
+    '''load the time series at points from a loader in ``data_catalog``
+
+    Parameters
+    ----------
+    loader : str or callable
+        Loader (or its name), e.g. ``'load_daily_loca_hydrology'``. Loaders
+        returning a dict of sources return a dict of point datasets.
+    points : DataFrame or dict
+        See ``extract_points``
+    kwargs :
+        Passed to the loader
+
+    Returns
+    -------
+    out : xarray.Dataset or dict
+    '''
+    from . import data_catalog
+
+    if isinstance(loader, str):
+        loader = getattr(data_catalog, loader)
+    ds = loader(**kwargs)
+    if isinstance(ds, dict):
+        return {k: extract_points(v, points, max_distance=max_distance)
+                for k, v in ds.items()}
+    return extract_points(ds, points, key=loader_key(loader.__name__),
+                          max_distance=max_distance)
@@ -0,0 +1,67 @@
+'''Floating point precision of loaded and derived data
+
+The archives are float32 on disk (or packed integers that decode to
+float64), but unit conversions, derived variables and weights silently
+promote them to float64, doubling memory and transfer on the cluster. The
+precision policy sets the dtype that loaded data, derived variables and
+analysis results are kept in:
+
+- globally with ``LOCA_DTYPE`` (default ``float32``) or by setting
+  ``DTYPE``; ``'native'`` keeps the dtypes of the source files,
+- for a block of code with ``with precision('float64'): ...``,
+- per call with the ``dtype`` argument of the loaders.
+
+Sums over many time steps (epoch means, resampling) are accumulated in
+``ACCUMULATOR`` and cast to the policy dtype afterwards.
+'''
+import contextlib
+import contextvars
+import os
+
+import numpy as np
+import xarray as xr
+
+DTYPE = os.environ.get('LOCA_DTYPE', 'float32')
+
+# dtype of running sums over many values
+ACCUMULATOR = 'f8'
+
+_DTYPE = contextvars.ContextVar('loca_dtype', default=None)
+
+
+def get_dtype(dtype=None):
+    '''the dtype to use: dtype if given, else that of the enclosing
+    ``precision`` block, else ``DTYPE``. None means keep the native dtype.
+    '''
+    for value in (dtype, _DTYPE.get(), DTYPE):
+        if value is not None:
+            return None if value == 'native' else np.dtype(value)
+    return None
+
+
+@contextlib.contextmanager
+def precision(dtype):
+    '''use dtype for the loads and analyses in the block (None changes
+    nothing)'''
+    if dtype is None:
+        yield
+        return
+    token = _DTYPE.set(dtype)
+    try:
+        yield
+    finally:
+        _DTYPE.reset(token)
+
+
+def cast(obj, dtype=None):
+    '''cast the floating point data of a Dataset, DataArray or array to the
+    policy dtype (lazily for dask arrays, coordinates are left alone)'''
+    dtype = get_dtype(dtype)
+    if dtype is None:
+        return obj
+    if isinstance(obj, xr.Dataset):
+        return obj.assign({name: cast(da, dtype)
+                           for name, da in obj.data_vars.items()})
+    if np.issubdtype(obj.dtype, np.floating) and obj.dtype != dtype:
+        return obj.astype(dtype)
+    return obj
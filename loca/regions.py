@@ -0,0 +1,266 @@
+'''Aggregation of gridded data to regions (basins, HUCs) with sparse weights
+
+Each region covers a handful of grid cells, so the grid-cell -> region
+weights are stored as a ``scipy.sparse`` matrix of shape
+``(n_regions, n_lat * n_lon)`` instead of a dense ``(region, lat, lon)``
+array. Weight matrices are cached on disk, keyed by a hash of the grid and of
+the region geometries, and applied as one sparse matrix product per chunk
+across every leading dimension (e.g. ``gcm`` and ``time``) of the data.
+'''
+import hashlib
+import os
+
+import numpy as np
+import scipy.sparse as sp
+import xarray as xr
+
+from .utils import get_cache_dir
+
+
+def grid_hash(lat, lon):
+    '''hash of the lat/lon coordinates of a grid'''
+    h = hashlib.sha1()
+    for coord in (lat, lon):
+        h.update(np.ascontiguousarray(coord, dtype='f8').tobytes())
+    return h.hexdigest()[:16]
+
+
+def file_hash(path, blocksize=2 ** 20):
+    '''hash of the contents of a file (e.g. a shapefile)'''
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(blocksize), b''):
+            h.update(block)
+    return h.hexdigest()[:16]
+
+
+def geometries_hash(geometries, regions):
+    '''hash of a sequence of shapely geometries and their region ids'''
+    h = hashlib.sha1()
+    for region, geom in zip(regions, geometries):
+        h.update(str(region).encode())
+        h.update(geom.wkb)
+    return h.hexdigest()[:16]
+
+
+def _cell_edges(centers):
+    '''cell edges of a 1D coordinate of cell centers'''
+    centers = np.asarray(centers, dtype='f8')
+    if centers.size == 1:
+        return np.array([centers[0] - 0.5, centers[0] + 0.5])
+    mid = (centers[1:] + centers[:-1]) / 2
+    return np.concatenate([[2 * centers[0] - mid[0]], mid,
+                           [2 * centers[-1] - mid[-1]]])
+
+
+def _candidate_slice(edges, lo, hi):
+    '''index range of the cells overlapping [lo, hi]'''
+    lower = np.minimum(edges[:-1], edges[1:])
+    upper = np.maximum(edges[:-1], edges[1:])
+    inds = np.flatnonzero((upper > lo) & (lower < hi))
+    if inds.size == 0:
+        return slice(0, 0)
+    return slice(inds.min(), inds.max() + 1)
+
+
+class RegionWeights(object):
+    '''Sparse grid-cell -> region weights for one grid
+
+    Parameters
+    ----------
+    matrix : scipy.sparse matrix
+        Weights with shape ``(n_regions, n_lat * n_lon)``; entry ``(r, c)``
+        is the fraction of cell ``c`` that lies in region ``r``
+    regions : array-like
+        Region ids
+    lat, lon : array-like
+        Grid coordinates
+    region_dim : str
+        Name of the region dimension of aggregated output
+    '''
+
+    def __init__(self, matrix, regions, lat, lon, region_dim='region'):
+        self.matrix = sp.csr_matrix(matrix)
+        self.regions = np.asarray(regions)
+        self.lat = np.asarray(lat)
+        self.lon = np.asarray(lon)
+        self.region_dim = region_dim
+        if self.matrix.shape != (self.regions.size,
+                                 self.lat.size * self.lon.size):
+            raise ValueError('weights matrix does not match regions and grid')
+
+    def __repr__(self):
+        return '<RegionWeights: %d regions, %d x %d grid, %d weights>' % (
+            self.regions.size, self.lat.size, self.lon.size, self.matrix.nnz)
+
+    @classmethod
+    def from_dense(cls, weights, region_dim='region'):
+        '''build from a dense ``(region, lat, lon)`` DataArray'''
+        weights = weights.transpose(region_dim, 'lat', 'lon').fillna(0)
+        matrix = sp.csr_matrix(
+            weights.values.reshape(weights.shape[0], -1))
+        return cls(matrix, weights[region_dim].values, weights['lat'].values,
+                   weights['lon'].values, region_dim=region_dim)
+
+    @classmethod
+    def from_geometries(cls, lat, lon, geometries, regions,
+                        region_dim='region'):
+        '''build from shapely geometries (lon/lat coordinates)
+
+        Weights are the fraction of each grid cell's area (in degrees) that
+        intersects each geometry. Requires shapely >= 2.0.
+        '''
+        import shapely
+
+        lat_edges = _cell_edges(lat)
+        lon_edges = _cell_edges(lon)
+        nlon = len(lon)
+
+        rows, cols, vals = [], [], []
+        for r, geom in enumerate(geometries):
+            if geom is None or geom.is_empty:
+                continue
+            minx, miny, maxx, maxy = geom.bounds
+            islc = _candidate_slice(lat_edges, miny, maxy)
+            jslc = _candidate_slice(lon_edges, minx, maxx)
+            ii, jj = np.meshgrid(np.arange(len(lat))[islc],
+                                 np.arange(nlon)[jslc], indexing='ij')
+            ii, jj = ii.ravel(), jj.ravel()
+            if ii.size == 0:
+                continue
+            y0, y1 = lat_edges[ii], lat_edges[ii + 1]
+            x0, x1 = lon_edges[jj], lon_edges[jj + 1]
+            boxes = shapely.box(np.minimum(x0, x1), np.minimum(y0, y1),
+                                np.maximum(x0, x1), np.maximum(y0, y1))
+            overlap = shapely.area(shapely.intersection(geom, boxes))
+            frac = overlap / shapely.area(boxes)
+            keep = frac > 0
+            rows.append(np.full(keep.sum(), r))
+            cols.append(ii[keep] * nlon + jj[keep])
+            vals.append(frac[keep])
+
+        if rows:
+            rows, cols, vals = map(np.concatenate, (rows, cols, vals))
+        matrix = sp.csr_matrix((vals, (rows, cols)),
+                               shape=(len(regions), len(lat) * nlon))
+        return cls(matrix, regions, lat, lon, region_dim=region_dim)
+
+    def save(self, path):
+        '''write the weights to a .npz file'''
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        m = self.matrix.tocoo()
+        tmp = '%s.%d.tmp.npz' % (path[:-4] if path.endswith('.npz') else path,
+                                 os.getpid())
+        regions = self.regions
+        if regions.dtype == object:
+            regions = regions.astype(str)
+        np.savez_compressed(tmp, row=m.row, col=m.col, data=m.data,
+                            shape=m.shape, regions=regions,
+                            lat=self.lat, lon=self.lon,
+                            region_dim=self.region_dim)
+        os.replace(tmp, path)
+
+    @classmethod
+    def load(cls, path):
+        '''read weights written by save'''
+        with np.load(path, allow_pickle=False) as f:
+            matrix = sp.coo_matrix((f['data'], (f['row'], f['col'])),
+                                   shape=tuple(f['shape']))
+            return cls(matrix, f['regions'], f['lat'], f['lon'],
+                       region_dim=str(f['region_dim']))
+
+    def _matmul(self, block, normalize):
+        '''aggregate a numpy block whose last two axes are (lat, lon)'''
+        lead = block.shape[:-2]
+        x = block.reshape(-1, block.shape[-2] * block.shape[-1]).T
+        valid = ~np.isnan(x)
+        total = self.matrix @ np.where(valid, x, 0)
+        if normalize:
+            weight = self.matrix @ valid.astype(total.dtype)
+            with np.errstate(invalid='ignore', divide='ignore'):
+                total = np.where(weight > 0, total / weight, np.nan)
+        out = total.T.reshape(lead + (self.regions.size, ))
+        return out.astype(np.result_type(block.dtype, np.float32))
+
+    def aggregate(self, obj, normalize=True):
+        '''aggregate a DataArray or Dataset with lat/lon dims to regions
+
+        With ``normalize=True`` (the default) the result is the
+        area-weighted mean over the valid cells of each region, otherwise
+        the weighted sum.
+        '''
+        if isinstance(obj, xr.Dataset):
+            out = xr.Dataset(attrs=obj.attrs)
+            for name, da in obj.data_vars.items():
+                if 'lat' in da.dims and 'lon' in da.dims:
+                    out[name] = self.aggregate(da, normalize=normalize)
+            return out
+
+        same_lat = np.array_equal(obj['lat'].values, self.lat)
+        same_lon = np.array_equal(obj['lon'].values, self.lon)
+        if not (same_lat and same_lon):
+            raise ValueError('data is not on the grid of these weights')
+
+        if obj.chunks is not None:
+            # one sparse product per chunk needs the full grid in each chunk
+            obj = obj.chunk({'lat': -1, 'lon': -1})
+
+        out = xr.apply_ufunc(self._matmul, obj,
+                             input_core_dims=[['lat', 'lon']],
+                             output_core_dims=[[self.region_dim]],
+                             kwargs=dict(normalize=normalize),
+                             dask='parallelized',
+                             output_dtypes=[np.result_type(obj.dtype,
+                                                           np.float32)],
+                             dask_gufunc_kwargs=dict(output_sizes={
+                                 self.region_dim: self.regions.size}),
+                             keep_attrs=True)
+        out.coords[self.region_dim] = self.regions
+        return out
+
+
+def get_region_weights(lat, lon, geometries, regions, key=None,
+                       region_dim='region'):
+    '''return cached RegionWeights for a grid and a set of geometries
+
+    Parameters
+    ----------
+    lat, lon : array-like
+        Grid coordinates
+    geometries : sequence of shapely geometries
+        Region outlines (lon/lat)
+    regions : sequence
+        Region ids
+    key : str, optional
+        Identifier of the geometries, e.g. ``file_hash(shapefile)``.
+        Defaults to a hash of the geometries themselves.
+    '''
+    lat, lon = np.asarray(lat), np.asarray(lon)
+    if key is None:
+        key = geometries_hash(geometries, regions)
+    path = os.path.join(get_cache_dir('regions'),
+                        '%s-%s.npz' % (grid_hash(lat, lon), key))
+    if os.path.isfile(path):
+        return RegionWeights.load(path)
+
+    weights = RegionWeights.from_geometries(lat, lon, geometries, regions,
+                                            region_dim=region_dim)
+    weights.save(path)
+    return weights
+
+
+def read_shapefile_regions(path, lat, lon, id_column=None,
+                           region_dim='region'):
+    '''build (or load cached) RegionWeights from a shapefile
+
+    Requires geopandas. Regions are indexed by ``id_column`` (defaults to the
+    shapefile's index).
+    '''
+    from geopandas import GeoDataFrame
+
+    gdf = GeoDataFrame.from_file(path)
+    if id_column is not None:
+        gdf = gdf.set_index(id_column)
+    key = '%s-%s' % (file_hash(path), id_column or 'index')
+    return get_region_weights(lat, lon, list(gdf.geometry), gdf.index.values,
+                              key=key, region_dim=region_dim)
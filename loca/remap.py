@@ -0,0 +1,185 @@
+'''Conservative remapping between regular lat/lon grids with cached weights
+
+Every 1/16th degree file shares one grid, so the conservative (area
+weighted) interpolation weights to the 1/8th degree grid only need to be
+computed once. ``RemapWeights`` stores them as a sparse
+``(n_dst_cells, n_src_cells)`` matrix, cached on disk by source and
+destination grid, and applies them as one sparse matrix product per chunk.
+Like ``cdo remapcon`` (with ``fracarea`` normalization), destination cells
+are the area weighted mean of the valid source cells they overlap.
+'''
+import os
+import threading
+
+import numpy as np
+import scipy.sparse as sp
+import xarray as xr
+
+from .regions import _cell_edges, grid_hash
+from .utils import get_cache_dir
+
+LAT_NAMES = ['lat', 'latitude', 'Lat']
+LON_NAMES = ['lon', 'longitude', 'Lon']
+
+
+def _overlap_matrix(src_edges, dst_edges):
+    '''overlap length of every (dst, src) pair of 1D cells'''
+    s0 = np.minimum(src_edges[:-1], src_edges[1:])
+    s1 = np.maximum(src_edges[:-1], src_edges[1:])
+    d0 = np.minimum(dst_edges[:-1], dst_edges[1:])[:, np.newaxis]
+    d1 = np.maximum(dst_edges[:-1], dst_edges[1:])[:, np.newaxis]
+    overlap = np.minimum(s1, d1) - np.maximum(s0, d0)
+    return sp.csr_matrix(np.clip(overlap, 0, None))
+
+
+def coarsen_grid(lat, lon, factor=2):
+    '''cell centers of a grid made by merging factor x factor cells'''
+    def _coarsen(x):
+        n = len(x) // factor * factor
+        return np.asarray(x[:n], dtype='f8').reshape(-1, factor).mean(axis=1)
+    return _coarsen(lat), _coarsen(lon)
+
+
+def read_grid(gridfile):
+    '''lat/lon cell centers of a netCDF grid/domain file'''
+    with xr.open_dataset(gridfile) as ds:
+        lat = next(ds[n].values for n in LAT_NAMES if n in ds.variables)
+        lon = next(ds[n].values for n in LON_NAMES if n in ds.variables)
+    return lat, lon
+
+
+def _spatial_dims(obj):
+    lat = next(n for n in LAT_NAMES if n in obj.dims)
+    lon = next(n for n in LON_NAMES if n in obj.dims)
+    return lat, lon
+
+
+class RemapWeights(object):
+    '''Sparse conservative remapping weights between two regular grids'''
+
+    def __init__(self, matrix, src_lat, src_lon, dst_lat, dst_lon):
+        self.matrix = sp.csr_matrix(matrix)
+        self.src_lat, self.src_lon = np.asarray(src_lat), np.asarray(src_lon)
+        self.dst_lat, self.dst_lon = np.asarray(dst_lat), np.asarray(dst_lon)
+
+    def __repr__(self):
+        return '<RemapWeights: %dx%d -> %dx%d grid, %d weights>' % (
+            self.src_lat.size, self.src_lon.size, self.dst_lat.size,
+            self.dst_lon.size, self.matrix.nnz)
+
+    @classmethod
+    def conservative(cls, src_lat, src_lon, dst_lat, dst_lon):
+        '''compute area weighted overlaps (on the sphere) of the two grids'''
+        def sin_edges(lat):
+            return np.sin(np.deg2rad(np.clip(_cell_edges(lat), -90, 90)))
+
+        wlat = _overlap_matrix(sin_edges(src_lat), sin_edges(dst_lat))
+        wlon = _overlap_matrix(_cell_edges(src_lon), _cell_edges(dst_lon))
+        return cls(sp.kron(wlat, wlon, format='csr'), src_lat, src_lon,
+                   dst_lat, dst_lon)
+
+    def save(self, path):
+        m = self.matrix.tocoo()
+        tmp = '%s.%d.%d.tmp.npz' % (path[:-4], os.getpid(),
+                                    threading.get_ident())
+        np.savez_compressed(tmp, row=m.row, col=m.col, data=m.data,
+                            shape=m.shape, src_lat=self.src_lat,
+                            src_lon=self.src_lon, dst_lat=self.dst_lat,
+                            dst_lon=self.dst_lon)
+        os.replace(tmp, path)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as f:
+            matrix = sp.coo_matrix((f['data'], (f['row'], f['col'])),
+                                   shape=tuple(f['shape']))
+            return cls(matrix, f['src_lat'], f['src_lon'], f['dst_lat'],
+                       f['dst_lon'])
+
+    def _matmul(self, block):
+        '''remap a numpy block whose last two axes are (lat, lon)'''
+        lead = block.shape[:-2]
+        x = block.reshape(-1, block.shape[-2] * block.shape[-1]).T
+        valid = ~np.isnan(x)
+        total = self.matrix @ np.where(valid, x, 0)
+        weight = self.matrix @ valid.astype(total.dtype)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            out = np.where(weight > 0, total / weight, np.nan)
+        out = out.T.reshape(lead + (self.dst_lat.size, self.dst_lon.size))
+        return out.astype(np.result_type(block.dtype, np.float32))
+
+    def remap(self, obj):
+        '''lazily remap a DataArray or Dataset to the destination grid'''
+        if isinstance(obj, xr.Dataset):
+            lat, lon = _spatial_dims(obj)
+            out = xr.Dataset(attrs=obj.attrs)
+            for name, da in obj.data_vars.items():
+                if lat in da.dims and lon in da.dims:
+                    out[name] = self.remap(da)
+                elif lat not in da.dims and lon not in da.dims:
+                    out[name] = da
+            return out
+
+        lat, lon = _spatial_dims(obj)
+        if obj.chunks is not None:
+            obj = obj.chunk({lat: -1, lon: -1})
+        dtype = np.result_type(obj.dtype, np.float32)
+        out = xr.apply_ufunc(self._matmul, obj,
+                             input_core_dims=[[lat, lon]],
+                             output_core_dims=[['__lat__', '__lon__']],
+                             dask='parallelized', output_dtypes=[dtype],
+                             dask_gufunc_kwargs=dict(output_sizes={
+                                 '__lat__': self.dst_lat.size,
+                                 '__lon__': self.dst_lon.size}),
+                             keep_attrs=True)
+        out = out.rename({'__lat__': lat, '__lon__': lon})
+        out.coords[lat] = self.dst_lat
+        out.coords[lon] = self.dst_lon
+        return out
+
+
+def get_remap_weights(src_lat, src_lon, dst_lat, dst_lon):
+    '''return cached conservative weights between two grids'''
+    path = os.path.join(get_cache_dir('remap'), '%s-%s.npz' % (
+        grid_hash(src_lat, src_lon), grid_hash(dst_lat, dst_lon)))
+    if os.path.isfile(path):
+        return RemapWeights.load(path)
+    weights = RemapWeights.conservative(src_lat, src_lon, dst_lat, dst_lon)
+    weights.save(path)
+    return weights
+
+
+def remap_dataset(ds, gridfile=None, factor=2, grid=None):
+    '''lazily remap ds to the grid in gridfile
+
+    ``grid`` gives the destination ``(lat, lon)`` cell centers directly.
+    Without either the destination grid merges ``factor`` x ``factor``
+    source cells (e.g. 1/16th -> 1/8th degree).
+    '''
+    lat, lon = _spatial_dims(ds)
+    if grid is not None:
+        dst_lat, dst_lon = grid
+    elif gridfile is None:
+        dst_lat, dst_lon = coarsen_grid(ds[lat].values, ds[lon].values,
+                                        factor=factor)
+    else:
+        dst_lat, dst_lon = read_grid(gridfile)
+    weights = get_remap_weights(ds[lat].values, ds[lon].values,
+                                dst_lat, dst_lon)
+    return weights.remap(ds)
+
+
+def remap_file(infile, outfile, gridfile=None, force=False):
+    '''remap one netCDF file, skipping outputs newer than their input
+
+    Returns True if outfile was (re)written.
+    '''
+    exists = not force and os.path.isfile(outfile)
+    if exists and os.path.getmtime(outfile) >= os.path.getmtime(infile):
+        return False
+    with xr.open_dataset(infile) as ds:
+        out = remap_dataset(ds, gridfile=gridfile).load()
+    tmp = '%s.%d.tmp' % (outfile, os.getpid())
+    out.to_netcdf(tmp)
+    os.replace(tmp, outfile)
+    return True
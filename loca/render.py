@@ -0,0 +1,274 @@
+'''Batch rendering of figures made of grids of map panels
+
+The analysis figures are grids of maps (models by dataset by scenario).
+Drawing them panel by panel with ``DataArray.plot.pcolormesh`` loads every
+panel separately and rasterizes full resolution grids in the notebook
+process. Here the panels of a figure, or of a whole set of figures, are
+
+1. coarsened (lazily, with a NaN-skipping mean) to the resolution they are
+   displayed at,
+2. computed in one ``dask.compute`` call, so shared inputs are read once and
+   only display-sized arrays are gathered,
+3. drawn with the Agg backend, one figure per process of a process pool.
+
+Example
+-------
+>>> fields = {(d, m): calc_change(hist[d][var].sel(gcm=m),
+...                               rcp[d][var].sel(gcm=m), pct=True)
+...           for d in ['bcsd', 'loca'] for m in models}
+>>> spec = FigureSpec([[(d, m) for d in ['bcsd', 'loca']] for m in models],
+...                   col_titles=['BCSD', 'LOCA'], row_labels=models,
+...                   vmin=-25, vmax=25, cmap='RdBu')
+>>> render_all(fields, {'pct_change': spec}, 'figs')
+{'pct_change': 'figs/pct_change.png'}
+'''
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from math import ceil
+
+import dask
+import numpy as np
+from dask.system import CPU_COUNT
+
+from .cells import CELL_DIM, unpack
+from .instrument import instrument
+
+DEFAULT_DPI = 150
+
+# keyword arguments that go to the colorbar rather than to pcolormesh
+_COLORBAR_KWS = ('extend', 'label')
+
+
+class Panel(object):
+    '''one map of a figure
+
+    Parameters
+    ----------
+    key : hashable
+        Key of the field (in the ``fields`` passed to ``render``) to draw
+    title : str, optional
+        Title of the panel, defaults to the column title in the first row
+    kwargs :
+        pcolormesh (``vmin``, ``vmax``, ``cmap``, ...) and colorbar
+        (``extend``, ``label``) arguments, added to those of the figure
+    '''
+
+    def __init__(self, key, title=None, **kwargs):
+        self.key = key
+        self.title = title
+        self.kwargs = kwargs
+
+    def __repr__(self):
+        return '<Panel %r>' % (self.key, )
+
+
+class FigureSpec(object):
+    '''layout and labels of one figure
+
+    Parameters
+    ----------
+    layout : list of lists
+        Rows of panels; each panel is a ``Panel``, a field key, or None for
+        an empty (removed) axis
+    col_titles, row_labels : list of str, optional
+        Titles of the columns (on the first row) and labels of the rows (on
+        the first column)
+    suptitle : str, optional
+        Title of the figure
+    figsize : tuple, optional
+        Defaults to 11 inches wide and 1.5 inches per row
+    colorbar : {'panel', 'figure', None}
+        A colorbar for every panel, one for the figure or none
+    kwargs :
+        Default pcolormesh and colorbar arguments of every panel
+    '''
+
+    def __init__(self, layout, col_titles=None, row_labels=None,
+                 suptitle=None, figsize=None, colorbar='panel', **kwargs):
+        self.layout = [[p if p is None or isinstance(p, Panel) else Panel(p)
+                        for p in row] for row in layout]
+        self.nrows = len(self.layout)
+        self.ncols = max(len(row) for row in self.layout)
+        self.col_titles = col_titles
+        self.row_labels = row_labels
+        self.suptitle = suptitle
+        self.figsize = figsize or (11, 1.5 * self.nrows)
+        self.colorbar = colorbar
+        self.kwargs = kwargs
+
+    def __repr__(self):
+        return '<FigureSpec %dx%d>' % (self.nrows, self.ncols)
+
+    def panels(self):
+        '''(row, col, panel) of every panel'''
+        for i, row in enumerate(self.layout):
+            for j, panel in enumerate(row):
+                if panel is not None:
+                    yield i, j, panel
+
+    def panel_pixels(self, dpi=DEFAULT_DPI):
+        '''approximate (height, width) of one panel in pixels'''
+        return (self.figsize[1] * dpi / self.nrows,
+                self.figsize[0] * dpi / self.ncols)
+
+
+def display_factor(shape, pixels):
+    '''coarsening factor that brings a (lat, lon) shape to about pixels'''
+    return max(1, *[int(ceil(n / max(p, 1))) for n, p in zip(shape, pixels)])
+
+
+def _coarsen(da, pixels):
+    '''lazily coarsen a map to about pixels, missing cells are skipped'''
+    if CELL_DIM in da.dims:
+        da = unpack(da)
+    da = da.squeeze(drop=True)
+    if set(da.dims) != {'lat', 'lon'}:
+        raise ValueError('panels must be (lat, lon) maps, got dims %s'
+                         % (da.dims, ))
+    da = da.transpose('lat', 'lon')
+    factor = display_factor(da.shape, pixels)
+    if factor > 1:
+        da = da.coarsen(lat=factor, lon=factor, boundary='pad').mean()
+    return da
+
+
+@instrument(kind='analysis')
+def gather(fields, specs, dpi=DEFAULT_DPI):
+    '''compute the display resolution data of every panel of specs at once
+
+    Returns ``{key: (lat, lon, values)}`` of numpy arrays. A field used by
+    several figures is coarsened to the finest resolution it is shown at.
+    '''
+    pixels = {}
+    for spec in specs:
+        px = spec.panel_pixels(dpi)
+        for _, _, panel in spec.panels():
+            old = pixels.get(panel.key, (0, 0))
+            pixels[panel.key] = (max(old[0], px[0]), max(old[1], px[1]))
+
+    keys = list(pixels)
+    missing = [k for k in keys if k not in fields]
+    if missing:
+        raise KeyError('no fields for panels %s' % missing)
+    maps = dask.compute(*[_coarsen(fields[k], pixels[k]) for k in keys])
+    return {k: (da['lat'].values, da['lon'].values, np.asarray(da.values))
+            for k, da in zip(keys, maps)}
+
+
+def draw(spec, data, fig=None):
+    '''draw a figure from gathered data, returns a matplotlib Figure
+
+    Draws into ``fig`` if given, otherwise into a new pyplot figure.
+    '''
+    if fig is None:
+        import matplotlib.pyplot as plt
+        fig = plt.figure(figsize=spec.figsize)
+
+    axes = fig.subplots(nrows=spec.nrows, ncols=spec.ncols, sharex=True,
+                        sharey=True, squeeze=False)
+    mesh = None
+    for i in range(spec.nrows):
+        for j in range(spec.ncols):
+            row = spec.layout[i]
+            panel = row[j] if j < len(row) else None
+            ax = axes[i, j]
+            if panel is None:
+                fig.delaxes(ax)
+                continue
+            kws = dict(spec.kwargs, **panel.kwargs)
+            cbar_kws = {k: kws.pop(k) for k in _COLORBAR_KWS if k in kws}
+            lat, lon, values = data[panel.key]
+            mesh = ax.pcolormesh(lon, lat, np.ma.masked_invalid(values),
+                                 shading='auto', **kws)
+            if spec.colorbar == 'panel':
+                fig.colorbar(mesh, ax=ax, **cbar_kws)
+
+            title = panel.title
+            if title is None and i == 0 and spec.col_titles:
+                title = spec.col_titles[j]
+            if title:
+                ax.set_title(title)
+            if j == 0 and spec.row_labels:
+                ax.set_ylabel(spec.row_labels[i])
+
+    if spec.colorbar != 'figure':
+        fig.tight_layout()
+    if spec.colorbar == 'figure' and mesh is not None:
+        cbar_kws = {k: spec.kwargs[k] for k in _COLORBAR_KWS
+                    if k in spec.kwargs}
+        fig.colorbar(mesh, ax=list(fig.axes), **cbar_kws)
+    if spec.suptitle:
+        fig.suptitle(spec.suptitle, fontsize=16, y=1)
+    return fig
+
+
+def _draw_to_file(spec, data, path, dpi):
+    '''draw one figure and write it to path
+
+    The figure gets its own Agg canvas rather than going through pyplot, so
+    the caller's backend and figure list are untouched when this runs in
+    process.
+    '''
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    from matplotlib.figure import Figure
+
+    fig = Figure(figsize=spec.figsize)
+    FigureCanvasAgg(fig)
+    draw(spec, data, fig=fig)
+    fig.savefig(path, dpi=dpi, bbox_inches='tight')
+    return path
+
+
+def render(fields, spec, path=None, dpi=DEFAULT_DPI):
+    '''gather and draw one figure in this process
+
+    Returns the matplotlib Figure, which is also written to path if given.
+    '''
+    fig = draw(spec, gather(fields, [spec], dpi=dpi))
+    if path is not None:
+        fig.savefig(path, dpi=dpi, bbox_inches='tight')
+    return fig
+
+
+@instrument(kind='analysis')
+def render_all(fields, specs, outdir, dpi=DEFAULT_DPI, fmt='png',
+               processes=None):
+    '''gather the panels of many figures at once and draw them in parallel
+
+    Parameters
+    ----------
+    fields : dict
+        Maps panel keys to (lazy or computed) (lat, lon) DataArrays, or
+        packed ``cell`` DataArrays
+    specs : dict
+        Maps a figure name to its ``FigureSpec``
+    outdir : str
+        Directory the figures are written to, as ``<name>.<fmt>``
+    processes : int, optional
+        Size of the process pool, defaults to one process per figure up to
+        the number of cores
+
+    Returns
+    -------
+    paths : dict
+        Maps figure names to the files written
+    '''
+    os.makedirs(outdir, exist_ok=True)
+    data = gather(fields, list(specs.values()), dpi=dpi)
+    jobs = {}
+    for name, spec in specs.items():
+        keys = {panel.key for _, _, panel in spec.panels()}
+        jobs[name] = (spec, {k: data[k] for k in keys},
+                      os.path.join(outdir, '%s.%s' % (name, fmt)), dpi)
+
+    processes = min(processes or CPU_COUNT, len(jobs))
+    if processes <= 1:
+        return {name: _draw_to_file(*job) for name, job in jobs.items()}
+    # spawn: the workers need none of the threads (dask, client) of the caller
+    context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(max_workers=processes,
+                             mp_context=context) as pool:
+        futures = {name: pool.submit(_draw_to_file, *job)
+                   for name, job in jobs.items()}
+        return {name: f.result() for name, f in futures.items()}
@@ -0,0 +1,233 @@
+'''Single-pass resampling of all variables to several frequencies at once
+
+``resample_dataset`` computes the sums/means of every variable for every
+requested frequency (e.g. ``'MS'``, ``'AS'``, ``'A-OCT'``, ``'7D'``) from one
+pass over each input time chunk. Group boundaries are computed once from the
+time coordinate; each chunk is reduced with ``np.add.reduceat`` into partial
+sums and counts for every group it touches, and the (small) partials are
+combined afterwards, one window of adjacent chunks at a time. Results match
+``xr.Dataset.resample`` (nan-skipping sums, means, maxima and minima, NaN for
+empty groups) without building a graph per variable and frequency.
+'''
+import dask.array as da
+import numpy as np
+import xarray as xr
+
+from .precision import ACCUMULATOR
+
+
+def group_boundaries(time, freq, dim='time'):
+    '''return the group labels and the group id of every time step
+
+    Parameters
+    ----------
+    time : xr.DataArray
+        Monotonically increasing time coordinate
+    freq : str
+        Resampling frequency
+
+    Returns
+    -------
+    labels : xr.DataArray
+        Time coordinate of the resampled data
+    gid : np.ndarray
+        Integer group (index into labels) of every time step
+    '''
+    ones = xr.DataArray(np.ones(time.size, dtype='i1'), dims=dim,
+                        coords={dim: time.values})
+    counts = ones.resample({dim: freq}).count()
+    # empty groups come back as NaN
+    sizes = np.nan_to_num(counts.values).astype(int)
+    gid = np.repeat(np.arange(counts.size), sizes)
+    return counts[dim], gid
+
+
+def _segments(gid):
+    '''start positions and group ids of the runs of equal values in gid'''
+    if gid.size == 0:
+        return np.zeros(0, dtype=int), gid
+    starts = np.flatnonzero(np.diff(gid)) + 1
+    starts = np.concatenate([[0], starts])
+    return starts, gid[starts]
+
+
+# ufunc used to reduce the values of each group (NaNs are skipped)
+_REDUCERS = {'sum': np.add, 'mean': np.add, 'max': np.fmax, 'min': np.fmin}
+
+
+def _partials(block, gids, axis, how='sum'):
+    '''partial reductions and counts of block for every frequency
+
+    Returns one array holding ``[stat_f0, count_f0, stat_f1, count_f1, ...]``
+    concatenated along ``axis``.
+    '''
+    valid = ~np.isnan(block)
+    if how in ('sum', 'mean'):
+        values = np.where(valid, block, 0).astype(ACCUMULATOR)
+    else:
+        values = block.astype(ACCUMULATOR)
+    reducer = _REDUCERS[how]
+    out = []
+    for gid in gids:
+        starts, _ = _segments(gid)
+        out.append(reducer.reduceat(values, starts, axis=axis))
+        out.append(np.add.reduceat(valid, starts, axis=axis).astype(
+            ACCUMULATOR))
+    return np.concatenate(out, axis=axis)
+
+
+def _combine(partials, seg_gid, ngroups, how, axis, dtype):
+    '''reduce partial stats/counts of each group and fill empty groups'''
+    n = partials.shape[axis] // 2
+    sums = np.take(partials, np.arange(n), axis=axis)
+    counts = np.take(partials, np.arange(n, 2 * n), axis=axis)
+    starts, gids = _segments(seg_gid)
+    sums = _REDUCERS[how].reduceat(sums, starts, axis=axis)
+    counts = np.add.reduceat(counts, starts, axis=axis)
+
+    shape = list(partials.shape)
+    shape[axis] = ngroups
+    out = np.full(shape, np.nan)
+    index = [slice(None)] * len(shape)
+    index[axis] = gids
+    if how == 'sum':
+        out[tuple(index)] = sums
+    elif how in ('max', 'min'):
+        out[tuple(index)] = np.where(counts > 0, sums, np.nan)
+    else:
+        with np.errstate(invalid='ignore', divide='ignore'):
+            out[tuple(index)] = np.where(counts > 0, sums / counts, np.nan)
+    return out.astype(dtype)
+
+
+def _resample_array(data, axis, gids, ngroups, how):
+    '''resample one (numpy or dask) array to every frequency in gids'''
+    dtype = np.result_type(data.dtype, np.float32)
+
+    if not isinstance(data, da.Array):
+        partials = _partials(data, gids, axis, how)
+        out, offset = [], 0
+        for gid, n in zip(gids, ngroups):
+            starts, seg_gid = _segments(gid)
+            p = np.take(partials, np.arange(offset, offset + 2 * starts.size),
+                        axis=axis)
+            offset += 2 * starts.size
+            out.append(_combine(p, seg_gid, n, how, axis, dtype))
+        return out
+
+    # the number of segments each frequency has in each time chunk
+    bounds = np.cumsum((0,) + data.chunks[axis])
+    nsegs = [[len(_segments(gid[a:b])[0]) for a, b in
+              zip(bounds[:-1], bounds[1:])] for gid in gids]
+
+    def block_partials(block, block_info=None):
+        a, b = block_info[0]['array-location'][axis]
+        return _partials(block, [gid[a:b] for gid in gids], axis, how)
+
+    out_chunks = list(data.chunks)
+    out_chunks[axis] = tuple(sum(2 * ns[i] for ns in nsegs)
+                             for i in range(len(bounds) - 1))
+    partials = data.map_blocks(block_partials, chunks=tuple(out_chunks),
+                               dtype=ACCUMULATOR,
+                               meta=np.array((), dtype=ACCUMULATOR))
+
+    out = []
+    chunk_offsets = np.cumsum((0,) + out_chunks[axis])
+    for f, (gid, n) in enumerate(zip(gids, ngroups)):
+        # position of the stat/count partial and group of every segment
+        sum_pos, cnt_pos, seg_gid = [], [], []
+        for i, (a, b) in enumerate(zip(bounds[:-1], bounds[1:])):
+            start = chunk_offsets[i] + sum(2 * ns[i] for ns in nsegs[:f])
+            m = nsegs[f][i]
+            sum_pos.append(np.arange(start, start + m))
+            cnt_pos.append(np.arange(start + m, start + 2 * m))
+            seg_gid.append(_segments(gid[a:b])[1])
+        sum_pos = np.concatenate(sum_pos)
+        cnt_pos = np.concatenate(cnt_pos)
+        seg_gid = np.concatenate(seg_gid)
+
+        # combine window by window: each window holds the groups that start
+        # in one input chunk (plus any empty groups that follow them) and
+        # only the segments of those groups, so no step ever gathers the
+        # partials of the whole time axis
+        first = np.flatnonzero(np.diff(seg_gid, prepend=-1))
+        seg_chunk = np.repeat(np.arange(len(bounds) - 1), nsegs[f])
+        owners = first[np.diff(seg_chunk[first], prepend=-1) != 0]
+        seg_bounds = np.append(owners, seg_gid.size)
+        group_bounds = np.append(seg_gid[owners], n)
+
+        index, sizes, windows = [], [], []
+        for s0, s1, g0, g1 in zip(seg_bounds[:-1], seg_bounds[1:],
+                                  group_bounds[:-1], group_bounds[1:]):
+            index.extend([sum_pos[s0:s1], cnt_pos[s0:s1]])
+            sizes.append(2 * (s1 - s0))
+            windows.append((seg_gid[s0:s1] - g0, g1 - g0))
+        p = da.take(partials, np.concatenate(index), axis=axis)
+        p = p.rechunk({axis: tuple(sizes)})
+
+        def combine(block, block_info=None, windows=windows):
+            w_gid, w_n = windows[block_info[0]['chunk-location'][axis]]
+            return _combine(block, w_gid, w_n, how, axis, dtype)
+
+        res_chunks = list(p.chunks)
+        res_chunks[axis] = tuple(w_n for _, w_n in windows)
+        out.append(p.map_blocks(combine, chunks=tuple(res_chunks),
+                                dtype=dtype, meta=np.array((), dtype=dtype)))
+    return out
+
+
+def resample_dataset(ds, freqs=('MS', ), how=None, dim='time'):
+    '''resample every variable in ds to every frequency in freqs
+
+    Parameters
+    ----------
+    ds : xr.Dataset
+        Dataset with a monotonically increasing time coordinate
+    freqs : sequence of str
+        Resampling frequencies, e.g. ``('MS', 'AS', 'A-OCT', '7D')``
+    how : str, callable or dict, optional
+        Maps a variable name to ``'sum'``, ``'mean'``, ``'max'`` or
+        ``'min'``; variables default to ``'mean'``. A string applies to all
+        variables.
+    dim : str
+        Name of the time dimension
+
+    Returns
+    -------
+    out : dict
+        Maps each frequency to the resampled dataset
+    '''
+    freqs = list(freqs)
+    if not ds.indexes[dim].is_monotonic_increasing:
+        raise ValueError('time must be monotonically increasing to resample')
+    if how is None:
+        how = {}
+    if isinstance(how, str):
+        how = dict.fromkeys(ds.data_vars, how)
+    if isinstance(how, dict):
+        rules = how
+        how = lambda name: rules.get(name, 'mean')
+
+    groups = [group_boundaries(ds[dim], freq, dim=dim) for freq in freqs]
+    labels = [g[0] for g in groups]
+    gids = [g[1] for g in groups]
+    ngroups = [label.size for label in labels]
+
+    out = {freq: xr.Dataset(attrs=ds.attrs) for freq in freqs}
+    for name, var in ds.data_vars.items():
+        if dim not in var.dims:
+            for freq in freqs:
+                out[freq][name] = var
+            continue
+        axis = var.dims.index(dim)
+        results = _resample_array(var.data, axis, gids, ngroups, how(name))
+        for freq, label, data in zip(freqs, labels, results):
+            coords = {k: v for k, v in var.coords.items()
+                      if dim not in v.dims}
+            coords[dim] = label.values
+            out[freq][name] = xr.DataArray(data, dims=var.dims,
+                                           coords=coords, attrs=var.attrs)
+
+    for freq in freqs:
+        out[freq][dim].attrs.update(ds[dim].attrs)
+    return out
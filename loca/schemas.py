@@ -0,0 +1,216 @@
+'''Declarative per-source harmonization of names and units
+
+LOCA, BCSD, Maurer and Livneh each name their coordinates, variables and
+units differently. ``SCHEMAS`` records for every source how to map it onto
+the common names (``lat``, ``lon``, ``time``, ``pcp``, ``t_min``, ``t_max``,
+``t_mean``, ``total_runoff``, ...) and units:
+
+- coordinate renames and bound-variable drops are applied to each file as it
+  is opened (the files of one source do not always agree),
+- variable renames are applied once to the combined dataset and are
+  metadata-only,
+- variables are subset to what was asked for (plus the inputs of derived
+  variables) before anything is computed,
+- unit conversions and derived variables are single elementwise tasks per
+  chunk (one ``map_blocks`` layer each) rather than chains of dask
+  arithmetic, computed in the dtype of the precision policy (see
+  ``loca.precision``).
+'''
+from functools import partial
+
+import dask.array as dask_array
+import numpy as np
+import xarray as xr
+
+from .precision import cast, get_dtype
+
+KELVIN = 273.13
+SEC_PER_DAY = 86400
+
+BOUND_VARS = ['lon_bnds', 'lat_bnds', 'time_bnds', 'longitude_bnds',
+              'latitude_bnds']
+
+
+def _mean(a, b):
+    return (a + b) / 2.
+
+
+def _mean_k_to_c(a, b):
+    return (a + b) / 2. - KELVIN
+
+
+def _scale_offset(x, scale=1, offset=0):
+    return x * scale + offset
+
+
+def _cast_result(func, dtype, *args, **kwargs):
+    return np.asarray(func(*args, **kwargs)).astype(dtype, copy=False)
+
+
+def _elementwise(func, *arrays, **kwargs):
+    '''apply func to DataArrays with the same dims as one task per chunk
+
+    The result has the policy dtype (or that of the inputs), whatever the
+    constants in func would promote it to.
+    '''
+    dims = arrays[0].dims
+    arrays = [a.transpose(*dims) for a in arrays]
+    data = [a.data for a in arrays]
+    dtype = get_dtype() or np.result_type(*data)
+    func = partial(_cast_result, func, dtype, **kwargs)
+    if any(isinstance(d, dask_array.Array) for d in data):
+        out = dask_array.map_blocks(func, *data, dtype=dtype)
+    else:
+        out = func(*data)
+    return xr.DataArray(out, dims=dims, coords=arrays[0].coords)
+
+
+class Schema(object):
+    '''How to harmonize one source
+
+    Parameters
+    ----------
+    name : str
+        Source name (key in ``SCHEMAS``)
+    coords : dict, optional
+        Coordinate renames applied to every file; missing names are ignored
+    renames : dict, optional
+        Variable renames applied to the combined dataset
+    convert : dict, optional
+        Maps a (renamed) variable to ``(scale, offset, units)``
+    derived : dict, optional
+        Maps a variable to ``(inputs, func)``. It is computed from its inputs
+        unless the source already provides it.
+    keep : list, optional
+        Variables returned by default (all variables if None)
+    drop : list, optional
+        Variables dropped from every file
+    wrap_lon : bool
+        Convert longitudes in [0, 360) to [-180, 180)
+    '''
+
+    def __init__(self, name, coords=None, renames=None, convert=None,
+                 derived=None, keep=None, drop=BOUND_VARS, wrap_lon=False):
+        self.name = name
+        self.coords = coords or {}
+        self.renames = renames or {}
+        self.convert = convert or {}
+        self.derived = derived or {}
+        self.keep = keep
+        self.drop = list(drop)
+        self.wrap_lon = wrap_lon
+
+    def __repr__(self):
+        return '<Schema %s>' % self.name
+
+    def preprocess(self, ds):
+        '''per-file fixes: drop bounds, rename coordinates, wrap longitudes'''
+        drops = [v for v in self.drop if v in ds.variables]
+        if drops:
+            ds = ds.drop_vars(drops)
+        renames = {k: v for k, v in self.coords.items()
+                   if k in ds.variables or k in ds.dims}
+        if renames:
+            ds = ds.rename(renames)
+        if self.wrap_lon and 'lon' in ds.coords:
+            ds['lon'] = ds['lon'].where(ds['lon'] <= 180, ds['lon'] - 360)
+        return ds
+
+    # so that a schema can be passed as ``preprocess``
+    __call__ = preprocess
+
+    def outputs(self, ds, variables=None):
+        '''names of the variables apply would return for ds'''
+        if variables is not None:
+            return list(variables)
+        if self.keep is not None:
+            return list(self.keep)
+        names = [self.renames.get(k, k) for k in ds.data_vars]
+        for name, (inputs, _) in self.derived.items():
+            if name not in names and all(i in names for i in inputs):
+                names.append(name)
+        return names
+
+    def source_variables(self, variables):
+        '''names in the files of the variables needed to return variables'''
+        inverse = {v: k for k, v in self.renames.items()}
+        names = set()
+        for name in variables:
+            names.add(inverse.get(name, name))
+            if name in self.derived:
+                names.update(inverse.get(i, i) for i in self.derived[name][0])
+        return sorted(names)
+
+    def apply(self, ds, variables=None):
+        '''harmonize a dataset opened with ``preprocess``
+
+        Only the requested ``variables`` (default ``keep``, or everything)
+        and the inputs of the derived variables among them are renamed,
+        converted and computed, in the dtype of the precision policy.
+        '''
+        ds = self.preprocess(ds)
+        ds = ds.rename({k: v for k, v in self.renames.items()
+                        if k in ds.data_vars})
+        outputs = self.outputs(ds, variables)
+
+        needed = []
+        for name in outputs:
+            if name not in ds.data_vars and name in self.derived:
+                needed.extend(self.derived[name][0])
+            else:
+                needed.append(name)
+        missing = [n for n in needed if n not in ds.data_vars]
+        if missing:
+            raise KeyError('%s does not provide %s' % (self.name, missing))
+        ds = cast(ds[list(dict.fromkeys(needed))])
+
+        for name, (scale, offset, units) in self.convert.items():
+            if name in ds.data_vars:
+                attrs = dict(ds[name].attrs, units=units)
+                ds[name] = _elementwise(_scale_offset, ds[name], scale=scale,
+                                        offset=offset)
+                ds[name].attrs = attrs
+
+        for name in outputs:
+            if name not in ds.data_vars:
+                inputs, func = self.derived[name]
+                ds[name] = _elementwise(func, *[ds[i] for i in inputs])
+        return ds[outputs]
+
+
+def _schemas(*schemas):
+    return {s.name: s for s in schemas}
+
+
+_LATLON = {'latitude': 'lat', 'longitude': 'lon'}
+_MET = {'pr': 'pcp', 'tasmin': 't_min', 'tasmax': 't_max'}
+_TOTAL_RUNOFF = {'total_runoff': (('runoff', 'baseflow'), np.add)}
+_T_MEAN = {'t_mean': (('t_min', 't_max'), _mean)}
+
+SCHEMAS = _schemas(
+    Schema('loca_met', coords=_LATLON, renames=_MET,
+           convert={'pcp': (SEC_PER_DAY, 0, 'mm/d')},  # kg m-2 s-1 --> mm/d
+           derived={'t_mean': (('t_min', 't_max'), _mean_k_to_c)}),  # K --> C
+    Schema('loca_vic', coords=dict(_LATLON, Time='time'),
+           derived=_TOTAL_RUNOFF),
+    Schema('bcsd_met', coords=_LATLON, renames=_MET),
+    Schema('bcsd_met_mon', coords=_LATLON, renames=dict(_MET, tas='t_mean')),
+    Schema('bcsd_vic', coords=_LATLON,
+           renames={'total runoff': 'total_runoff'}),
+    Schema('bcsd_vic_mon', coords=_LATLON, renames={'et': 'ET', 'swe': 'SWE'}),
+    Schema('maurer_met', coords=_LATLON, renames=_MET, derived=_T_MEAN,
+           wrap_lon=True),
+    Schema('maurer_vic', coords=_LATLON,
+           renames={'et': 'ET', 'swe': 'SWE', 'surface_runoff': 'runoff'}),
+    Schema('livneh_met', coords=_LATLON,
+           renames={'Prec': 'pcp', 'Tmin': 't_min', 'Tmax': 't_max'},
+           derived=_T_MEAN, keep=['t_mean', 'pcp']),
+    Schema('livneh_vic', coords=dict(_LATLON, Lat='lat', Lon='lon',
+                                     Time='time'),
+           derived=_TOTAL_RUNOFF),
+)
+
+
+def harmonize(ds, source, variables=None):
+    '''rename, convert and derive the variables of a dataset from source'''
+    return SCHEMAS[source].apply(ds, variables=variables)
@@ -0,0 +1,24 @@
+import numpy as np
+import pandas as pd
+import pytest
+import xarray as xr
+
+from loca.extremes import calc_7ro10, calc_ro20yr
+
+
+@pytest.fixture
+def runoff():
+    time = pd.date_range('1980-10-01', '2000-09-30', freq='D')
+    rng = np.random.default_rng(0)
+    values = rng.gamma(2., 1., size=(time.size, 3, 4)).astype('f4')
+    return xr.DataArray(values, dims=('time', 'lat', 'lon'),
+                        coords={'time': time}, name='total_runoff')
+
+
+@pytest.mark.parametrize('func', [calc_ro20yr, calc_7ro10])
+def test_time_chunked_input(runoff, func):
+    # one chunk per (yearly) file, as returned by the loaders
+    expected = func(runoff, freq='YS-OCT')
+    actual = func(runoff.chunk({'time': 365}), freq='YS-OCT')
+    assert actual.chunks is not None
+    np.testing.assert_allclose(actual.values, expected.values, rtol=1e-5)
@@ -1,21 +1,164 @@
+'''Provision dask clusters from named profiles
 
-from dask.distributed import Client
-from dask_jobqueue import PBSCluster
+``dask_distributed_setup('cheyenne')`` starts a PBS cluster on Cheyenne,
+``dask_distributed_setup('local')`` a ``LocalCluster`` on any machine.
+Clusters scale adaptively; ``scale_for_graph`` bounds the number of workers
+by the size of the graph about to be computed. Worker memory can be derived
+from the chunks of the data that will be computed, and the scheduler file
+is written so that notebooks can attach with ``connect()``.
+'''
+import os
+from math import ceil
 
+from dask.distributed import Client, LocalCluster
+from dask.utils import parse_bytes
+from dask.system import CPU_COUNT
+from distributed.system import MEMORY_LIMIT
 
+from .chunks import MEMORY_FRACTION, max_chunk_bytes
+
+SCHEDULER_FILE = os.environ.get(
+    'LOCA_SCHEDULER_FILE',
+    os.path.join(os.path.expanduser('~'), 'scheduler_file.json'))
+
+# tasks a thread is given before another worker is added
+TASKS_PER_THREAD = 100
+
+# memory of a worker derived from chunk sizes is at least this
+MIN_WORKER_MEMORY = 2 ** 30
+
+# PBSCluster keywords, memory is per job (shared by its processes)
 cheyenne_cluster = dict(queue='premium', interface='ib0', processes=18,
                         threads=4, memory="6GB", project='P48500028',
                         resource_spec='select=1:ncpus=36:mem=109G',
                         walltime='03:00:00')
 
+# LocalCluster keywords, memory is per worker process
+_LOCAL_THREADS = min(4, CPU_COUNT)
+local_cluster = dict(processes=max(CPU_COUNT // _LOCAL_THREADS, 1),
+                     threads=_LOCAL_THREADS,
+                     memory=MEMORY_LIMIT // max(CPU_COUNT // _LOCAL_THREADS,
+                                                1))
+
+
+def _pbs_cluster(**kwargs):
+    from dask_jobqueue import PBSCluster
+    return PBSCluster(**kwargs)
+
+
+def _local_cluster(processes=1, threads=1, memory='auto', **kwargs):
+    return LocalCluster(n_workers=processes, threads_per_worker=threads,
+                        memory_limit=memory, **kwargs)
+
+
+# name: (cluster factory, keywords, memory per job or worker, max workers)
+PROFILES = {
+    'cheyenne': (_pbs_cluster, cheyenne_cluster, 'job',
+                 4 * cheyenne_cluster['processes']),
+    'local': (_local_cluster, local_cluster, 'worker',
+              local_cluster['processes']),
+}
+
+
+def get_profile(name='cheyenne'):
+    '''cluster keywords of a profile in ``PROFILES``'''
+    try:
+        return PROFILES[name][1]
+    except KeyError:
+        raise NotImplementedError('unknown cluster profile %s, choose from %s'
+                                  % (name, list(PROFILES)))
+
+
+def worker_resources(name='cheyenne', profile=None):
+    '''(memory in bytes, threads) of one worker of a profile'''
+    _, defaults, per, _ = PROFILES[name]
+    profile = defaults if profile is None else profile
+    memory = profile.get('memory', MEMORY_LIMIT)
+    if isinstance(memory, str):
+        memory = parse_bytes(memory)
+    if per == 'job':
+        memory //= profile.get('processes', 1)
+    return memory, profile.get('threads', 1)
 
-def dask_distributed_setup(machine='cheyenne', cluster_kws={}, client_kws={}):
 
-    if machine == 'cheyenne':
-        cheyenne_cluster.update(cluster_kws)
-        cluster = PBSCluster(**cheyenne_cluster)
-        client = Client(cluster)
-    else:
-        raise NotImplementedError('only cheyenne is supported at this time')
+def worker_memory(chunk_bytes, threads=1):
+    '''memory a worker with threads needs to process chunks of chunk_bytes
 
+    The inverse of ``loca.chunks.chunk_budget``, at least
+    ``MIN_WORKER_MEMORY``.
+    '''
+    return max(int(ceil(chunk_bytes * threads / MEMORY_FRACTION)),
+               MIN_WORKER_MEMORY)
+
+
+def _graph_size(*objs):
+    return sum(len(obj.__dask_graph__()) for obj in objs
+               if obj.__dask_graph__() is not None)
+
+
+def scale_for_graph(cluster, *objs, minimum=1, maximum=None):
+    '''adapt the number of workers of cluster to the graphs of objs
+
+    The maximum number of workers is what it takes to give every thread
+    ``TASKS_PER_THREAD`` tasks (bounded by ``maximum``). Returns that
+    number.
+    '''
+    workers = cluster.scheduler_info.get('workers', {})
+    threads = max([w['nthreads'] for w in workers.values()] or [1])
+    n = max(int(ceil(_graph_size(*objs) / (threads * TASKS_PER_THREAD))),
+            minimum)
+    if maximum is not None:
+        n = min(n, maximum)
+    cluster.adapt(minimum=minimum, maximum=n)
+    return n
+
+
+def dask_distributed_setup(machine='cheyenne', cluster_kws={}, client_kws={},
+                           chunks=None, adapt=True, minimum=1, maximum=None,
+                           scheduler_file=SCHEDULER_FILE):
+    '''start a cluster from a profile in ``PROFILES`` and connect a client
+
+    Parameters
+    ----------
+    machine : str
+        Name of the profile, e.g. ``'cheyenne'`` or ``'local'``
+    cluster_kws, client_kws : dict
+        Keywords that update the profile and that are passed to ``Client``
+    chunks : Dataset, DataArray or int, optional
+        Data to be computed (or the size of its largest chunk in bytes); the
+        memory of the workers is set so that they can hold its chunks
+    adapt : bool
+        Scale adaptively between ``minimum`` and ``maximum`` workers
+        (defaults to the maximum of the profile)
+    scheduler_file : str
+        Where to write the scheduler address for ``connect`` (None to skip)
+
+    Returns
+    -------
+    cluster, client
+    '''
+    profile = dict(get_profile(machine), **cluster_kws)
+    factory, _, per, max_workers = PROFILES[machine]
+
+    if chunks is not None:
+        if not isinstance(chunks, int):
+            chunks = max_chunk_bytes(chunks)
+        memory = worker_memory(chunks, profile.get('threads', 1))
+        if per == 'job':
+            memory *= profile.get('processes', 1)
+        profile['memory'] = memory
+
+    cluster = factory(**profile)
+    client = Client(cluster, **client_kws)
+    if adapt:
+        cluster.adapt(minimum=minimum,
+                      maximum=max_workers if maximum is None else maximum)
+    if scheduler_file is not None:
+        client.write_scheduler_file(scheduler_file)
     return cluster, client
+
+
+def connect(scheduler_file=SCHEDULER_FILE, **kwargs):
+    '''connect a client to the cluster started by ``dask_distributed_setup``
+    (e.g. in the Dashboard notebook)'''
+    return Client(scheduler_file=scheduler_file, **kwargs)
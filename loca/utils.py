@@ -1,34 +1,134 @@
 
-from calendar import isleap, monthrange
+import os
+from functools import lru_cache
 
+import dask.array as dask_array
 import numpy as np
 import pandas as pd
 import xarray as xr
 
+from .instrument import instrument
+from .memo import memoize
+from .precision import cast
 
-def dpy_from_time_var(time_var):
-    '''return a data array with the number of days per year'''
-    index = time_var.indexes['time']
-    dpy = np.array([366 if isleap(y) else 365 for y in index.year])
+CACHE_DIR = os.environ.get('LOCA_CACHE_DIR',
+                           os.path.join(os.path.expanduser('~'), '.cache',
+                                        'loca'))
 
-    return xr.DataArray(dpy, coords=time_var.coords)
 
+def get_cache_dir(*subdirs):
+    '''return (and create) a directory inside the loca cache directory
 
-def dpm_from_time_var(time_var):
-    '''return a data array with the number of days per month'''
-    def dpm_from_index(index):
-        return np.array([monthrange(y, m)[1]
-                         for y, m in zip(index.year, index.month)])
+    The cache root defaults to ``~/.cache/loca`` and can be changed with the
+    ``LOCA_CACHE_DIR`` environment variable.
+    '''
+    path = os.path.join(CACHE_DIR, *subdirs)
+    os.makedirs(path, exist_ok=True)
+    return path
 
+
+# days per month in a non-leap year
+_DPM = np.array([31, 28, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31])
+
+_CALENDARS = {'standard': 'gregorian', 'gregorian': 'gregorian',
+              'proleptic_gregorian': 'gregorian', 'julian': 'julian',
+              'noleap': 'noleap', '365_day': 'noleap',
+              'all_leap': 'all_leap', '366_day': 'all_leap',
+              '360_day': '360_day'}
+
+
+@lru_cache(maxsize=32)
+def _dpm_table(calendar, first_year, last_year):
+    '''(year, month) lookup table of the days per month in a calendar'''
+    years = np.arange(first_year, last_year + 1)[:, np.newaxis]
+    kind = _CALENDARS.get(calendar)
+    if kind is None:
+        raise ValueError('unsupported calendar: %s' % calendar)
+
+    if kind == '360_day':
+        return np.full((years.size, 12), 30, dtype='i2')
+    if kind == 'noleap':
+        leap = np.zeros_like(years, dtype=bool)
+    elif kind == 'all_leap':
+        leap = np.ones_like(years, dtype=bool)
+    elif kind == 'julian':
+        leap = years % 4 == 0
+    else:
+        leap = (years % 4 == 0) & ((years % 100 != 0) | (years % 400 == 0))
+
+    table = np.tile(_DPM, (years.size, 1)).astype('i2')
+    table[:, 1] += leap[:, 0]
+    return table
+
+
+def _index_calendar(index):
+    '''calendar of a DatetimeIndex or CFTimeIndex'''
+    return getattr(index, 'calendar', 'standard')
+
+
+def _year_month(index):
+    return (np.asarray(index.year, dtype=int),
+            np.asarray(index.month, dtype=int))
+
+
+def _time_index(time_var):
     if isinstance(time_var, xr.DataArray):
-        dpm = xr.DataArray(dpm_from_index(time_var.indexes['time']),
-                           coords=time_var.coords)
-    elif isinstance(time_var, pd.Index):
-        dpm = pd.Series(dpm_from_index(time_var), index=time_var)
+        return time_var.to_index()
+    if isinstance(time_var, pd.Index):
+        return time_var
+    raise TypeError('time_var must be a DataArray or pandas Index, got %s'
+                    % type(time_var))
+
+
+def _wrap_weights(values, time_var, chunks, dtype=None):
+    '''return weights in the same container type as time_var'''
+    if dtype is not None:
+        values = values.astype(dtype)
+    if isinstance(time_var, pd.Index):
+        return pd.Series(values, index=time_var)
+    if chunks is not None:
+        values = dask_array.from_array(values, chunks=chunks)
+    return xr.DataArray(values, dims=time_var.dims, coords=time_var.coords)
+
+
+def dpy_from_time_var(time_var, chunks=None, dtype=None):
+    '''return a data array with the number of days per year
+
+    Supports all CF calendars. Pass ``chunks`` (e.g. the time chunks of the
+    data being weighted) to get dask-backed weights and ``dtype`` (e.g. that
+    of the data) to get floating point rather than integer weights.
+    '''
+    index = _time_index(time_var)
+    years, _ = _year_month(index)
+    if years.size == 0:
+        return _wrap_weights(np.zeros(0, dtype='i2'), time_var, chunks,
+                             dtype)
+    table = _dpm_table(_index_calendar(index), years.min(), years.max())
+    dpy = table.sum(axis=1)[years - years.min()]
+
+    return _wrap_weights(dpy, time_var, chunks, dtype)
+
+
+def dpm_from_time_var(time_var, chunks=None, dtype=None):
+    '''return a data array with the number of days per month
+
+    Supports all CF calendars. Pass ``chunks`` (e.g. the time chunks of the
+    data being weighted) to get dask-backed weights and ``dtype`` (e.g. that
+    of the data) to get floating point rather than integer weights.
+    '''
+    index = _time_index(time_var)
+    years, months = _year_month(index)
+    if years.size == 0:
+        return _wrap_weights(np.zeros(0, dtype='i2'), time_var, chunks,
+                             dtype)
+    table = _dpm_table(_index_calendar(index), years.min(), years.max())
+    dpm = table[years - years.min(), months - 1]
 
-    return dpm
+    return _wrap_weights(dpm, time_var, chunks, dtype)
 
 
+@instrument(kind='analysis')
+@memoize()
 def calc_change(hist_mean, rcp_mean, pct=False):
     '''calculate the change signal, if pct is True, return the percent change'''
 
@@ -37,4 +137,4 @@ def calc_change(hist_mean, rcp_mean, pct=False):
     else:
         diff = rcp_mean - hist_mean
 
-    return diff
+    return cast(diff)
@@ -0,0 +1,239 @@
+'''Cached metadata for multi-file datasets
+
+``xr.open_mfdataset`` opens the header of every file to discover coordinates
+and variables, which takes tens of minutes for the full LOCA ensemble. The
+functions here record the schema of each file once (coordinates, time values,
+variable dims, dtypes, attributes, on-disk chunking and the names each
+variable had before ``preprocess`` renamed it) and later build the same lazy
+dask-backed dataset straight from that cache. File headers are only read
+again for files that are new or whose size/mtime changed.
+'''
+import hashlib
+import os
+import pickle
+
+import dask.array as da
+import numpy as np
+from dask.base import tokenize
+import xarray as xr
+
+from .utils import get_cache_dir
+
+SCHEMA_VERSION = 1
+
+_SOURCE_NAME = '_loca_source_name'
+
+
+def _preprocess_name(preprocess):
+    if preprocess is None:
+        return ''
+    return '%s.%s' % (getattr(preprocess, '__module__', ''),
+                      getattr(preprocess, '__qualname__', repr(preprocess)))
+
+
+def _file_stat(f):
+    '''return (path, size, mtime) from a FileIndex record or a path'''
+    if isinstance(f, dict):
+        return f['path'], f['size'], f['mtime']
+    st = os.stat(f)
+    return f, st.st_size, st.st_mtime
+
+
+def read_file_schema(path, preprocess=None):
+    '''open one file and return a picklable description of its contents'''
+    with xr.open_dataset(path) as ds:
+        ds = ds.copy()
+        for name in ds.data_vars:
+            ds[name].attrs[_SOURCE_NAME] = name
+        if preprocess is not None:
+            ds = preprocess(ds)
+
+        coords = {}
+        for name, coord in ds.coords.items():
+            coords[name] = (coord.dims, coord.values, dict(coord.attrs))
+
+        data_vars = {}
+        for name, var in ds.data_vars.items():
+            attrs = dict(var.attrs)
+            source = attrs.pop(_SOURCE_NAME, None)
+            data_vars[name] = {'dims': var.dims, 'shape': var.shape,
+                               'dtype': var.dtype, 'attrs': attrs,
+                               'source': source,
+                               'chunksizes': var.encoding.get('chunksizes')}
+
+        return {'coords': coords, 'data_vars': data_vars,
+                'attrs': dict(ds.attrs), 'sizes': dict(ds.sizes)}
+
+
+class _LazyFileVariable(object):
+    '''array-like that reads (a slice of) one variable of one file'''
+
+    def __init__(self, path, info, preprocess=None):
+        self.path = path
+        self.source = info['source']
+        self.name = info['name']
+        self.shape = tuple(info['shape'])
+        self.dtype = np.dtype(info['dtype'])
+        self.ndim = len(self.shape)
+        self.preprocess = preprocess
+
+    def __getitem__(self, key):
+        with xr.open_dataset(self.path) as ds:
+            if self.source is not None:
+                var = ds[self.source]
+            else:
+                # variable was derived by preprocess, so we have to run it
+                var = self.preprocess(ds)[self.name]
+            return np.asarray(var.variable[key].values, dtype=self.dtype)
+
+
+class VirtualDatasetCache(object):
+    '''Schema cache for one collection of files (e.g. one model/scenario)'''
+
+    def __init__(self, files, preprocess=None, path=None):
+        self.files = [_file_stat(f) for f in files]
+        self.files.sort()
+        self.preprocess = preprocess
+        if path is None:
+            h = hashlib.sha1()
+            h.update(_preprocess_name(preprocess).encode())
+            for p, _, _ in self.files:
+                h.update(p.encode())
+            path = os.path.join(get_cache_dir('virtual'),
+                                '%s.pkl' % h.hexdigest()[:24])
+        self.path = path
+        self.schemas = self._load()
+
+    def _load(self):
+        try:
+            with open(self.path, 'rb') as f:
+                state = pickle.load(f)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            return {}
+        if state.get('version') != SCHEMA_VERSION:
+            return {}
+        return state['schemas']
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp = '%s.%d.tmp' % (self.path, os.getpid())
+        with open(tmp, 'wb') as f:
+            pickle.dump({'version': SCHEMA_VERSION, 'schemas': self.schemas},
+                        f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, self.path)
+
+    def update(self):
+        '''read the schema of any file that is new or has changed'''
+        schemas = {}
+        changed = False
+        for path, size, mtime in self.files:
+            cached = self.schemas.get(path)
+            if cached is not None and cached['stat'] == (size, mtime):
+                schemas[path] = cached
+                continue
+            schemas[path] = {'stat': (size, mtime),
+                             'schema': read_file_schema(path,
+                                                        self.preprocess)}
+            changed = True
+        changed = changed or set(schemas) != set(self.schemas)
+        self.schemas = schemas
+        if changed:
+            self.save()
+        return self
+
+    def to_dataset(self, chunks=None, concat_dim='time'):
+        '''build the lazy combined dataset from the cached schemas'''
+        self.update()
+        if not self.files:
+            raise OSError('no files to open')
+
+        schemas = [(p, self.schemas[p]['schema']) for p, _, _ in self.files]
+        first = schemas[0][1]
+
+        # group the files holding each variable and sort them along time
+        pieces = {}
+        for path, schema in schemas:
+            for name, info in schema['data_vars'].items():
+                pieces.setdefault(name, []).append((path, schema, info))
+
+        data_vars = {}
+        for name, items in pieces.items():
+            if concat_dim in items[0][2]['dims']:
+                items.sort(key=lambda x: _first_value(x[1], concat_dim))
+            else:
+                items = items[:1]
+            arrays, times = [], []
+            for path, schema, info in items:
+                info = dict(info, name=name)
+                arr = _LazyFileVariable(path, info, self.preprocess)
+                file_chunks = _chunks_for(info, chunks)
+                # the key must change with the block layout and whenever
+                # the file is rewritten, dask and memo tokens rely on it
+                size, mtime = self.schemas[path]['stat']
+                token = tokenize(path, name, file_chunks, size, mtime,
+                                 _preprocess_name(self.preprocess))
+                arrays.append(da.from_array(
+                    arr, chunks=file_chunks, name='virtual-%s' % token,
+                    lock=True, meta=np.array((), dtype=arr.dtype)))
+                if concat_dim in schema['coords']:
+                    times.append(schema['coords'][concat_dim][1])
+            dims = items[0][2]['dims']
+            if concat_dim in dims and len(arrays) > 1:
+                data = da.concatenate(arrays, axis=dims.index(concat_dim))
+            else:
+                data = arrays[0]
+
+            coords = {}
+            for dim in dims:
+                if dim == concat_dim and times:
+                    coords[dim] = np.concatenate(times)
+                elif dim in items[0][1]['coords']:
+                    coords[dim] = items[0][1]['coords'][dim][1]
+            data_vars[name] = xr.DataArray(data, dims=dims, coords=coords,
+                                           attrs=items[0][2]['attrs'],
+                                           name=name)
+
+        ds = xr.merge(list(data_vars.values()), join='outer',
+                      combine_attrs='override')
+        for name, (dims, values, attrs) in first['coords'].items():
+            if concat_dim in dims:
+                ds[name].attrs.update(attrs)
+            elif name in ds.coords:
+                ds[name].attrs.update(attrs)
+            else:
+                ds.coords[name] = xr.Variable(dims, values, attrs)
+        ds.attrs.update(first['attrs'])
+        return ds
+
+
+def _first_value(schema, dim):
+    values = schema['coords'].get(dim, (None, [0], None))[1]
+    return values[0] if len(values) else 0
+
+
+def _chunks_for(info, chunks):
+    '''translate an open_mfdataset chunks argument into per-axis chunks'''
+    if chunks is None:
+        return tuple(info['shape'])
+    if isinstance(chunks, dict):
+        return tuple(min(chunks.get(d, s), s) if chunks.get(d, s) != -1
+                     else s for d, s in zip(info['dims'], info['shape']))
+    return chunks
+
+
+def open_virtual_dataset(files, preprocess=None, chunks=None, cache_path=None):
+    '''open a list of files like ``xr.open_mfdataset`` using cached metadata
+
+    Parameters
+    ----------
+    files : list
+        Paths or ``FileIndex`` records (records avoid a ``stat`` per file)
+    preprocess : callable, optional
+        Same as in ``xr.open_mfdataset``; applied once per file when its
+        schema is recorded. Renames are remembered so that data reads go
+        straight to the source variables.
+    chunks : dict, optional
+        Dask chunks per dimension, defaults to one chunk per file.
+    '''
+    cache = VirtualDatasetCache(files, preprocess=preprocess, path=cache_path)
+    return cache.to_dataset(chunks=chunks)
@@ -0,0 +1,246 @@
+'''Analysis-ready Zarr copies of the harmonized archives
+
+The netCDF archives are thousands of yearly files chunked as one full grid
+per day, which suits neither time-series metrics (e.g. ``calc_7ro10``) nor
+maps. A ``ZarrStore`` holds one consolidated, chunked and compressed Zarr
+store per loader output in one of two chunk layouts:
+
+- ``'time'``: every chunk holds the full time series of a tile of grid cells
+- ``'space'``: every chunk holds the full grid for a run of time steps
+
+Stores are written region by region (one gcm and one band of latitudes or of
+time steps at a time) so that memory use is bounded. Finished regions are
+recorded in the store, an interrupted export resumes with the first missing
+region. Like ``AggregateStore``, a ``provenance.json`` records the source
+files so that stale stores can be detected.
+
+The sources hold the full grid of one day per chunk, so a ``'time'`` store
+is written in two passes: the data are first staged in an intermediate store
+chunked by runs of time steps and bands of latitudes, which reads every
+source chunk once, and each latitude band of the final store is then built
+from the staged chunks of that band only.
+'''
+import json
+import os
+import shutil
+from datetime import datetime
+
+import numpy as np
+import xarray as xr
+
+from .aggregates import source_fingerprint
+from .utils import get_cache_dir
+
+ZARR_VERSION = 1
+
+LAYOUTS = ('time', 'space')
+
+# target size of one (uncompressed) chunk and of one region written at once
+CHUNK_BYTES = 2 ** 25
+REGION_BYTES = 2 ** 30
+
+
+def layout_chunks(sizes, layout='time', itemsize=4, chunk_bytes=CHUNK_BYTES):
+    '''on-disk chunks for a dataset with dimension ``sizes``'''
+    if layout not in LAYOUTS:
+        raise ValueError('unknown layout %s, choose from %s'
+                         % (layout, LAYOUTS))
+    ntime = sizes.get('time', 1)
+    nlat, nlon = sizes.get('lat', 1), sizes.get('lon', 1)
+    n = max(chunk_bytes // itemsize, 1)
+
+    chunks = {d: 1 for d in sizes}  # e.g. one gcm per chunk
+    if layout == 'time':
+        tile = max(int(np.sqrt(n / ntime)), 1)
+        chunks.update(time=ntime, lat=min(tile, nlat), lon=min(tile, nlon))
+    else:
+        nsteps = max(n // (nlat * nlon), 1)
+        chunks.update(time=min(nsteps, ntime), lat=nlat, lon=nlon)
+    return {d: c for d, c in chunks.items() if d in sizes}
+
+
+def _regions(ds, chunks, layout, region_bytes):
+    '''index slices of the regions that are written one at a time'''
+    split = 'lat' if layout == 'time' else 'time'
+    if split not in ds.dims:
+        split = None
+
+    itemsize = max([v.dtype.itemsize for v in ds.data_vars.values()] or [4])
+    per_step = itemsize * len(ds.data_vars)
+    for dim, size in ds.sizes.items():
+        if dim not in (split, 'gcm'):
+            per_step *= size
+
+    regions = [{}]
+    if 'gcm' in ds.dims:
+        regions = [{'gcm': slice(g, g + 1)} for g in range(ds.sizes['gcm'])]
+    if split is None:
+        return regions
+
+    size = ds.sizes[split]
+    step = max(region_bytes // per_step // chunks[split], 1) * chunks[split]
+    return [dict(r, **{split: slice(i, min(i + step, size))})
+            for r in regions for i in range(0, size, step)]
+
+
+def _staging_chunks(ds, band, itemsize=4, chunk_bytes=CHUNK_BYTES):
+    '''chunks of the intermediate store of a ``'time'`` layout export'''
+    nlon = ds.sizes.get('lon', 1)
+    nsteps = max(chunk_bytes // (itemsize * band * nlon), 1)
+    chunks = {d: 1 for d in ds.dims}
+    chunks.update(time=min(nsteps, ds.sizes['time']), lat=band, lon=nlon)
+    return {d: c for d, c in chunks.items() if d in ds.dims}
+
+
+def _region_key(region):
+    return ','.join('%s=%d:%d' % (d, s.start, s.stop)
+                    for d, s in sorted(region.items()))
+
+
+class ZarrStore(object):
+    '''Chunked Zarr copy of one loader output
+
+    Parameters
+    ----------
+    name : str
+        Unique name of the loader output (see ``aggregates.store_name``)
+    sources : list
+        FileIndex records of the files the store is built from
+    layout : str
+        ``'time'`` or ``'space'`` (see ``layout_chunks``)
+    root : str, optional
+        Parent directory of the store, defaults to the loca cache directory
+    '''
+
+    def __init__(self, name, sources, layout='time', root=None):
+        if layout not in LAYOUTS:
+            raise ValueError('unknown layout %s, choose from %s'
+                             % (layout, LAYOUTS))
+        self.name = name
+        self.sources = list(sources)
+        self.layout = layout
+        if root is None:
+            root = get_cache_dir('zarr')
+        self.path = os.path.join(root, '%s.%s.zarr' % (name, layout))
+
+    def __repr__(self):
+        return '<ZarrStore %s>' % self.path
+
+    @property
+    def provenance_file(self):
+        return os.path.join(self.path, 'provenance.json')
+
+    @property
+    def progress_file(self):
+        return os.path.join(self.path, 'progress.json')
+
+    @property
+    def staging_path(self):
+        return '%s.staging' % self.path
+
+    def _read_json(self, path):
+        try:
+            with open(path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _write_json(self, path, obj):
+        tmp = '%s.%d.tmp' % (path, os.getpid())
+        with open(tmp, 'w') as f:
+            json.dump(obj, f)
+        os.replace(tmp, path)
+
+    @property
+    def provenance(self):
+        return self._read_json(self.provenance_file)
+
+    def exists(self):
+        '''True if a complete store exists (it may be stale)'''
+        prov = self.provenance
+        return prov is not None and prov.get('version') == ZARR_VERSION
+
+    def is_current(self):
+        '''True if the store is complete and the sources are unchanged'''
+        if not self.exists():
+            return False
+        fingerprint = source_fingerprint(self.sources)
+        return self.provenance['fingerprint'] == fingerprint
+
+    def open(self, chunks=None):
+        '''open the store (chunks default to the on-disk chunks)'''
+        return xr.open_zarr(self.path, chunks={} if chunks is None else chunks,
+                            consolidated=True)
+
+    def write(self, ds, region_bytes=REGION_BYTES, chunk_bytes=CHUNK_BYTES):
+        '''write ds to the store one region at a time
+
+        Regions finished by an earlier (interrupted) call for the same
+        sources are skipped. Returns the number of regions written.
+        '''
+        fingerprint = source_fingerprint(self.sources)
+        itemsizes = [v.dtype.itemsize for v in ds.data_vars.values()]
+        itemsize = max(itemsizes or [4])
+        chunks = layout_chunks(ds.sizes, self.layout, itemsize=itemsize,
+                               chunk_bytes=chunk_bytes)
+        regions = _regions(ds, chunks, self.layout, region_bytes)
+
+        bands = {(r['lat'].start, r['lat'].stop) for r in regions
+                 if 'lat' in r}
+        lazy = any(v.chunks for v in ds.data_vars.values())
+        time_layout = self.layout == 'time' and 'time' in ds.dims
+        staged = time_layout and lazy and len(bands) > 1
+        if staged:
+            # read the (one day per chunk) sources once, see module docs
+            band = max(b - a for a, b in bands)
+            stage_chunks = _staging_chunks(ds, band, itemsize=itemsize,
+                                           chunk_bytes=chunk_bytes)
+            self._write_regions(
+                ds, self.staging_path, stage_chunks, fingerprint,
+                _regions(ds, stage_chunks, 'space', region_bytes))
+            ds = xr.open_zarr(self.staging_path, chunks={},
+                              consolidated=True)
+
+        written = self._write_regions(ds, self.path, chunks, fingerprint,
+                                      regions)
+
+        prov = {'version': ZARR_VERSION, 'name': self.name,
+                'layout': self.layout, 'chunks': chunks,
+                'created': datetime.now().isoformat(),
+                'fingerprint': fingerprint,
+                'sources': [{k: r[k] for k in ('path', 'size', 'mtime')}
+                            for r in self.sources]}
+        self._write_json(self.provenance_file, prov)
+        if staged:
+            shutil.rmtree(self.staging_path, ignore_errors=True)
+        return written
+
+    def _write_regions(self, ds, path, chunks, fingerprint, regions):
+        '''write ds with chunks to the store at path, resuming by region'''
+        ds = ds.chunk(chunks)
+        for var in ds.variables.values():
+            var.encoding.pop('chunks', None)
+            var.encoding.pop('preferred_chunks', None)
+
+        progress_file = os.path.join(path, 'progress.json')
+        progress = self._read_json(progress_file)
+        if progress is None or progress.get('fingerprint') != fingerprint:
+            # (re)start: write the metadata and coordinates only
+            ds.to_zarr(path, mode='w', compute=False, consolidated=True)
+            progress = {'fingerprint': fingerprint, 'done': []}
+            self._write_json(progress_file, progress)
+
+        done = set(progress['done'])
+        written = 0
+        for region in regions:
+            key = _region_key(region)
+            if key in done:
+                continue
+            sub = ds.isel(region)
+            drops = [k for k, v in sub.variables.items()
+                     if not set(v.dims) & set(region)]
+            sub.drop_vars(drops).to_zarr(path, region=region)
+            progress['done'].append(key)
+            self._write_json(progress_file, progress)
+            written += 1
+        return written
@@ -4,9 +4,18 @@ import xarray as xr
 import pprint
 import pycurl
 import itertools
-from joblib import Parallel, delayed
+import hashlib
+import json
+import threading
+import time
+from functools import partial
+from concurrent.futures import (ThreadPoolExecutor, ProcessPoolExecutor,
+                                as_completed)
 import click
 
+from loca.instrument import measure
+from loca.remap import remap_file
+
 try:
     from cdo import Cdo
     cdo = Cdo()
@@ -27,7 +36,15 @@ livneh_met_root = 'dcp/archive/cmip5/loca/livneh2014.1_16deg/netcdf/daily/'
 livneh_met_template = 'livneh_NAmerExt_15Oct2014.{0:04d}{1:02d}.nc'
 liven_met_target = '/glade/p/ral/hap/common_data/Livneh_met/livneh2014.1_16deg'
 
-FORCE_REMAP = True
+FORCE_REMAP = False
+
+QC_MANIFEST_FILE = os.path.join(
+    os.environ.get('LOCA_CACHE_DIR',
+                   os.path.join(os.path.expanduser('~'), '.cache', 'loca')),
+    'qc_manifest.json')
+
+# set by main, shared by all download threads
+QC_MANIFEST = None
 
 variables = ['runoff', 'baseflow', 'SWE', 'ET', 'windspeed',
              'shortwave_in']
@@ -35,46 +52,61 @@ variables = ['runoff', 'baseflow', 'SWE', 'ET', 'windspeed',
 
 @click.command()
 @click.option('--kind', default='met', help='LOCA data type to download')
-@click.option('--n_jobs', help='number of processes to run',
+@click.option('--n_jobs', help='number of parallel download connections',
               default=1)
 @click.option('--remap_to', default=False)
 @click.option('-v', '--verbose', count=True)
 @click.option('--quick', is_flag=True,
-              help='skip the full QC check of existing files')
-def main(kind, n_jobs, remap_to, verbose, quick):
+              help='skip the checksum in the QC check of existing files')
+@click.option('--verify', is_flag=True,
+              help='only verify existing files, do not download')
+@click.option('--manifest', default=QC_MANIFEST_FILE,
+              help='path of the QC manifest')
+@click.option('--checksums', default=None,
+              help='md5sum style file of the expected checksums')
+@click.option('--root', default=loca_root,
+              help='URL of the server root to download from')
+def main(kind, n_jobs, remap_to, verbose, quick, verify, manifest, checksums,
+         root):
+    global QC_MANIFEST
+    QC_MANIFEST = QCManifest(manifest, checksums=(read_checksums(checksums)
+                                                  if checksums else None))
+
     for k, func in [('vic', main_vic), ('met', main_met),
                     ('livneh', main_livneh_forcings),
                     ('livneh_vic', main_livneh_vic)]:
         if k == kind:
-            files = func()
+            files = func(root=root)
 
             if verbose:
                 # cdo.debug = True
                 pp.pprint(files)
                 print(len(files))
 
+            if verify:
+                failures = verify_all(files.values(), QC_MANIFEST,
+                                      n_jobs=n_jobs, full=not quick)
+                print('FAILED QC:')
+                pp.pprint(failures)
+                continue
+
             # download these files
-            failures = Parallel(n_jobs=n_jobs, verbose=11)(delayed(
-                _maybe_download)(r, t, gridfile=remap_to,
-                                 quick=quick) for (r, t) in files.items())
+            failures = download_all(files, n_jobs=n_jobs, quick=quick)
+            QC_MANIFEST.save()
 
-            failures = set(failures)
             print('FAILED TO DOWNLOAD:')
             pp.pprint(failures)
 
-            # # remap these files
-            # if remap_to:
-            #     targets = files.values()
-            #     failures = Parallel(n_jobs=n_jobs, verbose=11)(delayed(
-            #         _maybe_remap)(t, gridfile=remap_to,
-            #                       quick=quick) for t in targets)
-            #
-            #     failures = set(failures)
-            #     print('FAILED TO REMAP:')
-            #     pp.pprint(failures)
+            # remap these files
+            if remap_to:
+                targets = [t for t in files.values() if os.path.isfile(t)]
+                failures = remap_all(targets, remap_to, n_jobs=n_jobs)
 
+                print('FAILED TO REMAP:')
+                pp.pprint(failures)
 
-def main_met():
+
+def main_met(root=loca_root):
 
     models = {
         'historical': {
@@ -130,7 +162,7 @@ def main_met():
                 for drange in _make_drange_list(scen):
                     fname = met_template.format(var=var, mod=model, scen=scen,
                                                 drange=drange, ens=ens)
-                    remote = os.path.join(loca_root, met_root, model, '16th',
+                    remote = os.path.join(root, met_root, model, '16th',
                                           scen, ens, var, fname)
                     target_dir = os.path.join(met_target, model, '16th',
                                               scen, ens, var)
@@ -141,7 +173,7 @@ def main_met():
     return to_download
 
 
-def main_vic():
+def main_vic(root=loca_root):
 
     scenarios = ['historical', 'rcp45', 'rcp85']
 
@@ -158,7 +190,7 @@ def main_vic():
     for scen, model, var in itertools.product(scenarios, models, variables):
         for year in _make_drange_list(scen, with_md=False):
             fname = vic_template.format(var=var, year=year)
-            remote = os.path.join(loca_root, vic_root, model,
+            remote = os.path.join(root, vic_root, model,
                                   'vic_output.{scen}.netcdf'.format(scen=scen),
                                   fname)
             target = os.path.join(vic_target, model,
@@ -170,13 +202,13 @@ def main_vic():
     return to_download
 
 
-def main_livneh_forcings():
+def main_livneh_forcings(root=loca_root):
     to_download = {}
 
     for year in range(1950, 2014):
         for month in range(1, 13):
             fname = livneh_met_template.format(year, month)
-            remote = os.path.join(loca_root, livneh_met_root, fname)
+            remote = os.path.join(root, livneh_met_root, fname)
             target = os.path.join(liven_met_target, fname)
 
             to_download[remote] = target
@@ -184,7 +216,7 @@ def main_livneh_forcings():
     return to_download
 
 
-def main_livneh_vic():
+def main_livneh_vic(root=loca_root):
     to_download = {}
 
     for dset in ['Livneh_L14', 'Livneh_L14_CONUS']:
@@ -193,7 +225,7 @@ def main_livneh_vic():
                 # ftp://gdo-dcp.ucllnl.org/pub/..../data/LOCA_VIC_dpierce_2017-02-28/Livneh_L14/
                 fname = vic_template.format(var=var, year=year)
 
-                remote = os.path.join(loca_root, vic_root, dset, fname)
+                remote = os.path.join(root, vic_root, dset, fname)
                 target = os.path.join(vic_target, dset, fname)
 
                 to_download[remote] = target
@@ -212,54 +244,216 @@ def _make_drange_list(scen, with_md=True):
         return ['{:04d}'.format(y) for y in years]
 
 
-def file_qc_passes(f, quick=True):
-    if os.path.isfile(f):
-        if quick:
-            return True
-        try:
-            with xr.open_dataset(f,
-                                 decode_cf=False,
-                                 decode_times=False,
-                                 decode_coords=False) as ds:
-                with open(os.devnull, "w") as buf:
-                    ds.info(buf=buf)
-                ds = ds.load()
-                return True
-        except Exception as e:
-            return False
-    return False
+def _checksum(f, blocksize=2 ** 22):
+    '''streaming md5 checksum of a file'''
+    h = hashlib.md5()
+    with open(f, 'rb') as fh:
+        for block in iter(lambda: fh.read(blocksize), b''):
+            h.update(block)
+    return h.hexdigest()
+
 
+def _sanity_check(f):
+    '''check the netCDF header and read the last record of every variable
 
-def _maybe_download(remote, target, gridfile=None, quick=True, max_tries=5):
-    if not file_qc_passes(target, quick=quick):
+    A file that was cut off mid-download fails when its last record is
+    read, without having to load the whole file.
+    '''
+    with open(f, 'rb') as fh:
+        magic = fh.read(4)
+    if magic[:3] != b'CDF' and magic != b'\x89HDF':
+        return False
+    try:
+        with xr.open_dataset(f,
+                             decode_cf=False,
+                             decode_times=False,
+                             decode_coords=False) as ds:
+            for var in ds.variables.values():
+                if var.ndim and var.shape[0]:
+                    var[-1].values
+        return True
+    except Exception:
+        return False
+
+
+def read_checksums(path):
+    '''read an ``md5sum`` style file into a {basename: md5} dict'''
+    checksums = {}
+    with open(path) as f:
+        for line in f:
+            parts = line.split()
+            if len(parts) == 2:
+                checksums[os.path.basename(parts[1].lstrip('*'))] = \
+                    parts[0].lower()
+    return checksums
+
+
+def check_file(f, full=True, expected=None):
+    '''run the QC checks on one file and return its manifest record
+
+    If the ``expected`` md5 is known the checksum is always computed and a
+    mismatch fails the check.
+    '''
+    st = os.stat(f)
+    rec = {'size': st.st_size, 'mtime': st.st_mtime,
+           'ok': st.st_size > 0 and _sanity_check(f), 'checksum': None}
+    if (full or expected) and rec['ok']:
+        rec['checksum'] = _checksum(f)
+        if expected and rec['checksum'] != expected:
+            rec['ok'] = False
+    return rec
+
+
+class QCManifest(object):
+    '''persistent record of the QC results of every file
+
+    Files are only checked again when their size or mtime changes.
+    ``checksums`` optionally maps file basenames to their published md5,
+    which the recorded checksums are compared with.
+    '''
+
+    def __init__(self, path=QC_MANIFEST_FILE, checksums=None):
+        self.path = path
+        self.checksums = checksums or {}
+        self._lock = threading.Lock()
+        self._dirty = 0
+        try:
+            with open(path) as f:
+                self.records = json.load(f)
+        except (OSError, ValueError):
+            self.records = {}
+
+    def save(self):
+        with self._lock:
+            records = dict(self.records)
+            self._dirty = 0
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)),
+                    exist_ok=True)
+        tmp = '%s.%d.tmp' % (self.path, os.getpid())
+        with open(tmp, 'w') as f:
+            json.dump(records, f)
+        os.replace(tmp, self.path)
+
+    def is_current(self, f, full=True):
+        '''True if f has a QC record matching its current stat'''
+        rec = self.records.get(f)
+        if rec is None:
+            return False
+        st = os.stat(f)
+        if (rec['size'], rec['mtime']) != (st.st_size, st.st_mtime):
+            return False
+        if not rec['ok']:
+            return True
+        if rec['checksum'] is None:
+            return not (full or self.expected(f))
+        return rec['checksum'] == self.expected(f, rec['checksum'])
+
+    def expected(self, f, default=None):
+        '''published md5 of f, if known'''
+        return self.checksums.get(os.path.basename(f), default)
+
+    def update(self, f, rec):
+        with self._lock:
+            self.records[f] = rec
+            self._dirty += 1
+            save = self._dirty >= 500
+        if save:
+            self.save()
+
+    def passes(self, f, full=True):
+        if not self.is_current(f, full=full):
+            self.update(f, check_file(f, full=full,
+                                      expected=self.expected(f)))
+        return self.records[f]['ok']
+
+
+def file_qc_passes(f, quick=True, manifest=None):
+    '''check that f exists and is a complete netCDF file
+
+    The header and last record of every variable are checked; unless
+    ``quick``, a checksum is recorded as well. Results are cached in the QC
+    manifest so unchanged files are not checked again.
+    '''
+    if not os.path.isfile(f):
+        return False
+    if manifest is None:
+        manifest = QC_MANIFEST
+    if manifest is None:
+        return check_file(f, full=not quick)['ok']
+    return manifest.passes(f, full=not quick)
+
+
+def verify_all(files, manifest, n_jobs=1, full=True):
+    '''QC check the existing files whose stat changed, in parallel
+
+    Returns the list of files that failed.
+    '''
+    files = list(files)
+    todo = [f for f in files
+            if os.path.isfile(f) and not manifest.is_current(f, full=full)]
+    print('verifying %d files' % len(todo), flush=True)
+    with measure('verify_all', kind='download', report=False,
+                 params=dict(n_jobs=n_jobs, full=full)) as step:
+        step.add_files(todo)
+        with ProcessPoolExecutor(max_workers=n_jobs) as pool:
+            futures = {pool.submit(check_file, f, full=full,
+                                   expected=manifest.expected(f)): f
+                       for f in todo}
+            for future in as_completed(futures):
+                manifest.update(futures[future], future.result())
+        manifest.save()
+        records = manifest.records
+        failures = sorted(f for f in files
+                          if f in records and not records[f]['ok'])
+        step.update(failures=len(failures))
+    return failures
+
+
+def _maybe_download(remote, target, gridfile=None, quick=True, max_tries=5,
+                    stats=None, manifest=None, fetch=None):
+    if not file_qc_passes(target, quick=quick, manifest=manifest):
         for a in range(max_tries):
             try:
                 path = os.path.dirname(target)
                 os.makedirs(path, exist_ok=True)
-                download(remote, target)
-                assert file_qc_passes(target, quick=quick)
+                # retries resume from the partial file
+                download(remote, target, stats=stats, fetch=fetch)
+                if not file_qc_passes(target, quick=quick,
+                                      manifest=manifest):
+                    # keep the bad copy aside so the next try starts over
+                    # and a failed file never looks like a finished target
+                    os.replace(target, target + '.bad')
+                    raise IOError('downloaded file failed QC: %s' % target)
                 break
             except Exception as e:
                 print(e)
                 continue
         else:
+            if stats is not None:
+                stats.add_failure()
             return remote
-    if gridfile is not None:
+    if gridfile:
         return _maybe_remap(target, gridfile, quick=quick)
 
 
 def _maybe_remap(infile, gridfile, quick=True, operator='remapcon'):
-    '''Remap infile using cdo'''
-    # Temporary check of dimensions
+    '''Remap infile to gridfile, skipping outputs that are up to date
+
+    Conservative remapping uses the cached sparse weights in loca.remap,
+    other operators fall back to cdo.
+    '''
     try:
-        if cdo is None:
-            raise RuntimeError("we were note able to load cdo")
-        remap_method = getattr(cdo, operator)
         outfile = _make_remap_output_filename_and_dir(infile)
-        if not file_qc_passes(outfile, quick=quick):
-            remap_method(gridfile, input=infile, output=outfile)
-        elif FORCE_REMAP:
-            remap_method(gridfile, input=infile, output=outfile)
+        if operator == 'remapcon':
+            if not remap_file(infile, outfile, gridfile=gridfile,
+                              force=FORCE_REMAP):
+                return ''
+        else:
+            if cdo is None:
+                raise RuntimeError("we were note able to load cdo")
+            remap_method = getattr(cdo, operator)
+            if FORCE_REMAP or not file_qc_passes(outfile, quick=quick):
+                remap_method(gridfile, input=infile, output=outfile)
     except Exception as e:
         print(e)
         return infile
@@ -268,6 +462,29 @@ def _maybe_remap(infile, gridfile, quick=True, operator='remapcon'):
         return ''
 
 
+def remap_all(files, gridfile, n_jobs=1, operator='remapcon'):
+    '''remap files to gridfile in a process pool
+
+    The remapping weights are computed once and cached on disk, each worker
+    then only reads them. Returns the set of files that failed.
+    '''
+    with measure('remap_all', kind='download', report=False,
+                 params=dict(n_jobs=n_jobs, operator=operator)) as step:
+        step.add_files(files)
+        failures = set()
+        if files and operator == 'remapcon':
+            # compute (and cache) the weights once before starting the workers
+            failures.add(_maybe_remap(files[0], gridfile, operator=operator))
+            files = files[1:]
+        with ProcessPoolExecutor(max_workers=n_jobs) as pool:
+            failures.update(pool.map(partial(_maybe_remap, gridfile=gridfile,
+                                             operator=operator), files,
+                                     chunksize=16))
+        failures.discard('')
+        step.update(failures=len(failures))
+    return failures
+
+
 def _make_remap_output_filename_and_dir(infile):
     if '16th' in infile:
         new_file = infile.replace('16th', '8th')
@@ -280,18 +497,142 @@ def _make_remap_output_filename_and_dir(infile):
     return new_file
 
 
-def download(remote, target):
-    # As long as the file is opened in binary mode, both Python 2 and Python 3
-    # can write response body to it without decoding.
-    print(remote, '-->', target, flush=True)
-    with open(target, 'wb') as f:
+class DownloadStats(object):
+    '''thread safe tally of the downloaded bytes and files'''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.start = time.time()
+        self.nbytes = 0
+        self.files = 0
+        self.failures = 0
+
+    def add(self, nbytes):
+        with self._lock:
+            self.nbytes += nbytes
+            self.files += 1
+
+    def add_failure(self):
+        with self._lock:
+            self.failures += 1
+
+    @property
+    def throughput(self):
+        '''aggregate throughput in bytes per second'''
+        return self.nbytes / max(time.time() - self.start, 1e-9)
+
+    def report(self):
+        elapsed = time.time() - self.start
+        print('downloaded %d files (%.1f MB) in %.1f s: %.2f MB/s, '
+              '%d failures' % (self.files, self.nbytes / 1e6, elapsed,
+                               self.throughput / 1e6, self.failures),
+              flush=True)
+
+
+_local = threading.local()
+
+
+def _get_curl():
+    '''return this thread's curl handle
+
+    Reusing one handle per thread lets libcurl keep the FTP control
+    connection open between files on the same server.
+    '''
+    c = getattr(_local, 'curl', None)
+    if c is None:
         c = pycurl.Curl()
-        c.setopt(c.URL, remote)
-        c.setopt(c.WRITEDATA, f)
+        c.setopt(c.NOSIGNAL, 1)
+        c.setopt(c.FAILONERROR, 1)
+        c.setopt(c.CONNECTTIMEOUT, 60)
+        # give up on stalled transfers, they will be resumed on retry
+        c.setopt(c.LOW_SPEED_LIMIT, 1)
+        c.setopt(c.LOW_SPEED_TIME, 120)
+        _local.curl = c
+    return c
+
+
+def curl_fetch(remote, f, offset=0):
+    '''stream remote into the open file f, resuming at offset
+
+    Returns the number of bytes transferred. This is the default ``fetch``
+    of ``download``; any callable with the same signature can replace it.
+    '''
+    c = _get_curl()
+    c.setopt(c.URL, remote)
+    c.setopt(c.WRITEDATA, f)
+    c.setopt(c.RESUME_FROM_LARGE, offset)
+    try:
         c.perform()
-        c.close()
-    if os.stat(target).st_size == 0:
-        os.remove(target)
+    except pycurl.error as e:
+        if offset and e.args[0] in (pycurl.E_RANGE_ERROR,
+                                    pycurl.E_BAD_DOWNLOAD_RESUME):
+            # the server can't resume this file, start from scratch
+            f.seek(0)
+            f.truncate()
+            c.setopt(c.RESUME_FROM_LARGE, 0)
+            c.perform()
+        else:
+            raise
+    return int(c.getinfo(c.SIZE_DOWNLOAD))
+
+
+def download(remote, target, stats=None, fetch=None):
+    '''download remote to target, resuming from target + '.part' if present
+
+    Data is streamed to the ``.part`` file, which is atomically renamed to
+    target once the transfer completes. ``fetch`` defaults to ``curl_fetch``.
+    '''
+    print(remote, '-->', target, flush=True)
+    if fetch is None:
+        fetch = curl_fetch
+    part = target + '.part'
+    offset = os.path.getsize(part) if os.path.isfile(part) else 0
+
+    # As long as the file is opened in binary mode, both Python 2 and Python 3
+    # can write response body to it without decoding.
+    try:
+        with open(part, 'ab') as f:
+            nbytes = fetch(remote, f, offset)
+    finally:
+        if os.path.isfile(part) and os.path.getsize(part) == 0:
+            os.remove(part)
+
+    if not os.path.isfile(part):
+        raise IOError('empty download: %s' % remote)
+    os.replace(part, target)
+    if stats is not None:
+        stats.add(nbytes)
+    return nbytes
+
+
+def download_all(files, n_jobs=1, gridfile=None, quick=True, max_tries=5,
+                 manifest=None, fetch=None):
+    '''download (and optionally remap) a dict of {remote: target} files
+
+    Uses a pool of ``n_jobs`` threads, each reusing its own connection.
+    Returns the set of files that failed.
+    '''
+    stats = DownloadStats()
+    failures = set()
+    with measure('download_all', kind='download', report=False,
+                 params=dict(n_jobs=n_jobs, quick=quick)) as step:
+        with ThreadPoolExecutor(max_workers=n_jobs) as pool:
+            futures = [pool.submit(_maybe_download, r, t, gridfile=gridfile,
+                                   quick=quick, max_tries=max_tries,
+                                   stats=stats, manifest=manifest,
+                                   fetch=fetch)
+                       for (r, t) in files.items()]
+            for i, future in enumerate(as_completed(futures), 1):
+                failures.add(future.result())
+                if i % 100 == 0:
+                    stats.report()
+        stats.report()
+        failures.discard(None)
+        failures.discard('')
+        step.update(requested=len(files), downloaded=stats.files,
+                    downloaded_bytes=stats.nbytes, failures=len(failures),
+                    throughput=stats.throughput)
+    return failures
 
 
 if __name__ == "__main__":
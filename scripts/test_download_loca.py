@@ -0,0 +1,118 @@
+'''Tests of the download engine against a local HTTP stand-in server'''
+import functools
+import hashlib
+import os
+import threading
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+import pytest
+import xarray as xr
+
+pytest.importorskip('pycurl')
+
+import download_loca  # noqa: E402
+from loca import instrument  # noqa: E402
+
+
+class RangeRequestHandler(SimpleHTTPRequestHandler):
+    '''static file handler that honours ``Range: bytes=N-`` requests'''
+
+    def send_head(self):
+        rng = self.headers.get('Range')
+        path = self.translate_path(self.path)
+        if not rng or not os.path.isfile(path):
+            return super().send_head()
+        start = int(rng.split('=')[1].split('-')[0])
+        f = open(path, 'rb')
+        size = os.fstat(f.fileno()).st_size
+        f.seek(start)
+        self.send_response(206)
+        self.send_header('Content-Range',
+                         'bytes %d-%d/%d' % (start, size - 1, size))
+        self.send_header('Content-Length', str(size - start))
+        self.end_headers()
+        return f
+
+    def log_message(self, *args):
+        pass
+
+
+class QuietRequestHandler(SimpleHTTPRequestHandler):
+
+    def log_message(self, *args):
+        pass
+
+
+def _serve(directory, handler):
+    server = ThreadingHTTPServer(
+        ('127.0.0.1', 0), functools.partial(handler, directory=directory))
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server, 'http://127.0.0.1:%d/' % server.server_address[1]
+
+
+@pytest.fixture(params=[RangeRequestHandler, QuietRequestHandler],
+                ids=['ranges', 'no-ranges'])
+def server(request, tmp_path, monkeypatch):
+    monkeypatch.setattr(instrument, 'RUN_LOG', str(tmp_path / 'runs.jsonl'))
+    root = tmp_path / 'remote'
+    root.mkdir()
+    xr.Dataset({'pr': (('time', 'lat'), np.random.rand(50, 20))}).to_netcdf(
+        str(root / 'good.nc'), engine='scipy')
+    data = (root / 'good.nc').read_bytes()
+    (root / 'truncated.nc').write_bytes(data[:len(data) // 2])
+    srv, url = _serve(str(root), request.param)
+    yield url, root
+    srv.shutdown()
+    srv.server_close()
+
+
+def test_download_all(server, tmp_path):
+    url, root = server
+    target = str(tmp_path / 'local' / 'good.nc')
+    failures = download_loca.download_all({url + 'good.nc': target},
+                                          n_jobs=2, max_tries=1)
+    assert failures == set()
+    assert open(target, 'rb').read() == (root / 'good.nc').read_bytes()
+    assert not os.path.exists(target + '.part')
+
+
+def test_download_resumes_part_file(server, tmp_path):
+    url, root = server
+    data = (root / 'good.nc').read_bytes()
+    target = str(tmp_path / 'good.nc')
+    with open(target + '.part', 'wb') as f:
+        f.write(data[:100])
+    download_loca.download(url + 'good.nc', target)
+    assert open(target, 'rb').read() == data
+
+
+def test_failed_qc_is_moved_aside(server, tmp_path):
+    url, _ = server
+    target = str(tmp_path / 'truncated.nc')
+    failures = download_loca.download_all({url + 'truncated.nc': target},
+                                          max_tries=2)
+    assert failures == {url + 'truncated.nc'}
+    assert not os.path.exists(target)
+    assert os.path.exists(target + '.bad')
+
+
+def test_checksum_mismatch_fails(server, tmp_path):
+    url, root = server
+    good = hashlib.md5((root / 'good.nc').read_bytes()).hexdigest()
+    target = str(tmp_path / 'good.nc')
+
+    manifest = download_loca.QCManifest(str(tmp_path / 'qc.json'),
+                                        checksums={'good.nc': '0' * 32})
+    failures = download_loca.download_all({url + 'good.nc': target},
+                                          max_tries=1, manifest=manifest)
+    assert failures == {url + 'good.nc'}
+    assert not os.path.exists(target)
+
+    manifest = download_loca.QCManifest(str(tmp_path / 'qc.json'),
+                                        checksums={'good.nc': good})
+    failures = download_loca.download_all({url + 'good.nc': target},
+                                          max_tries=1, manifest=manifest)
+    assert failures == set()
+    assert manifest.records[target]['checksum'] == good
@@ -12,5 +12,6 @@ setup(name='loca',
       url='https://github.com/jhamman/LOCA_Downscaling_Analysis',
       license='Apache',
       packages=['loca'],
+      python_requires='>=3.7',
       long_description=long_description,
       zip_safe=False)